@@ -0,0 +1,304 @@
+
+#
+#
+#
+# Archives (zip and tar files) traversed as directories, without extracting them.
+#
+# ArchiveFileSystem wraps another file system (see fileSystems.py) and reports files
+# with an archive extension as directories. Listing such a directory, or one of the
+# directories inside it, reads only the index of the archive: the central directory
+# at the end of zip files, or the headers of the members of tar files (compressed
+# tar files have to be decompressed for this, but nothing is written). The index
+# also provides the sizes and modification times of the members, so visitors and
+# templates handle members exactly like files.
+#
+# Indexes are cached in memory and, if a cache file is given, in a SQLite database,
+# keyed by the path of the archive and checked against its modification time and
+# size. Traversing unchanged archives again hence costs one stat call each.
+#
+# Members of archives are reported with:
+#   - their uncompressed size, and the compressed one as allocated size (zip files),
+#   - the modification time stored in the archive; directories inside archives have
+#     the modification time of the archive, so that the export cache (exportCache.py)
+#     notices changed archives,
+#   - the device of the archive and made up inode numbers.
+#
+# NOTE: Archives inside archives are reported as files. Contents of members can not be
+#       opened. Member names are sanitized: absolute paths and .. components are dropped.
+#
+#
+#
+
+
+import os
+import stat
+import json
+import time
+import errno
+import sqlite3
+import tarfile
+import zipfile
+import threading
+import collections
+
+from fileSystems import FileSystem, LocalFileSystem, MemoryFileSystem, MemoryEntry
+
+
+
+ZIPEXTENSIONS = ('.zip', '.jar')
+TAREXTENSIONS = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+ARCHIVEEXTENSIONS = ZIPEXTENSIONS + TAREXTENSIONS
+
+# Substrings of paths that may lead into an archive
+ARCHIVEHINTS = ('.zip', '.jar', '.tar', '.tgz', '.tbz2', '.txz')
+
+SCHEMA = ['CREATE TABLE IF NOT EXISTS archives (path TEXT PRIMARY KEY, mtime REAL, size INTEGER, members TEXT)']
+
+# Made up inode numbers of members (see archiveIndex())
+MEMBERINODES = 1 << 62
+
+
+
+def isArchiveName(name):
+    return(name.lower().endswith(ARCHIVEEXTENSIONS))
+
+
+
+# Components of a member name inside the archive
+def memberComponents(name):
+    return([c for c in name.replace('\\', '/').split('/') if c not in ('', '.', '..')])
+
+
+
+# Reads the members of the archive in the open (binary) file f as a list of
+# (name, isDir, size, packed size, mtime). name: the file name of the archive.
+# Raises OSError if the archive can not be read.
+def readMembers(f, name):
+    members = []
+    try:
+       if name.lower().endswith(ZIPEXTENSIONS):
+          with zipfile.ZipFile(f) as z:
+               for i in z.infolist():
+                   try:
+                      mtime = time.mktime(i.date_time + (0, 0, -1))
+                   except (OverflowError, ValueError):
+                      mtime = 0.0
+                   members.append((i.filename, i.is_dir(), i.file_size, i.compress_size, mtime))
+       else:
+          with tarfile.open(fileobj=f, mode='r:*') as t:
+               for m in t:
+                   members.append((m.name, m.isdir(), m.size, m.size, float(m.mtime)))
+    except (zipfile.BadZipFile, tarfile.TarError, EOFError, ValueError) as arEx:
+       raise OSError(errno.EIO, f'Cannot read archive: {arEx}', name)
+
+    return(members)
+
+
+
+# The index of an archive with the given stat: a MemoryFileSystem holding its members.
+def archiveIndex(members, st):
+    index = MemoryFileSystem()
+    for name, isDir, size, packed, mtime in members:
+        components = memberComponents(name)
+        if len(components) == 0:
+           continue
+
+        path = os.sep.join(components)
+        try:
+           if isDir:
+              index.makeDirectories(path)
+           else:
+              index.addFile(path, size, mtime)
+              index.node(path).st.st_blocks = (packed + 511)//512
+        except OSError:
+           # Name used for both a file and a directory
+           continue
+
+    base = MEMBERINODES | ((st.st_ino & 0xFFFFFFFFFF) << 20)
+    stack = [index.root]
+    while len(stack) > 0:
+          n = stack.pop()
+          n.st.st_dev = st.st_dev
+          n.st.st_ino = base | (n.st.st_ino & 0xFFFFF)
+          if n.children is not None:
+             n.st.st_mtime = n.st.st_atime = n.st.st_ctime = st.st_mtime
+             stack.extend(n.children.values())
+
+    return(index)
+
+
+
+
+# Looks like the os.stat_result of a directory, for archives (see ArchiveEntry)
+class ArchiveStat:
+
+      def __init__(self, st):
+          self.st = st
+          self.st_mode = stat.S_IFDIR | stat.S_IMODE(st.st_mode)
+
+      def __getattr__(self, name):
+          return(getattr(self.st, name))
+
+
+
+# Entry of an archive found in a listing: a directory.
+class ArchiveEntry:
+
+      __slots__ = ('entry',)
+
+      def __init__(self, entry):
+          self.entry = entry
+
+      @property
+      def name(self):
+          return(self.entry.name)
+
+      @property
+      def path(self):
+          return(self.entry.path)
+
+      def is_dir(self, follow_symlinks=True):
+          return(True)
+
+      def is_file(self, follow_symlinks=True):
+          return(False)
+
+      def is_symlink(self):
+          return(self.entry.is_symlink())
+
+      def stat(self, follow_symlinks=True):
+          return(ArchiveStat(self.entry.stat()))
+
+
+
+
+# fileSystem: the file system holding the archives (default: the local one).
+# cachePath: SQLite database in which indexes are cached; '' caches them in memory only.
+# cached: number of indexes cached in memory.
+# read counts the archives read, reused those whose cached index was used.
+class ArchiveFileSystem(FileSystem):
+
+      def __init__(self, fileSystem=None, cachePath='', cached=64):
+          self.fileSystem = LocalFileSystem() if fileSystem is None else fileSystem
+          self.cachePath = cachePath
+          self.cached = cached
+          self.read = 0
+          self.reused = 0
+          self.setup()
+
+
+      def setup(self):
+          # archive path -> (mtime, size, index)
+          self.indexes = collections.OrderedDict()
+          self.lock = threading.Lock()
+          self.db = None
+          if self.cachePath not in (None, ''):
+             # Used by prefetching threads (-W) too; access is serialized by the lock
+             self.db = sqlite3.connect(self.cachePath, check_same_thread=False)
+             for stmt in SCHEMA:
+                 self.db.execute(stmt)
+             self.db.commit()
+
+
+      # Sharded traversals (-MP) hand the file system to other processes; connections
+      # and locks can not be pickled.
+      def __getstate__(self):
+          return({'fileSystem':self.fileSystem, 'cachePath':self.cachePath, 'cached':self.cached, 'read':0, 'reused':0})
+
+      def __setstate__(self, state):
+          self.__dict__.update(state)
+          self.setup()
+
+
+      def close(self):
+          if self.db is not None:
+             self.db.close()
+             self.db = None
+
+
+
+      # Splits path into the archive it leads into and the path inside the archive.
+      # Returns (None, None) if path is not inside an archive (nor an archive itself).
+      def locate(self, path):
+          lower = path.lower()
+          if not any(h in lower for h in ARCHIVEHINTS):
+             return(None, None)
+
+          components = os.path.normpath(path).split(os.sep)
+          for i, c in enumerate(components):
+              if not isArchiveName(c):
+                 continue
+
+              prefix = os.sep.join(components[:i+1])
+              try:
+                 st = self.fileSystem.stat(prefix)
+              except OSError:
+                 return(None, None)
+
+              if stat.S_ISREG(st.st_mode):
+                 return(prefix, os.sep.join(components[i+1:]))
+
+          return(None, None)
+
+
+      # Returns the index (see archiveIndex()) of the archive at path.
+      def index(self, path):
+          st = self.fileSystem.stat(path)
+          key = os.path.abspath(path)
+          with self.lock:
+               cached = self.indexes.get(key)
+               if cached is not None and cached[0] == st.st_mtime and cached[1] == st.st_size:
+                  self.indexes.move_to_end(key)
+                  self.reused += 1
+                  return(cached[2])
+
+               members = None
+               if self.db is not None:
+                  row = self.db.execute('SELECT mtime, size, members FROM archives WHERE path=?', (key,)).fetchone()
+                  if row is not None and row[0] == st.st_mtime and row[1] == st.st_size:
+                     members = json.loads(row[2])
+                     self.reused += 1
+
+          if members is None:
+             with self.fileSystem.open(path) as f:
+                  members = readMembers(f, os.path.basename(path))
+
+             with self.lock:
+                  self.read += 1
+                  if self.db is not None:
+                     self.db.execute('INSERT OR REPLACE INTO archives (path, mtime, size, members) VALUES (?, ?, ?, ?)',
+                                     (key, st.st_mtime, st.st_size, json.dumps(members)))
+                     self.db.commit()
+
+          index = archiveIndex(members, st)
+          with self.lock:
+               self.indexes[key] = (st.st_mtime, st.st_size, index)
+               while len(self.indexes) > self.cached:
+                     self.indexes.popitem(last=False)
+          return(index)
+
+
+
+      def listDirectory(self, path):
+          archive, inner = self.locate(path)
+          if archive is None:
+             return([ArchiveEntry(e) if isArchiveName(e.name) and not e.is_dir() else e for e in self.fileSystem.listDirectory(path)])
+
+          return([MemoryEntry(e.name, os.path.join(path, e.name), e.node) for e in self.index(archive).listDirectory(inner)])
+
+
+      def stat(self, path):
+          archive, inner = self.locate(path)
+          if archive is None:
+             return(self.fileSystem.stat(path))
+
+          if inner == '':
+             return(ArchiveStat(self.fileSystem.stat(archive)))
+          return(self.index(archive).stat(inner))
+
+
+      def open(self, path):
+          archive, inner = self.locate(path)
+          if archive is None or inner == '':
+             return(self.fileSystem.open(path))
+          raise OSError(errno.EOPNOTSUPP, 'Members of archives can not be opened', path)
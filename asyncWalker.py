@@ -0,0 +1,174 @@
+
+#
+#
+#
+# asyncio version of the directory traversal.
+#
+# Allows applications running an asyncio event loop to traverse directory
+# structures without blocking the loop:
+#
+#    async for entry in asyncWalker.walk('some/dir', {'maxFiles':100}, stat=True):
+#          print(entry.type, entry.path, entry.meta['size'])
+#
+# Directories are listed (and their entries stat-ed) in an executor by concurrency
+# lister tasks, each listing one directory at a time. A lister waits until the
+# consumer has taken its listing from the (bounded) queue before listing the next
+# directory, so memory and tasks stay bounded however many directories are found.
+# Entries are yielded as
+# soon as the listing of their directory is available, hence NOT in the sorted
+# depth-first order of functionality.fsTraversal().
+#
+#
+
+
+
+import asyncio
+import time
+
+from utilities import normalizedPathJoin, entryInfo, lazyEntryInfo
+import functionality
+import fileSystems
+import handlers
+
+
+
+
+# Executed in the executor. Lists path and, if stat is True, stats all its entries.
+# Returns (dirs, files) as lists of (name, FileMeta) tuples. If stat is False, metadata
+# is fetched (in the calling thread) when accessed.
+def listAndStat(path, stat=True):
+    dirs, files = functionality.scanDirectory(path)
+    meta = entryInfo if stat else lazyEntryInfo
+    return([(d.name, meta(d)) for d in dirs], [(f.name, meta(f)) for f in files])
+
+
+
+
+# Asynchronous generator yielding a handlers.TraversalEntry for each file and directory
+# in root that complies to criteria (see handlers.CompiledCriteria).
+#
+# Directories that don't comply are not traversed. Criteria maxLevels, nonRecursive,
+# uniqueDirectories and oneFileSystem are honored.
+# Criteria maxTime, maxFiles and maxDirs do not raise criteriaException; the generator
+# simply stops. If status (a dictionary) is given, the keys 'code' and 'message' are set
+# when the generator finishes: code is 0 if the traversal completed, or the error code
+# that the criteriaException would have had (-9 for maxFiles, -10 for maxDirs/maxTime).
+#
+# concurrency: number of lister tasks i.e. maximum number of directory listings in
+#              progress at the same time.
+# executor: concurrent.futures executor to list directories in. Defaults to the loop's
+#           default executor. Several walks can share the same executor and loop.
+# stat: stat entries in the executor. Defaults to True only if the criteria need metadata;
+#       otherwise entry.meta is stat-ed on first access, blocking the loop.
+
+async def walk(root, criteria={}, concurrency=8, executor=None, status=None, stat=None):
+
+    loop = asyncio.get_running_loop()
+
+    maxTime = criteria.get('maxTime', -1)
+    maxFiles = criteria.get('maxFiles', -1)
+    maxDirs = criteria.get('maxDirs', -1)
+    maxLevels = criteria.get('maxLevels', -1)
+    recursive = not criteria.get('nonRecursive', False)
+    compiled = handlers.CompiledCriteria(criteria)
+    if stat is None:
+       stat = len(compiled.metadata) > 0
+
+    if status is None:
+       status = {}
+    status['code'] = 0
+    status['message'] = ''
+
+    # Listings done, waiting to be consumed. Bounded so that listing does not run
+    # too far ahead of the consumer.
+    listings = asyncio.Queue(maxsize=2*concurrency)
+    # Directories found by the consumer, waiting to be listed
+    toList = asyncio.Queue()
+    tasks = []
+
+    # Directories are stat-ed in the executor; the guard itself is only used by the loop
+    guard = functionality.DirectoryGuard.forTraversal(root, 1, functionality.TraversalCriteria(criteria))
+
+    async def allowed(path):
+        if guard is None:
+           return(True)
+        try:
+           st = await loop.run_in_executor(executor, fileSystems.current.stat, path)
+        except OSError:
+           return(True)
+        return(guard.allows(path, st))
+
+    async def lister():
+        while True:
+              path, level = await toList.get()
+              try:
+                 dirs, files = [], []
+                 if await allowed(path):
+                    dirs, files = await loop.run_in_executor(executor, listAndStat, path, stat)
+              except Exception as wEx:
+                 print('Exception during walk:', str(wEx))
+                 dirs, files = [], []
+
+              # The next directory is listed only once this listing is queued
+              await listings.put((path, level, dirs, files))
+
+    def schedule(path, level):
+        toList.put_nowait((path, level))
+
+
+    timeStarted = time.perf_counter()
+    nFiles = 0
+    nDirs = 0
+    pending = 1
+    schedule(root, 1)
+    for i in range(max(concurrency, 1)):
+        tasks.append(loop.create_task(lister()))
+    try:
+       while pending > 0:
+
+             timeout = None
+             if maxTime > 0:
+                timeout = maxTime - (time.perf_counter() - timeStarted)
+
+             try:
+                if timeout is not None and timeout <= 0:
+                   raise asyncio.TimeoutError()
+                path, level, dirs, files = await asyncio.wait_for(listings.get(), timeout)
+             except asyncio.TimeoutError:
+                status['code'] = -10
+                status['message'] = f'Maximum time constraint of {maxTime}s reached.'
+                return
+
+             pending -= 1
+
+             for name, meta in files:
+                 if compiled.fileFailure(name, meta) is not None:
+                    continue
+
+                 if maxFiles > 0 and nFiles >= maxFiles:
+                    status['code'] = -9
+                    status['message'] = 'Maximum number of FILES reached.'
+                    return
+
+                 nFiles += 1
+                 yield handlers.TraversalEntry('file', name, normalizedPathJoin(path, name), level, path, meta)
+
+             for name, meta in dirs:
+                 if compiled.directoryFailure(name) is not None:
+                    continue
+
+                 if maxDirs > 0 and nDirs >= maxDirs:
+                    status['code'] = -10
+                    status['message'] = 'Maximum number of DIRECTORIES reached.'
+                    return
+
+                 nDirs += 1
+                 dirPath = normalizedPathJoin(path, name)
+                 yield handlers.TraversalEntry('directory', name, dirPath, level, path, meta)
+
+                 if recursive and (maxLevels <= 0 or level+1 <= maxLevels):
+                    pending += 1
+                    schedule(dirPath, level+1)
+    finally:
+       for t in tasks:
+           t.cancel()
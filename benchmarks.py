@@ -0,0 +1,1392 @@
+
+#
+#
+#
+# Benchmarks for dirWalker traversal and export code paths.
+#
+# Usage:
+#    python benchmarks.py <benchmark> [-d <directory>] [-r <repetitions>]
+#
+# If no directory is given, a synthetic directory tree is generated in a
+# temporary directory and removed afterwards.
+#
+#
+
+
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import datetime
+import argparse
+import random
+import re
+import tracemalloc
+
+from collections import deque
+from contextlib import contextmanager, redirect_stdout
+
+import functionality
+import handlers
+import dirIndex
+from utilities import normalizedPathJoin, fileCreationDate, entryInfo, searchNameComplies, normalizeDateTime
+
+
+
+
+# Creates a synthetic directory tree under base.
+# Each directory gets filesPerDir files (of a few bytes) and fanout subdirectories
+# down to depth levels.
+def makeSyntheticTree(base, depth=3, fanout=4, filesPerDir=40):
+    nDirs = 0
+    nFiles = 0
+    level = [base]
+    for d in range(depth+1):
+        nextLevel = []
+        for parent in level:
+            for f in range(filesPerDir):
+                with open(os.path.join(parent, f'file{f:04d}.txt'), 'w') as fh:
+                     fh.write('x' * (f % 64))
+                nFiles += 1
+
+            if d == depth:
+               continue
+
+            for s in range(fanout):
+                sub = os.path.join(parent, f'dir{s:03d}')
+                os.mkdir(sub)
+                nDirs += 1
+                nextLevel.append(sub)
+        level = nextLevel
+
+    return(nDirs, nFiles)
+
+
+
+@contextmanager
+def syntheticTree(root='', **kw):
+    if root != '':
+       yield root
+       return
+
+    base = tempfile.mkdtemp(prefix='dirWalkerBench-')
+    try:
+       nd, nf = makeSyntheticTree(base, **kw)
+       print(f'Synthetic tree at {base}: {nd} directories, {nf} files')
+       yield base
+    finally:
+       shutil.rmtree(base, ignore_errors=True)
+
+
+
+# Counts calls made to functions in module mod while active.
+# Used to count stat()/listing calls made from python code.
+@contextmanager
+def countCalls(mod, names):
+    counts = {n:0 for n in names}
+    originals = {n:getattr(mod, n) for n in names}
+
+    def wrap(n, fn):
+        def counted(*args, **kw):
+            counts[n] += 1
+            return(fn(*args, **kw))
+        return(counted)
+
+    for n in names:
+        setattr(mod, n, wrap(n, originals[n]))
+    try:
+       yield counts
+    finally:
+       for n in names:
+           setattr(mod, n, originals[n])
+
+
+
+
+def timed(fn, repeat=3):
+    best = None
+    for r in range(repeat):
+        ts = time.perf_counter()
+        fn()
+        el = time.perf_counter() - ts
+        best = el if best is None else min(best, el)
+    return(best)
+
+
+
+
+###########################################################################
+#
+# scandir vs os.walk + per file stat calls
+#
+###########################################################################
+
+
+# The traversal as it was before the scandir engine: one os.walk() per
+# directory followed by getsize(), getmtime() and stat() for every file.
+def legacyFileInfo(filePath):
+    fInf = {}
+    try:
+      fInf['size']  = str(os.path.getsize(filePath))
+    except Exception as fszEx:
+      fInf['size'] = "-1"
+
+    try:
+       fInf['lastmodified'] = datetime.datetime.fromtimestamp(os.path.getmtime(filePath))
+    except Exception as dtmEx:
+        fInf['lastmodified'] = ''
+
+    fInf['creationdate'] = fileCreationDate(filePath)
+    return(fInf)
+
+
+def legacyListing(root):
+    path, dirs, files = next(os.walk(root))
+    dirs.sort()
+    files.sort()
+    for f in files:
+        legacyFileInfo(normalizedPathJoin(root, f))
+
+    for d in dirs:
+        legacyListing(normalizedPathJoin(root, d))
+
+
+def scandirListing(root):
+    dirs, files = functionality.scanDirectory(root)
+    for f in files:
+        entryInfo(f)
+
+    for d in dirs:
+        entryInfo(d)
+        scandirListing(normalizedPathJoin(root, d.name))
+
+
+
+# DirEntry objects can not be patched; wrap them to count stat() calls.
+# If latency (seconds) is > 0, each stat() and each listing additionally sleeps
+# that long to simulate a high latency (network) filesystem. Like DirEntry, the
+# result of stat() is cached.
+class _instrumentedEntry:
+      def __init__(self, entry, counts, latency=0):
+          self._entry = entry
+          self._counts = counts
+          self._latency = latency
+          self._stat = None
+
+      def stat(self, *args, **kw):
+          if self._stat is None:
+             self._counts['DirEntry.stat'] += 1
+             if self._latency > 0:
+                time.sleep(self._latency)
+             self._stat = self._entry.stat(*args, **kw)
+          return(self._stat)
+
+      def __getattr__(self, n):
+          return(getattr(self._entry, n))
+
+
+class _instrumentedScandir:
+      def __init__(self, it, counts, latency=0):
+          self._it = it
+          self._counts = counts
+          self._latency = latency
+          if latency > 0:
+             time.sleep(latency)
+
+      def __enter__(self):
+          return(self)
+
+      def __exit__(self, *exc):
+          self._it.close()
+
+      def __iter__(self):
+          for e in self._it:
+              yield _instrumentedEntry(e, self._counts, self._latency)
+
+
+
+@contextmanager
+def instrumentedScandir(latency=0):
+    counts = {'DirEntry.stat': 0}
+    orig = os.scandir
+    os.scandir = lambda p='.': _instrumentedScandir(orig(p), counts, latency)
+    try:
+       yield counts
+    finally:
+       os.scandir = orig
+
+
+
+
+def benchScandir(root, repeat):
+
+    with countCalls(os, ['stat', 'lstat', 'scandir']) as counts:
+         legacyListing(root)
+    legacyCounts = dict(counts)
+
+    with countCalls(os, ['stat', 'lstat', 'scandir']) as counts:
+         with instrumentedScandir() as scounts:
+              scandirListing(root)
+    newCounts = dict(counts)
+    newCounts.update(scounts)
+
+    tLegacy = timed(lambda: legacyListing(root), repeat)
+    tNew = timed(lambda: scandirListing(root), repeat)
+
+    print(f'{"":22} {"os.walk+fileInfo":>18} {"scandir":>18}')
+    print(f'{"listing calls":22} {legacyCounts["scandir"]:>18} {newCounts["scandir"]:>18}')
+    print(f'{"stat calls":22} {legacyCounts["stat"] + legacyCounts["lstat"]:>18} {newCounts["stat"] + newCounts["lstat"] + newCounts["DirEntry.stat"]:>18}')
+    print(f'{"wall time (best, s)":22} {tLegacy:>18.4f} {tNew:>18.4f}')
+
+
+
+
+
+###########################################################################
+#
+# Serial vs thread pool (--workers) traversal on a high latency filesystem
+#
+###########################################################################
+
+
+# Records every visitor call, to verify that parallel traversal visits items in
+# exactly the same order as the serial one.
+class RecordingVisitor(handlers.Visitor):
+
+      def __init__(self, criteria={}):
+          super().__init__()
+          self.criteria = criteria
+          self.file_count = 0
+          self.directory_count = 0
+          self.calls = []
+
+      def getCriterium(self, cname='', default=-1):
+          return(self.criteria.get(cname, default))
+
+      def visit_file(self, name, path, level, parent, finfo={}):
+          self.file_count += 1
+          self.calls.append(('F', path, level, finfo['size']))
+          return(0)
+
+      def visit_directory(self, name, path, level, parent, ldc, lfc):
+          self.directory_count += 1
+          self.calls.append(('D', path, level))
+          return(0)
+
+      def updateCounts(self, path, ldc, lfc, tdc, tfc):
+          self.calls.append(('C', path, ldc, lfc, tdc, tfc))
+
+
+
+def benchWorkers(root, repeat, latency=0.002, workers=(4, 16, 32)):
+    print(f'Simulated latency per listing/stat: {latency*1000:.1f}ms')
+
+    results = {}
+    for w in (0,) + tuple(workers):
+        v = RecordingVisitor({'workers': w})
+        with instrumentedScandir(latency):
+             ts = time.perf_counter()
+             res = functionality.traverse(root, v)
+             el = time.perf_counter() - ts
+        results[w] = (el, res, v.calls)
+
+    serial = results[0]
+    print(f'{"workers":>8} {"wall time (s)":>14} {"speedup":>8} {"same order":>11}')
+    for w, (el, res, calls) in results.items():
+        same = (res == serial[1] and calls == serial[2])
+        print(f'{w if w > 0 else "serial":>8} {el:>14.4f} {serial[0]/el:>8.1f} {str(same):>11}')
+
+
+
+
+
+###########################################################################
+#
+# Single process vs sharded (--processes) search and export
+#
+###########################################################################
+
+
+def benchProcesses(root, repeat, query=r'(?i:(file|dir)0*[13579]\.txt$)'):
+    nCpus = os.cpu_count() or 1
+    print(f'CPUs: {nCpus}')
+
+    counts = sorted(set([0, 2, 4, nCpus]))
+    out = tempfile.mkdtemp(prefix='dirWalkerBenchOut-')
+    try:
+       print(f'{"processes":>10} {"search (s)":>11} {"export (s)":>11} {"same result":>12}')
+       reference = None
+       for n in counts:
+           with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                tSearch = timed(lambda: functionality.search(query, {'directory':root, 'processes':n}), repeat)
+                sRes = functionality.search(query, {'directory':root, 'processes':n})
+                tExport = timed(lambda: functionality.export({'directory':root, 'processes':n, 'outputFile':os.path.join(out, 'index.html')}), repeat)
+                eRes = functionality.export({'directory':root, 'processes':n, 'outputFile':os.path.join(out, 'index.html')})
+
+           if reference is None:
+              reference = (sRes, eRes)
+           print(f'{n if n > 0 else "single":>10} {tSearch:>11.4f} {tExport:>11.4f} {str((sRes, eRes) == reference):>12}')
+    finally:
+       shutil.rmtree(out, ignore_errors=True)
+
+
+
+
+###########################################################################
+#
+# Visitor driven traversal: recursive vs generator (iterTree) engine, and
+# the walk() generator vs collecting results in a visitor
+#
+###########################################################################
+
+
+def peakMemory(fn, retained=False):
+    tracemalloc.start()
+    try:
+       result = fn()
+       current, peak = tracemalloc.get_traced_memory()
+       return(current if retained else peak)
+    finally:
+       tracemalloc.stop()
+
+
+
+def benchWalk(root, repeat, query=r'(?i:(file|dir)0*[13579]\.txt$)'):
+
+    tRecursive = timed(lambda: functionality.traverse(root, RecordingVisitor({})), repeat)
+    tGenerator = timed(lambda: functionality.traverse(root, RecordingVisitor({'iterative':True})), repeat)
+    print(f'{"visitor traversal":22} {"recursive":>12} {"iterTree":>12}')
+    print(f'{"wall time (best, s)":22} {tRecursive:>12.4f} {tGenerator:>12.4f}')
+    print()
+
+    def searchVisitor():
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+             functionality.search(query, {'directory':root})
+
+    def walkCount():
+        return(sum(1 for e in functionality.walk(root, {'fileinclusionPattern':query})))
+
+    print(f'{"matching files":22} {"search()":>12} {"walk()":>12}')
+    print(f'{"wall time (best, s)":22} {timed(searchVisitor, repeat):>12.4f} {timed(walkCount, repeat):>12.4f}')
+    print(f'{"peak memory (KiB)":22} {peakMemory(searchVisitor)/1024:>12.1f} {peakMemory(walkCount)/1024:>12.1f}')
+
+
+
+
+###########################################################################
+#
+# Per file cost of checking criteria: evaluated per file (as the visitors
+# did before handlers.CompiledCriteria) vs compiled once
+#
+###########################################################################
+
+
+# The checks of SearchVisitor.visit_file() before criteria were compiled.
+def legacyFileChecks(name, finfo, criteria):
+    if searchNameComplies(name, criteria.get('fileexclusionPattern', ''), criteria.get('fileinclusionPattern', ''), r'/\1/', False) == '':
+       return(False)
+
+    if criteria.get('fileSize', -1) >= 0:
+       if int(finfo['size']) != criteria.get('fileSize', -1):
+          return(False)
+
+    if criteria.get('minFileSize', -1) >= 0:
+       if int(finfo['size']) < criteria.get('minFileSize', -1):
+          return(False)
+
+    if criteria.get('maxFileSize', -1) >= 0:
+       if int(finfo['size']) > criteria.get('maxFileSize', -1):
+          return(False)
+
+    if criteria.get('creationDate', '') != '':
+       expr = f"finfo['creationdate'].date() {criteria.get('creationDateOp', '==')} normalizeDateTime(criteria.get('creationDate', ''))"
+       if not eval(expr):
+          return(False)
+
+    if criteria.get('lastModifiedDate', '') != '':
+       expr = f"finfo['lastmodified'].date() {criteria.get('lastModifiedDateOp', '==')} normalizeDateTime(criteria.get('lastModifiedDate', ''))"
+       if not eval(expr):
+          return(False)
+
+    return(True)
+
+
+
+def benchCriteria(root, repeat, number=20000):
+    cases = {'name': {'fileinclusionPattern':r'(?i:(file|dir)0*[13579]\.txt$)'},
+             'name+size': {'fileinclusionPattern':r'(\.txt$)', 'fileexclusionPattern':'0000', 'minFileSize':10, 'maxFileSize':50},
+             'name+size+dates': {'fileinclusionPattern':r'(\.txt$)', 'minFileSize':10, 'creationDate':'01/01/2000', 'creationDateOp':'>', 'lastModifiedDate':'01/01/2100', 'lastModifiedDateOp':'<'}}
+
+    dirs, files = functionality.scanDirectory(root)
+    items = [(f.name, entryInfo(f)) for f in files]
+    print(f'{len(items)} files, {number} checks per case')
+    print(f'{"criteria":18} {"per file (us)":>14} {"compiled (us)":>14} {"speedup":>8} {"same":>6}')
+    for case, criteria in cases.items():
+        compiled = handlers.CompiledCriteria(criteria)
+        same = all(legacyFileChecks(n, fi, criteria) == compiled.complies('file', n, fi) for n, fi in items)
+
+        def run(check):
+            def loop():
+                for i in range(number):
+                    check(*items[i % len(items)])
+            return(loop)
+
+        tLegacy = timed(run(lambda n, fi: legacyFileChecks(n, fi, criteria)), repeat) / number * 1e6
+        tCompiled = timed(run(lambda n, fi: compiled.fileFailure(n, fi) is None), repeat) / number * 1e6
+        print(f'{case:18} {tLegacy:>14.2f} {tCompiled:>14.2f} {tLegacy/tCompiled:>8.1f} {str(same):>6}')
+
+
+
+
+###########################################################################
+#
+# Stat calls with lazily (on first access) vs eagerly fetched metadata
+#
+###########################################################################
+
+
+@contextmanager
+def eagerMetadata():
+    orig = functionality.lazyEntryInfo
+    functionality.lazyEntryInfo = entryInfo
+    try:
+       yield
+    finally:
+       functionality.lazyEntryInfo = orig
+
+
+
+def benchLazyMeta(root, repeat, query=r'(?i:(file|dir)0*[13579]\.txt$)'):
+    out = tempfile.mkdtemp(prefix='dirWalkerBenchOut-')
+
+    cases = {'search (names)': lambda: functionality.search(query, {'directory':root}),
+             'walk (names)': lambda: sum(1 for e in functionality.walk(root, {'fileinclusionPattern':query})),
+             'walk (size)': lambda: sum(1 for e in functionality.walk(root, {'minFileSize':32})),
+             'export (no metadata)': lambda: functionality.export({'directory':root, 'template':'templates/htmlTemplate2.tmpl', 'outputFile':os.path.join(out, 'index.html')}),
+             'export (metadata)': lambda: functionality.export({'directory':root, 'template':'templates/htmlTemplate.tmpl', 'outputFile':os.path.join(out, 'index.html')})}
+
+    try:
+       print(f'{"":22} {"eager stats":>12} {"lazy stats":>12} {"eager (s)":>10} {"lazy (s)":>10}')
+       for case, fn in cases.items():
+           with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                with eagerMetadata():
+                     with instrumentedScandir() as eCounts:
+                          fn()
+                     tEager = timed(fn, repeat)
+                with instrumentedScandir() as lCounts:
+                     fn()
+                tLazy = timed(fn, repeat)
+           print(f'{case:22} {eCounts["DirEntry.stat"]:>12} {lCounts["DirEntry.stat"]:>12} {tEager:>10.4f} {tLazy:>10.4f}')
+    finally:
+       shutil.rmtree(out, ignore_errors=True)
+
+
+
+
+###########################################################################
+#
+# Live search vs search answered from the SQLite index (dirIndex.py)
+#
+###########################################################################
+
+
+def benchIndex(root, repeat, query=r'(?i:(file|dir)0*[13579]\.txt$)', latency=0.002):
+    out = tempfile.mkdtemp(prefix='dirWalkerBenchOut-')
+    db = os.path.join(out, 'index.db')
+    try:
+       with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            with countCalls(os, ['stat', 'scandir']) as buildCounts:
+                 tBuild = timed(lambda: functionality.refreshIndex({'directory':root, 'index':db}), 1)
+            with countCalls(os, ['stat', 'scandir']) as refreshCounts:
+                 tRefresh = timed(lambda: functionality.refreshIndex({'directory':root, 'index':db}), 1)
+            tLive = timed(lambda: functionality.search(query, {'directory':root}), repeat)
+            with instrumentedScandir(latency):
+                 tLatency = timed(lambda: functionality.search(query, {'directory':root}), 1)
+            with countCalls(os, ['stat', 'scandir']) as searchCounts:
+                 tIndexed = timed(lambda: functionality.search(query, {'directory':root, 'index':db}), repeat)
+            same = functionality.search(query, {'directory':root}) == functionality.search(query, {'directory':root, 'index':db})
+
+       print(f'{"":26} {"wall time (s)":>14} {"listings":>9} {"stats":>7}')
+       print(f'{"build index":26} {tBuild:>14.4f} {buildCounts["scandir"]:>9} {buildCounts["stat"]:>7}')
+       print(f'{"refresh (no changes)":26} {tRefresh:>14.4f} {refreshCounts["scandir"]:>9} {refreshCounts["stat"]:>7}')
+       print(f'{"search (live)":26} {tLive:>14.4f}')
+       print(f'{f"search (live, {latency*1000:g}ms lat.)":26} {tLatency:>14.4f}')
+       print(f'{"search (index)":26} {tIndexed:>14.4f} {searchCounts["scandir"]:>9} {searchCounts["stat"]:>7}')
+       print(f'Same result: {same}')
+    finally:
+       shutil.rmtree(out, ignore_errors=True)
+
+
+
+
+###########################################################################
+#
+# Export vs incremental export reusing cached fragments (exportCache.py)
+#
+###########################################################################
+
+
+def benchExportCache(root, repeat, changed=0.01):
+    out = tempfile.mkdtemp(prefix='dirWalkerBenchOut-')
+    criteria = {'directory':root, 'outputFile':os.path.join(out, 'index.html')}
+    cached = dict(criteria, exportCache=os.path.join(out, 'cache.db'))
+
+    directories = sorted(d for d, ds, fs in os.walk(root))
+    toChange = directories[::max(1, int(1/changed))]
+    def change():
+        for d in toChange:
+            with open(os.path.join(d, f'new{time.perf_counter_ns()}.txt'), 'w') as fh:
+                 fh.write('new')
+
+    try:
+       with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            tFull = timed(lambda: functionality.export(criteria), repeat)
+            tFirst = timed(lambda: functionality.export(cached), 1)
+            tUnchanged = timed(lambda: functionality.export(cached), repeat)
+            tChanged = timed(lambda: (change(), functionality.export(cached)), repeat)
+
+       print(f'{len(directories)} directories, {len(toChange)} changed per run')
+       print(f'{"export":34} {tFull:>10.4f}')
+       print(f'{"cached export (empty cache)":34} {tFirst:>10.4f}')
+       print(f'{"cached export (no changes)":34} {tUnchanged:>10.4f}')
+       print(f'{"cached export (" + str(len(toChange)) + " dirs changed)":34} {tChanged:>10.4f}')
+    finally:
+       shutil.rmtree(out, ignore_errors=True)
+
+
+
+
+###########################################################################
+#
+# Assembling the html of exports: the stack collapsed at every level change
+# (as ExportVisitor did before ExportFrame/ExportNode) vs one render pass
+#
+###########################################################################
+
+
+# ExportVisitor as it was before directories were completed in updateCounts():
+# items on one stack, collapsed whenever a directory at a higher level is visited,
+# and searched linearly in updateCounts(). Items are rendered by an ExportVisitor so
+# that both produce the same html; disk usage is not supported.
+class StackExportVisitor(handlers.Visitor):
+
+      def __init__(self, dirT, fileT, pageT, criteria):
+          super().__init__()
+          self.criteria = criteria
+          self.renderer = handlers.ExportVisitor(dirT, fileT, pageT, criteria)
+          self.renderer.stack.append(handlers.ExportFrame(0, '', ''))
+          self.stack = deque()
+
+      @property
+      def file_count(self):
+          return(self.renderer.file_count)
+
+      @property
+      def directory_count(self):
+          return(self.renderer.directory_count)
+
+      def getCriterium(self, cname='', default=-1):
+          return(self.criteria.get(cname, default))
+
+      def neededMetadata(self):
+          return(self.renderer.neededMetadata())
+
+      def visit_file(self, name, path, level, parent, finfo={}):
+          status = self.renderer.visit_file(name, path, level, parent, finfo)
+          if status == 0:
+             self.stack.append({'type':'file', 'collapsed':False, 'level':level, 'name':path, 'dname':name, 'html':self.renderer.stack[-1].files.pop()})
+          return(status)
+
+      def visit_directory(self, name, path, level, parent, ldc, lfc):
+          status = self.renderer.visit_directory(name, path, level, parent, ldc, lfc)
+          if status == 0:
+             nD = {'type':'directory', 'collapsed':False, 'level':level, 'name':path, 'dname':name, 'html':self.renderer.stack.pop().html}
+             self.collapse(newD=nD)
+             self.stack.append(nD)
+          return(status)
+
+      def collapse(self, newD={'type':'directory', 'level':0, 'name':''}, final=False):
+          stk = self.stack
+          sDir = ''
+          if len(stk) <= 0:
+             return
+
+          top = stk.pop()
+          if newD['level'] >= top['level']:
+             stk.append(top)
+             return
+
+          sDir = top['html']
+          while len(stk) > 0:
+                s = stk.pop()
+                if s['level'] == newD['level']:
+                   top['html'] = sDir
+                   s['html'] = s['html'].replace('${SUBDIRECTORY}', top['html'])
+                   s['collapsed'] = True
+                   stk.append(s)
+                   stk.append(top)
+                   return
+
+                if s['level'] == top['level']:
+                   if s['type']=='directory':
+                      sDir = s['html'] + self.criteria.get('templateItemsSeparator', ' ') + sDir
+                   else:
+                      sDir = sDir + self.criteria.get('templateItemsSeparator', ' ') + s['html']
+                elif top['level'] - s['level'] == 1:
+                     sDir = s['html'].replace('${SUBDIRECTORY}', sDir)
+                     top = {'type':'directory', 'collapsed':True, 'level':s['level'], 'name':s['name'], 'dname':s['dname'], 'html':sDir}
+                     sDir = top['html']
+          return(sDir)
+
+      def updateCounts(self, path, ldc, lfc, tdc, tfc):
+          stkbfr = []
+          while True:
+                itm = self.stack.pop()
+                if itm['name'] == path:
+                   itm['html'] = itm['html'].replace('${LNDIRS}', str(ldc)).replace('${LNFILES}', str(lfc)).replace('${NDIRS}', str(tdc)).replace('${NFILES}', str(tfc))
+                   self.stack.append(itm)
+                   break
+                stkbfr.append(itm)
+
+          for i in stkbfr[::-1]:
+              self.stack.append(i)
+
+
+
+# html of the tree of root exported by visitor class cls (see export())
+def exportedTree(cls, root, templates):
+    dTemp, fTemp, pTemp = templates
+    v = cls(dTemp, fTemp, pTemp, {'directory':root, 'iterative':True})
+    rootHtml = dTemp.replace('${DIRNAME}', root).replace('${PATH}', root)
+    random.seed(0)
+    if cls is StackExportVisitor:
+       v.stack.append({'type':'directory', 'collapsed':False, 'level':0, 'name':root, 'dname':root, 'html':rootHtml})
+       functionality.traverse(root, v)
+       v.collapse(final=True)
+       v.stack.pop()
+       return(v.stack.pop()['html'])
+
+    v.stack.append(handlers.ExportFrame(0, root, rootHtml))
+    functionality.traverse(root, v)
+    return(v.finish().render(' '))
+
+
+
+# A single chain of depth directories, each with filesPerDir files
+def chainTree(root, depth, filesPerDir):
+    import fileSystems
+
+    fs = fileSystems.MemoryFileSystem()
+    node = fs.makeDirectories(root)
+    for d in range(depth):
+        for f in range(filesPerDir):
+            node.children[f'file{f:04d}.txt'] = fs.newNode(False, f % 64)
+        node.children['d'] = fs.newNode(True)
+        node = node.children['d']
+    return(fs)
+
+
+
+def benchExportTree(root, repeat, entries=1000000):
+    import fileSystems
+
+    # Rendering items costs the same in both; a small template keeps it from dominating
+    templates = ('<details><summary>${DIRNAME} ${NDIRS}/${NFILES}</summary><ul>${SUBDIRECTORY}</ul></details>', '<li>${FILENAME}</li>', '${TREE}')
+    trees = [(f'{root}', None),
+             (f'wide ({entries} entries)', fileSystems.MemoryFileSystem.synthetic('tree', 2, 100, entries//10101 - 1)),
+             (f'deep ({entries} entries)', fileSystems.MemoryFileSystem.synthetic('tree', 5, 8, entries//37449 - 1)),
+             ('chain (200 levels)', chainTree('tree', 200, 100))]
+
+    print(f'{"":28} {"stack (s)":>10} {"tree (s)":>10} {"same html":>10}')
+    for name, fs in trees:
+        previous = fileSystems.use(fs)
+        path = root if fs is None else 'tree'
+        try:
+           with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                times = {}
+                html = {}
+                for cls in (StackExportVisitor, handlers.ExportVisitor):
+                    ts = time.perf_counter()
+                    html[cls] = exportedTree(cls, path, templates)
+                    times[cls] = time.perf_counter() - ts
+        finally:
+           fileSystems.use(previous)
+
+        print(f'{name:28} {times[StackExportVisitor]:>10.2f} {times[handlers.ExportVisitor]:>10.2f} {str(html[StackExportVisitor] == html[handlers.ExportVisitor]):>10}')
+
+
+
+
+###########################################################################
+#
+# Peak memory of exports: the tree rendered in memory vs streamed to the
+# output file (export())
+#
+###########################################################################
+
+
+def benchExportMemory(root, repeat, entries=20000):
+    import fileSystems
+
+    templates = functionality.readTemplateFile('templates/htmlTemplate.tmpl')
+    trees = [(f'{root}', None),
+             (f'wide ({entries//10} entries)', fileSystems.MemoryFileSystem.synthetic('tree', 1, 100, entries//1010 - 1)),
+             (f'wide ({entries} entries)', fileSystems.MemoryFileSystem.synthetic('tree', 2, 100, entries//10101 - 1)),
+             (f'deep ({entries} entries)', fileSystems.MemoryFileSystem.synthetic('tree', 5, 8, entries//37449 - 1))]
+
+    out = tempfile.mkdtemp(prefix='dirWalkerBenchOut-')
+    output = os.path.join(out, 'index.html')
+    print(f'{"":28} {"in memory (MB)":>15} {"streamed (MB)":>15} {"page (MB)":>10}')
+    try:
+       for name, fs in trees:
+           previous = fileSystems.use(fs)
+           path = root if fs is None else 'tree'
+           try:
+              with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                   kept = peakMemory(lambda: exportedTree(handlers.ExportVisitor, path, templates))
+                   streamed = peakMemory(lambda: functionality.export({'directory':path, 'iterative':True, 'outputFile':output}))
+           finally:
+              fileSystems.use(previous)
+
+           print(f'{name:28} {kept/2**20:>15.1f} {streamed/2**20:>15.1f} {os.path.getsize(output)/2**20:>10.1f}')
+    finally:
+       shutil.rmtree(out, ignore_errors=True)
+
+
+
+
+###########################################################################
+#
+# Lazy loading (-LZ): the page holds the top levels only; deeper ones are
+# written to shards (lazyExport.py)
+#
+###########################################################################
+
+
+def benchLazy(root, repeat, lazyLevels=2, depths=(2, 3, 4, 5), workers=4):
+    import fileSystems
+
+    out = tempfile.mkdtemp(prefix='dirWalkerBenchOut-')
+    output = os.path.join(out, 'index.html')
+    print(f'{"":24} {"inline (MB)":>12} {"time (s)":>9} {"lazy (MB)":>10} {"shards":>7} {"largest (KB)":>13} {"time (s)":>9}')
+    try:
+       for depth in depths:
+           fs = fileSystems.MemoryFileSystem.synthetic('tree', depth, 8, 10)
+           entries = sum(8**d for d in range(depth+1))*11 - 1
+           previous = fileSystems.use(fs)
+           try:
+              with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                   tInline = timed(lambda: functionality.export({'directory':'tree', 'iterative':True, 'outputFile':output}), repeat)
+                   inline = os.path.getsize(output)
+                   tLazy = timed(lambda: functionality.export({'directory':'tree', 'iterative':True, 'outputFile':output, 'lazyLevels':lazyLevels, 'workers':workers}), repeat)
+           finally:
+              fileSystems.use(previous)
+
+           shards = [os.path.getsize(e.path) for e in os.scandir(os.path.join(out, 'index-shards')) if e.name.endswith('.js')]
+           print(f'{f"depth {depth} ({entries} entries)":24} {inline/2**20:>12.2f} {tInline:>9.2f} {os.path.getsize(output)/2**20:>10.2f} {len(shards):>7} {max(shards, default=0)/2**10:>13.1f} {tLazy:>9.2f}')
+    finally:
+       shutil.rmtree(out, ignore_errors=True)
+
+
+
+
+###########################################################################
+#
+# Paged export (-PG): one page vs a page per directory down to pageLevels,
+# exported by 1..N processes, and exporting the pages of one subtree again
+#
+###########################################################################
+
+
+def benchPages(root, repeat, depth=4, pageLevels=2, processes=(0, 2, 4)):
+    import fileSystems
+
+    out = tempfile.mkdtemp(prefix='dirWalkerBenchOut-')
+    output = os.path.join(out, 'index.html')
+    fs = fileSystems.MemoryFileSystem.synthetic('tree', depth, 8, 10)
+    entries = sum(8**d for d in range(depth+1))*11 - 1
+    print(f'{f"{entries} entries":24} {"pages":>6} {"largest (MB)":>13} {"time (s)":>9}')
+    previous = fileSystems.use(fs)
+    try:
+       with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            t = timed(lambda: functionality.export({'directory':'tree', 'iterative':True, 'outputFile':output}), repeat)
+       print(f'{"single page":24} {1:>6} {os.path.getsize(output)/2**20:>13.2f} {t:>9.2f}')
+       os.remove(output)
+
+       for n in processes:
+           with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                t = timed(lambda: functionality.export({'directory':'tree', 'iterative':True, 'outputFile':output, 'pageLevels':pageLevels, 'processes':n}), repeat)
+           pages = [os.path.getsize(output)] + [os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(os.path.join(out, 'index-pages')) for f in files]
+           print(f'{f"pages, -MP {n}":24} {len(pages):>6} {max(pages)/2**20:>13.2f} {t:>9.2f}')
+
+       subtree = functionality.scanDirectory('tree')[0][0].name
+       with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            t = timed(lambda: functionality.export({'directory':'tree', 'iterative':True, 'outputFile':output, 'pageLevels':pageLevels, 'pageSubtree':subtree}), repeat)
+       print(f'{f"subtree {subtree} again":24} {"":>6} {"":>13} {t:>9.2f}')
+    finally:
+       fileSystems.use(previous)
+       shutil.rmtree(out, ignore_errors=True)
+
+
+
+
+###########################################################################
+#
+# Virtual tree (-EF virtual): compact JSON rows rendered in view only vs
+# the html template, in bytes and elements per exported entry
+#
+###########################################################################
+
+
+def benchVirtual(root, repeat, depths=(2, 3, 4)):
+    import fileSystems
+
+    out = tempfile.mkdtemp(prefix='dirWalkerBenchOut-')
+    output = os.path.join(out, 'index.html')
+    formats = [('htmlTemplate', {'template':'templates/htmlTemplate.tmpl'}),
+               ('virtual', {'exportFormat':'virtual'})]
+    print(f'{"":26} {"":14} {"bytes/entry":>12} {"elements/entry":>15} {"time (s)":>9}')
+    try:
+       for depth in depths:
+           fs = fileSystems.MemoryFileSystem.synthetic('tree', depth, 8, 10)
+           entries = sum(8**d for d in range(depth+1))*11 - 1
+           previous = fileSystems.use(fs)
+           try:
+              for name, extra in formats:
+                  with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                       t = timed(lambda: functionality.export(dict({'directory':'tree', 'iterative':True, 'outputFile':output}, **extra)), repeat)
+                  with open(output, encoding='utf8') as f:
+                       # Start tags; what the browser turns into elements when loading the page
+                       elements = len(re.findall(r'<[a-zA-Z]', f.read()))
+                  print(f'{f"depth {depth} ({entries} entries)":26} {name:14} {os.path.getsize(output)/entries:>12.1f} {elements/entries:>15.2f} {t:>9.2f}')
+           finally:
+              fileSystems.use(previous)
+    finally:
+       shutil.rmtree(out, ignore_errors=True)
+
+
+
+
+###########################################################################
+#
+# Record exports (-EF ndjson/csv, handlers.RecordExportVisitor) vs the
+# json template
+#
+###########################################################################
+
+
+def benchRecords(root, repeat, depths=(3, 4)):
+    import csv
+    import json
+    import fileSystems
+
+    out = tempfile.mkdtemp(prefix='dirWalkerBenchOut-')
+    output = os.path.join(out, 'export')
+    formats = [('jsonTemplate', {'template':'templates/jsonTemplate.tmpl', 'templateItemsSeparator':','}, lambda f: [json.load(f)]),
+               ('ndjson', {'exportFormat':'ndjson', 'columns':'path,type,size'}, lambda f: [json.loads(line) for line in f]),
+               ('csv', {'exportFormat':'csv', 'columns':'path,type,size'}, lambda f: list(csv.reader(f)))]
+    print(f'{"":34} {"":14} {"time (s)":>9} {"µs/entry":>9} {"MB":>7} {"valid":>6}')
+    try:
+       for depth, quoted in [(d, False) for d in depths] + [(depths[0], True)]:
+           fs = fileSystems.MemoryFileSystem.synthetic('tree', depth, 8, 10)
+           entries = sum(8**d for d in range(depth+1))*11 - 1
+           # Names that need escaping: one file per directory named "quoted"
+           if quoted:
+              stack = [fs.node('tree')]
+              while len(stack) > 0:
+                    n = stack.pop()
+                    n.children['"quoted", \\name'] = n.children.pop('file0000.txt')
+                    stack.extend(c for c in n.children.values() if c.children is not None)
+           previous = fileSystems.use(fs)
+           try:
+              for name, extra, parse in formats:
+                  with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                       t = timed(lambda: functionality.export(dict({'directory':'tree', 'iterative':True, 'outputFile':output}, **extra)), repeat)
+                  try:
+                     with open(output, encoding='utf8', newline='') as f:
+                          parse(f)
+                     valid = True
+                  except ValueError:
+                     valid = False
+                  print(f'{f"depth {depth} ({entries} entries)" + (", quoted" if quoted else ""):34} {name:14} {t:>9.2f} {t/entries*1e6:>9.1f} {os.path.getsize(output)/2**20:>7.1f} {str(valid):>6}')
+           finally:
+              fileSystems.use(previous)
+    finally:
+       shutil.rmtree(out, ignore_errors=True)
+
+
+
+
+###########################################################################
+#
+# Compressed output (-CMP, compression.py): size of the export and of its
+# temporary file, and time
+#
+###########################################################################
+
+
+# compression.spool() recording the size of the temporary files once written
+@contextmanager
+def measuredSpools(sizes):
+    import compression
+
+    class MeasuredSpool:
+          def __init__(self, f):
+              self.f = f
+              self.write = f.write
+
+          def seek(self, offset):
+              r = self.f.seek(offset)
+              sizes.append(os.fstat(getattr(self.f, 'file', self.f).fileno()).st_size)
+              return(r)
+
+          def read(self, size=-1):
+              return(self.f.read(size))
+
+          def close(self):
+              self.f.close()
+
+          def __enter__(self):
+              return(self)
+
+          def __exit__(self, *exc):
+              self.close()
+
+    original = compression.spool
+    compression.spool = lambda criteria, **text: MeasuredSpool(original(criteria, **text))
+    try:
+       yield
+    finally:
+       compression.spool = original
+
+
+def benchCompress(root, repeat, depth=4):
+    import compression
+    import fileSystems
+
+    out = tempfile.mkdtemp(prefix='dirWalkerBenchOut-')
+    fs = fileSystems.MemoryFileSystem.synthetic('tree', depth, 8, 10)
+    entries = sum(8**d for d in range(depth+1))*11 - 1
+    print(f'{f"{entries} entries":20} {"output (MB)":>12} {"temporary (MB)":>15} {"time (s)":>9}')
+    previous = fileSystems.use(fs)
+    try:
+       for codec in ['', 'gzip', 'bz2', 'xz']:
+           sizes = []
+           output = os.path.join(out, 'index.html')
+           with open(os.devnull, 'w') as devnull, redirect_stdout(devnull), measuredSpools(sizes):
+                t = timed(lambda: functionality.export({'directory':'tree', 'iterative':True, 'outputFile':output, 'compress':codec}), repeat)
+           print(f'{codec or "none":20} {os.path.getsize(compression.outputPath(output, {"compress":codec}))/2**20:>12.1f} {max(sizes)/2**20:>15.1f} {t:>9.2f}')
+    finally:
+       fileSystems.use(previous)
+       shutil.rmtree(out, ignore_errors=True)
+
+
+
+
+###########################################################################
+#
+# Rendering items: pseudovariables replaced with eval() one by one vs
+# compiled templates (templateEngine.py)
+#
+###########################################################################
+
+
+# The pseudovariables as they were before templates were compiled
+LEGACYDIRECTORYPSEUDOVARIABLES = {'${ID}': 'dId', '${DIRNAME}': 'name', '${PATH}':'path', '${RLVLCOLOR}':'random.choice(fontColorPalette)',
+                                  '${LEVEL}': 'str(level)', '${OPENSTATE}': '""', '${PARENTPATH}':'parent', '${LEVELTABS}':'level*"\t"', '${LEVELNSBP}':'level*"&nbsp;"'}
+
+LEGACYFILEPSEUDOVARIABLES = {'${ID}': 'dId', '${FILELINK}':'makeHtmlLink(path, name, False)', '${FILENAME}': 'name', '${PATH}':'path',
+                             '${RLVLCOLOR}':'random.choice(fontColorPalette)', '${LEVEL}': 'str(level)', '${FILESIZE}': 'str(finfo["size"])',
+                             '${FILELASTMODIFIED}':"formatDateTime(finfo['lastmodified'])", '${FILECREATED}': "formatDateTime(finfo['creationdate'])",
+                             '${PARENTPATH}':'parent', '${LEVELTABS}':'level*"\t"', '${LEVELNSBP}':'level*"&nbsp;"'}
+
+
+def legacyDirectoryHtml(template, name, path, level, parent, dId):
+    html = template
+    for k, v in LEGACYDIRECTORYPSEUDOVARIABLES.items():
+        html = html.replace(k, eval(v, vars(handlers), locals()))
+    return(html)
+
+
+def legacyFileHtml(template, name, path, level, parent, finfo):
+    dId = "f" + str(level) + "-" + str( random.randint(0, 1000000) )
+    html = template
+    for k, v in LEGACYFILEPSEUDOVARIABLES.items():
+        if k in html:
+           html = html.replace(k, eval(v, vars(handlers), locals()))
+
+    filename, fileExtension = os.path.splitext(path)
+    if fileExtension == '':
+       fileExtension = '.ukn'
+    return(html.replace('${FILEEXTENSION}', fileExtension[1:]))
+
+
+
+def benchRender(root, repeat, items=20000):
+    import re
+    import templateEngine
+
+    finfo = {'size':176820, 'lastmodified':datetime.datetime(2023, 5, 17, 10, 30), 'creationdate':datetime.datetime(2023, 5, 1, 8, 0)}
+    names = [f'file{i:05d}.txt' for i in range(items)]
+    # Ids and colors are random
+    normalized = lambda html: re.sub(r'[df][0-9]+-[0-9]+|#[0-9a-f]{6}', '', html)
+
+    print(f'{"":36} {"eval (us/item)":>15} {"compiled (us/item)":>19} {"same":>6}')
+    for template in ('templates/htmlTemplate.tmpl', 'templates/htmlTemplate2.tmpl', 'templates/jsonTemplate.tmpl'):
+        dTemp, fTemp, pTemp = functionality.readTemplateFile(template)
+        compiledDir = templateEngine.Template(dTemp, handlers.DIRECTORYPSEUDOVARIABLES)
+        compiledFile = templateEngine.Template(fTemp, handlers.FILEPSEUDOVARIABLES)
+
+        cases = [('directory', lambda: [legacyDirectoryHtml(dTemp, n, 'a/b/' + n, 3, 'a/b', 'd3-1') for n in names],
+                               lambda: [compiledDir.render(n, 'a/b/' + n, 3, 'a/b', 'd3-1') for n in names]),
+                 ('file', lambda: [legacyFileHtml(fTemp, n, 'a/b/' + n, 3, 'a/b', finfo) for n in names],
+                          lambda: [compiledFile.render(n, 'a/b/' + n, 3, 'a/b', finfo) for n in names])]
+        for kind, legacy, compiled in cases:
+            tLegacy = timed(legacy, repeat)
+            tCompiled = timed(compiled, repeat)
+            same = [normalized(h) for h in legacy()] == [normalized(h) for h in compiled()]
+            print(f'{os.path.basename(template) + " (" + kind + ")":36} {tLegacy/items*1e6:>15.2f} {tCompiled/items*1e6:>19.2f} {str(same):>6}')
+
+
+
+
+###########################################################################
+#
+# Watching a directory: bursts of changes (watcher.py)
+#
+###########################################################################
+
+
+def benchWatch(root, repeat, burst=5000, delay=0.2):
+    import threading
+    import watcher
+
+    out = tempfile.mkdtemp(prefix='dirWalkerBenchOut-')
+    db = os.path.join(out, 'index.db')
+    directories = sorted(d for d, ds, fs in os.walk(root))
+    updates = []
+    stop = threading.Event()
+    ready = threading.Event()
+
+    # Creates, modifies and deletes burst files spread over all directories
+    def changes(run):
+        paths = [os.path.join(directories[i % len(directories)], f'burst{run}-{i}.txt') for i in range(burst//3)]
+        for p in paths:
+            with open(p, 'w') as fh:
+                 fh.write('new')
+        for p in paths:
+            with open(p, 'a') as fh:
+                 fh.write('more')
+        for p in paths[::2]:
+            os.remove(p)
+
+    try:
+       with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            for poll in (False, True):
+                updates.clear()
+                stop.clear()
+                ready.clear()
+                w = threading.Thread(target=watcher.watch, args=(root, db),
+                                     kwargs={'delay':delay, 'poll':poll, 'stop':stop, 'ready':ready,
+                                             'onChange':lambda c, st: updates.append((time.perf_counter(), st))})
+                w.start()
+                ready.wait()
+                for r in range(repeat):
+                    t0 = time.perf_counter()
+                    changes(f'{poll:d}{r}')
+                    tBurst = time.perf_counter() - t0
+                    n = len(updates)
+                    while len(updates) == n or time.perf_counter() - updates[-1][0] < 3*delay:
+                          time.sleep(delay/4)
+                    done = [u for u in updates[n:]]
+                    events = sum(st.get('events', 0) for t, st in done)
+                    listed = sum(st['listed'] for t, st in done)
+                    rate = '' if poll else f' ({events/tBurst:,.0f} events/s)'
+                    print(f'{"polling" if poll else "inotify":8} burst {r}: {burst//3*2 + burst//6} changes in {tBurst:.3f}s{rate}, '
+                          f'{len(done)} index updates, {listed} listings, index current {done[-1][0] - t0 - tBurst:.3f}s after burst', file=sys.__stdout__)
+                stop.set()
+                w.join()
+
+            index = dirIndex.DirectoryIndex(db)
+            idxFiles = index.db.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+            index.close()
+       print(f'{len(directories)} directories; files indexed:{idxFiles} on disk:{sum(len(fs) for d, ds, fs in os.walk(root))}')
+    finally:
+       shutil.rmtree(out, ignore_errors=True)
+
+
+
+
+###########################################################################
+#
+# Tracking traversed directories (-UD): InodeSet vs python set of tuples
+#
+###########################################################################
+
+
+def benchVisited(root, repeat, number=1000000, query=r'(?i:(file|dir)0*[13579]\.txt$)'):
+    from utilities import InodeSet
+
+    def fill(s, add):
+        for i in range(number):
+            add(s, 2049 + i % 3, 1000003 * i % (1 << 40))
+        return(s)
+
+    tSet = timed(lambda: fill(set(), lambda s, d, i: s.add((d, i))), 1)
+    mSet = peakMemory(lambda: fill(set(), lambda s, d, i: s.add((d, i))), True)
+    tInodes = timed(lambda: fill(InodeSet(), lambda s, d, i: s.add(d, i)), 1)
+    mInodes = peakMemory(lambda: fill(InodeSet(), lambda s, d, i: s.add(d, i)), True)
+
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+         tPlain = timed(lambda: functionality.search(query, {'directory':root}), repeat)
+         tUnique = timed(lambda: functionality.search(query, {'directory':root, 'uniqueDirectories':True, 'oneFileSystem':True}), repeat)
+
+    print(f'{number:,} (device, inode) pairs {"time (s)":>10} {"MB":>9} {"bytes/pair":>11}')
+    print(f'{"set of tuples":30} {tSet:>10.3f} {mSet/2**20:>9.1f} {mSet/number:>11.1f}')
+    print(f'{"InodeSet":30} {tInodes:>10.3f} {mInodes/2**20:>9.1f} {mInodes/number:>11.1f}')
+    print(f'{"search":30} {tPlain:>10.4f}')
+    print(f'{"search -UD -XDEV":30} {tUnique:>10.4f}')
+
+
+
+
+###########################################################################
+#
+# Size of every directory: aggregated in a single traversal (-DU) vs summing
+# each directory's files separately, and the cost of ${DIRSIZE} in exports
+#
+###########################################################################
+
+
+def perDirectorySizes(root):
+    sizes = {}
+    for dirPath, dirNames, fileNames in os.walk(root):
+        total = 0
+        for p, d, f in os.walk(dirPath):
+            total += sum(os.stat(os.path.join(p, n)).st_size for n in f)
+        sizes[dirPath] = total
+    return(sizes)
+
+
+
+def benchUsage(root, repeat):
+    out = tempfile.mkdtemp(prefix='dirWalkerBenchOut-')
+    try:
+       template = os.path.join(out, 'usage.tmpl')
+       with open('templates/htmlTemplate.tmpl', 'r', encoding='utf8') as tf:
+            with open(template, 'w', encoding='utf8') as uf:
+                 uf.write(tf.read().replace('${NFILES} )', '${NFILES} ${DIRSIZE} )'))
+
+       with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            tSingle = timed(lambda: functionality.usage({'directory':root}), repeat)
+            size = functionality.usage({'directory':root})[3]
+            tExport = timed(lambda: functionality.export({'directory':root, 'outputFile':os.path.join(out, 'index.html')}), repeat)
+            tExportSize = timed(lambda: functionality.export({'directory':root, 'template':template, 'outputFile':os.path.join(out, 'index.html')}), repeat)
+
+       tPerDir = timed(lambda: perDirectorySizes(root), repeat)
+       print(f'{"sizes of all directories":30} {"time (s)":>10}')
+       print(f'{"single traversal (-DU)":30} {tSingle:>10.4f}')
+       print(f'{"walk per directory":30} {tPerDir:>10.4f}')
+       print(f'{"same total":30} {str(perDirectorySizes(root)[root] == size):>10}')
+       print()
+       print(f'{"export":30} {tExport:>10.4f}')
+       print(f'{"export with ${DIRSIZE}":30} {tExportSize:>10.4f}')
+    finally:
+       shutil.rmtree(out, ignore_errors=True)
+
+
+
+
+###########################################################################
+#
+# Engines on a simulated slow and unreliable share: a copy of the directory
+# held in memory (see fileSystems.py), every listing/stat taking latency seconds
+#
+###########################################################################
+
+
+def benchFileSystems(root, repeat, latency=0.002, errorRate=0.01, query=r'(?i:(file|dir)0*[13579]\.txt$)'):
+    import fileSystems
+
+    memory = fileSystems.MemoryFileSystem.copyOf(root)
+    print(f'Simulated latency per listing/stat: {latency*1000:.1f}ms, failing: {errorRate:.1%}')
+    print(f'{"":14} {"wall time (s)":>14} {"listings":>9} {"stats":>7} {"failed":>7} {"same result":>12}')
+    reference = None
+    for name, c in (('serial', {}), ('-W 4', {'workers':4}), ('-W 16', {'workers':16}), ('-MP 4', {'processes':4})):
+        fs = fileSystems.LatencyFileSystem(memory, latency, errorRate)
+        previous = fileSystems.use(fs)
+        try:
+           with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                ts = time.perf_counter()
+                res = functionality.search(query, {'directory':root, **c})
+                el = time.perf_counter() - ts
+        finally:
+           fileSystems.use(previous)
+
+        if reference is None:
+           reference = res
+        print(f'{name:14} {el:>14.4f} {fs.calls["list"]:>9} {fs.calls["stat"]:>7} {fs.errors:>7} {str(res == reference):>12}')
+
+
+
+
+###########################################################################
+#
+# Searching archives of the directory: reading their indexes (first run and
+# cached, see archives.py) vs extracting them and searching the extracted files
+#
+###########################################################################
+
+
+def benchArchives(root, repeat, query=r'(?i:(file|dir)0*[13579]\.txt$)'):
+    import zipfile
+    import fileSystems
+    import archives
+
+    work = tempfile.mkdtemp(prefix='dwArchives_')
+    try:
+       arDir = os.path.join(work, 'archives')
+       os.mkdir(arDir)
+       for fmt in ('zip', 'gztar'):
+           shutil.make_archive(os.path.join(arDir, 'tree'), fmt, root)
+       print(f'Archives: {", ".join(f"{n} ({os.path.getsize(os.path.join(arDir, n))} bytes)" for n in sorted(os.listdir(arDir)))}')
+
+       def searchArchives(fs):
+           previous = fileSystems.use(fs)
+           try:
+              with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                   return(functionality.search(query, {'directory':arDir}))
+           finally:
+              fileSystems.use(previous)
+
+       def extractAndSearch():
+           out = os.path.join(work, 'extracted')
+           for n in os.listdir(arDir):
+               shutil.unpack_archive(os.path.join(arDir, n), os.path.join(out, n))
+           with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                res = functionality.search(query, {'directory':out})
+           shutil.rmtree(out)
+           return(res)
+
+       cachePath = os.path.join(work, 'archives.db')
+       print(f'{"":24} {"time (s)":>10} {"read":>6} {"reused":>7}')
+       fs = archives.ArchiveFileSystem(cachePath=cachePath)
+       ts = time.perf_counter()
+       res = searchArchives(fs)
+       el = time.perf_counter() - ts
+       fs.close()
+       print(f'{"-AR first run":24} {el:>10.4f} {fs.read:>6} {fs.reused:>7}')
+
+       el = timed(lambda: searchArchives(archives.ArchiveFileSystem(cachePath=cachePath)), repeat)
+       print(f'{"-AR -ARC later runs":24} {el:>10.4f}')
+
+       # Indexes cached in memory, e.g. while watching or searching interactively
+       fs = archives.ArchiveFileSystem()
+       el = timed(lambda: searchArchives(fs), repeat + 1)
+       print(f'{"-AR same process":24} {el:>10.4f} {fs.read:>6} {fs.reused:>7}')
+
+       print(f'{"extract + search":24} {timed(extractAndSearch, repeat):>10.4f}')
+       print(f'Same matches as extracted: {res[1:3] == extractAndSearch()[1:3]}')
+    finally:
+       shutil.rmtree(work, ignore_errors=True)
+
+
+
+
+###########################################################################
+#
+# Operations walking the directory vs reading its snapshot (see snapshot.py)
+#
+###########################################################################
+
+
+def benchSnapshot(root, repeat, query=r'(?i:(file|dir)0*[13579]\.txt$)'):
+    import fileSystems
+    import snapshot
+
+    work = tempfile.mkdtemp(prefix='dwSnapshot_')
+    try:
+       snapshotPath = os.path.join(work, 'tree.snap')
+       ts = time.perf_counter()
+       n = snapshot.write(root, snapshotPath)
+       el = time.perf_counter() - ts
+       size = os.path.getsize(snapshotPath)
+       print(f'Snapshot: {n} entries, {size} bytes ({size/n:.1f} bytes/entry), written in {el:.4f}s')
+
+       operations = (('search', lambda: functionality.search(query, {'directory':root})),
+                     ('export', lambda: functionality.export({'directory':root, 'outputFile':os.path.join(work, 'out.html')})),
+                     ('usage', lambda: functionality.traverse(root, handlers.UsageVisitor({'directory':root}))))
+
+       def run(fn):
+           with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                fn()
+
+       # The same directory on a share where every listing/stat takes latency seconds
+       latency = 0.001
+       share = fileSystems.LatencyFileSystem(fileSystems.MemoryFileSystem.copyOf(root), latency)
+
+       def runOn(fs, fn):
+           previous = fileSystems.use(fs)
+           try:
+              return(timed(lambda: run(fn), repeat))
+           finally:
+              fileSystems.use(previous)
+
+       print(f'{"":10} {"walking (s)":>12} {f"walking share ({latency*1000:.0f}ms)":>24} {"snapshot (s)":>13}')
+       for name, fn in operations:
+           fs = snapshot.SnapshotFileSystem([snapshotPath])
+           print(f'{name:10} {runOn(None, fn):>12.4f} {runOn(share, fn):>24.4f} {runOn(fs, fn):>13.4f}')
+           fs.close()
+
+       # Opening does not depend on the size of the snapshot
+       bigPath = os.path.join(work, 'big.snap')
+       n = snapshot.write('big', bigPath, fileSystems.MemoryFileSystem.synthetic('big', 4, 8, 50))
+       for name, p in (('tree', snapshotPath), (f'{n} entries', bigPath)):
+           el = timed(lambda: snapshot.SnapshotFileSystem([p]).close(), repeat)
+           print(f'Opening snapshot of {name}: {el*1000:.3f}ms')
+    finally:
+       shutil.rmtree(work, ignore_errors=True)
+
+
+
+
+BENCHMARKS = {'scandir': benchScandir,
+              'workers': benchWorkers,
+              'processes': benchProcesses,
+              'walk': benchWalk,
+              'criteria': benchCriteria,
+              'lazymeta': benchLazyMeta,
+              'index': benchIndex,
+              'exportcache': benchExportCache,
+              'exporttree': benchExportTree,
+              'exportmemory': benchExportMemory,
+              'lazy': benchLazy,
+              'pages': benchPages,
+              'virtual': benchVirtual,
+              'records': benchRecords,
+              'compress': benchCompress,
+              'render': benchRender,
+              'watch': benchWatch,
+              'visited': benchVisited,
+              'usage': benchUsage,
+              'filesystems': benchFileSystems,
+              'archives': benchArchives,
+              'snapshot': benchSnapshot}
+
+
+def main():
+    p = argparse.ArgumentParser(description='dirWalker benchmarks')
+    p.add_argument('benchmark', choices=sorted(BENCHMARKS.keys()))
+    p.add_argument('-d', '--directory', default='')
+    p.add_argument('-r', '--repeat', type=int, default=3)
+    args = p.parse_args()
+
+    with syntheticTree(args.directory) as root:
+         BENCHMARKS[args.benchmark](root, args.repeat)
+
+
+
+if __name__ == "__main__":
+   main()
@@ -0,0 +1,115 @@
+
+#
+#
+#
+# Checkpoints of long traversals, so that traversals stopped due to maxTime can be
+# resumed later (see functionality.fsTraversalResumable()).
+#
+# A checkpoint holds the traversal frontier, i.e. the stack of directories being
+# traversed, each with the names of its subdirectories not yet visited and its counts
+# so far, together with the state of the visitor (see handlers.Visitor.checkpointState())
+# and, with criterium uniqueDirectories, the directories traversed so far.
+# It is written with pickle, periodically and when the traversal is stopped; writing
+# replaces the previous checkpoint atomically.
+#
+# Listings of directories are not stored. When resuming, only the directories on the
+# stack are listed again, to get the entries of the subdirectories still to be visited.
+# Subdirectories removed meanwhile are skipped; those added meanwhile are not visited.
+#
+#
+#
+
+
+import os
+import pickle
+
+import clrprint
+
+import exportCache
+import handlers
+import functionality
+
+
+
+VERSION = 1
+
+# Criteria (besides those affecting exports) that affect the result of a traversal.
+# Checkpoints made with different values are not resumed.
+CHECKPOINTCRITERIA = ['noFiles', 'noDirs', 'nonRecursive', 'urlencode', 'uniqueDirectories', 'oneFileSystem']
+
+
+
+def configurationKey(root, lvl, visitor):
+    criteria = getattr(visitor, 'criteria', None) or {}
+    templates = [type(visitor).__name__, os.path.abspath(root), lvl,
+                 getattr(visitor, 'dirTemplate', None), getattr(visitor, 'fileTemplate', None),
+                 [criteria.get(k, None) for k in CHECKPOINTCRITERIA]]
+    return(exportCache.configurationKey(templates, criteria))
+
+
+
+# Writes the checkpoint of a traversal (see functionality.iterTree() for frames) about to
+# visit directory entry pending of the top frame. guard: the functionality.DirectoryGuard
+# of the traversal, if any.
+def save(path, key, frames, pending, visitor, guard=None):
+    saved = []
+    for i, f in enumerate(frames):
+        names = [e.name for e in f[2][f[3]:]]
+        if i == len(frames) - 1 and pending is not None:
+           names.insert(0, pending.name)
+
+        token = None
+        if f[8] is not None:
+           token = (f[8].name, f[8].path, f[8].level, f[8].parent)
+        saved.append((f[0], f[1], names, f[4], f[5], f[6], f[7], token))
+
+    tmpPath = path + '.tmp'
+    with open(tmpPath, 'wb') as cf:
+         pickle.dump({'version':VERSION, 'key':key, 'frames':saved, 'state':visitor.checkpointState(), 'guard':guard}, cf, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmpPath, path)
+
+
+
+# Returns the checkpoint at path or None if there is none.
+def load(path):
+    try:
+       with open(path, 'rb') as cf:
+            saved = pickle.load(cf)
+    except FileNotFoundError:
+       return(None)
+
+    if saved.get('version', 0) != VERSION:
+       clrprint.clrprint(f'[WARNING] Checkpoint [{path}] made by another version. Ignored.', clr='yellow')
+       return(None)
+    return(saved)
+
+
+
+def remove(path):
+    try:
+       os.remove(path)
+    except FileNotFoundError:
+       pass
+
+
+
+# Rebuilds the stack frames of a checkpoint.
+def restoreFrames(saved, lister=None):
+    if lister is None:
+       lister = functionality.scanDirectory
+
+    frames = []
+    for path, level, names, ldc, lfc, tdc, tfc, token in saved:
+        dirs = []
+        if len(names) > 0:
+           try:
+              byName = {d.name: d for d in lister(path)[0]}
+              dirs = [byName[n] for n in names if n in byName]
+           except OSError as lsEx:
+              print('Exception during resume:', str(lsEx))
+
+        if token is not None:
+           token = handlers.Directory(token[0], token[1], token[2], token[3], -1, -1)
+        frames.append([path, level, dirs, 0, ldc, lfc, tdc, tfc, token])
+
+    return(frames)
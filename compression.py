@@ -0,0 +1,141 @@
+#
+#
+#
+# Compressed output (-CMP, -CL).
+#
+# Exports and search results are compressed as they are written, chunk by chunk, with the
+# codecs of the standard library: gzip, bz2 or xz. The codec is chosen with criterium
+# compress or by the suffix of the output file (.gz, .bz2, .xz); with compress, the suffix
+# is appended to the output file if missing.
+#
+# Temporary files of exports (see functionality.export()) are compressed too, with the
+# fastest gzip level, so large exports need a fraction of the temporary disk space.
+#
+#
+#
+
+
+import io
+import bz2
+import gzip
+import lzma
+import tempfile
+
+import clrprint
+
+
+
+
+# name: (suffix, default level, lowest level). The highest level is 9 for all.
+CODECS = {'gzip': ('.gz', 6, 0),
+          'bz2': ('.bz2', 9, 1),
+          'xz': ('.xz', 6, 0)}
+
+
+# Opens file object or path f with the codec, in text or binary mode.
+# Levels the codec does not support are replaced by the nearest supported one.
+def codecOpen(codec, f, mode, level=-1, **text):
+    suffix, default, lowest = CODECS[codec]
+    if level is None or level < 0:
+       level = default
+    elif not lowest <= level <= 9:
+       clrprint.clrprint(f'[ERROR] Compression level {level} not supported by {codec} ({lowest}-9). Using level {min(max(level, lowest), 9)}.', clr='red')
+       level = min(max(level, lowest), 9)
+
+    if codec == 'xz':
+       return(lzma.open(f, mode, preset=level, **text))
+    if codec == 'bz2':
+       return(bz2.open(f, mode, compresslevel=level, **text))
+    return(gzip.open(f, mode, compresslevel=level, **text))
+
+
+# Codec of the output file path, None if not compressed
+def codecOf(path, criteria):
+    if criteria.get('compress', '') not in (None, ''):
+       return(criteria['compress'])
+
+    for codec, (suffix, level, lowest) in CODECS.items():
+        if path.lower().endswith(suffix):
+           return(codec)
+    return(None)
+
+
+# The path the output file is written to: with the suffix of criterium compress
+def outputPath(path, criteria):
+    codec = codecOf(path, criteria)
+    if path == '-' or codec is None or path.lower().endswith(CODECS[codec][0]):
+       return(path)
+    return(path + CODECS[codec][0])
+
+
+# path without the suffix of its codec
+def plainPath(path, criteria={}):
+    codec = codecOf(path, criteria)
+    if codec is not None and path.lower().endswith(CODECS[codec][0]):
+       return(path[:-len(CODECS[codec][0])])
+    return(path)
+
+
+# Opens output file path (see outputPath()) for writing text; compressed if a codec applies.
+# text: arguments of open() (encoding, errors, newline)
+def openOutput(path, criteria, buffering=-1, **text):
+    codec = codecOf(path, criteria)
+    if codec is None:
+       return(open(path, 'w', buffering=buffering, **text))
+    return(codecOpen(codec, outputPath(path, criteria), 'wt', criteria.get('compressLevel', -1), **text))
+
+
+
+
+# Temporary text file compressed while written; read back (after seek(0)) decompressed.
+# Supports what exports do with their temporary files: write(), then seek(0) and read(),
+# any number of times.
+class TemporarySpool:
+
+      def __init__(self, **text):
+          self.text = text
+          self.file = tempfile.TemporaryFile()
+          self.writer = codecOpen('gzip', self.file, 'wt', 1, **text)
+          self.reader = None
+          self.write = self.writer.write
+
+
+      def seek(self, offset):
+          if offset != 0:
+             raise io.UnsupportedOperation('Compressed temporary files can only be read from the start')
+
+          if self.writer is not None:
+             # Does not close self.file
+             self.writer.close()
+             self.writer = None
+             self.write = None
+          if self.reader is not None:
+             self.reader.close()
+
+          self.file.seek(0)
+          self.reader = codecOpen('gzip', self.file, 'rt', **self.text)
+          return(0)
+
+
+      def read(self, size=-1):
+          return(self.reader.read(size))
+
+
+      def close(self):
+          for f in (self.writer, self.reader, self.file):
+              if f is not None:
+                 f.close()
+
+
+      def __enter__(self):
+          return(self)
+
+      def __exit__(self, *exc):
+          self.close()
+
+
+# Temporary text file of an export; compressed if the output is
+def spool(criteria, **text):
+    if codecOf(criteria.get('outputFile', ''), criteria) is None:
+       return(tempfile.TemporaryFile('w+', **text))
+    return(TemporarySpool(**text))
@@ -0,0 +1,203 @@
+
+#
+#
+#
+# Persistent index of directory structures, stored in a SQLite database.
+#
+# The index keeps the paths, sizes and times of all files as well as the
+# modification time of every directory. Refreshing the index lists again only
+# those directories whose modification time changed (i.e. entries were added,
+# removed or renamed); unchanged directories cost a single stat call.
+#
+# Searches and exports can then be answered from the index without touching
+# the (possibly slow, network mapped) filesystem: DirectoryIndex provides
+# the same take()/discard() interface as functionality.DirectoryPrefetcher,
+# so visitors traverse the index exactly as they would the directory.
+#
+# NOTE: Changing the contents of a file does not change the modification time
+#       of its directory. Sizes and times of such files are updated only when
+#       something else changes in their directory, when the directory is listed
+#       again with refreshDirectories() (as watcher.py does), or when the index is
+#       rebuilt (i.e. the database file is deleted and the directory indexed again).
+#
+#
+#
+
+
+import os
+import sqlite3
+
+from utilities import normalizedPathJoin, creationTimestamp
+import functionality
+import fileSystems
+
+
+
+
+SCHEMA = ['CREATE TABLE IF NOT EXISTS directories (path TEXT PRIMARY KEY, parent TEXT, name TEXT, mtime REAL)',
+          'CREATE INDEX IF NOT EXISTS directoriesParent ON directories (parent, name)',
+          'CREATE TABLE IF NOT EXISTS files (parent TEXT, name TEXT, size INTEGER, mtime REAL, created REAL, PRIMARY KEY (parent, name)) WITHOUT ROWID']
+
+
+
+
+# A file or directory read from the index. Looks like an os.DirEntry whose stat()
+# returns the indexed size and times (see utilities.statToMeta()).
+class IndexEntry:
+
+      __slots__ = ('name', 'st_size', 'st_mtime', 'st_birthtime')
+
+      def __init__(self, name, size, mtime, created):
+          self.name = name
+          self.st_size = size
+          self.st_mtime = mtime
+          self.st_birthtime = created
+
+      def stat(self):
+          if self.st_mtime is None:
+             raise OSError(f'No metadata indexed for {self.name}')
+          return(self)
+
+
+
+
+class DirectoryIndex:
+
+      def __init__(self, dbPath):
+          self.dbPath = dbPath
+          self.db = sqlite3.connect(dbPath)
+          # Allows searching while the index is being updated (see watcher.py)
+          self.db.execute('PRAGMA journal_mode=WAL')
+          for stmt in SCHEMA:
+              self.db.execute(stmt)
+          self.db.commit()
+
+
+      def close(self):
+          self.db.close()
+
+
+      @staticmethod
+      def key(path):
+          return(os.path.abspath(path))
+
+
+      # True if directory path has been indexed (as a root or as a subdirectory of one)
+      def contains(self, path):
+          row = self.db.execute('SELECT mtime FROM directories WHERE path=?', (self.key(path),)).fetchone()
+          return(row is not None and row[0] is not None)
+
+
+
+      # Removes directory path and everything below it from the index.
+      def removeTree(self, path):
+          lo = path + os.sep
+          hi = path + chr(ord(os.sep) + 1)
+          self.db.execute('DELETE FROM directories WHERE path=? OR (path>=? AND path<?)', (path, lo, hi))
+          self.db.execute('DELETE FROM files WHERE parent=? OR (parent>=? AND parent<?)', (path, lo, hi))
+
+
+
+      # Brings the index of directory root up to date and returns a dictionary with the
+      # number of directories listed, unchanged and removed and the number of files indexed.
+      # Only directories not indexed yet or whose modification time changed are listed.
+      def refresh(self, root):
+          rootKey = self.key(root)
+          self.db.execute('INSERT OR IGNORE INTO directories (path, parent, name, mtime) VALUES (?, NULL, ?, NULL)', (rootKey, rootKey))
+          return(self.update([rootKey], False))
+
+
+      # Lists the given indexed directories again, even if their modification time did not
+      # change (e.g. because files in them were modified), and indexes their new subdirectories.
+      # Their other subdirectories are not looked at. Returns the same dictionary as refresh().
+      def refreshDirectories(self, paths):
+          return(self.update([self.key(p) for p in paths], True))
+
+
+
+      # Updates the index starting with directories paths. If force is True, paths are
+      # listed in any case and only new subdirectories are descended into.
+      def update(self, paths, force):
+          stats = {'listed':0, 'unchanged':0, 'removed':0, 'files':0}
+
+          stack = list(paths)
+          forced = set(paths) if force else set()
+          while len(stack) > 0:
+                path = stack.pop()
+                row = self.db.execute('SELECT mtime FROM directories WHERE path=?', (path,)).fetchone()
+                if row is None and force:
+                   # Not indexed (yet); will be indexed when its parent is listed
+                   continue
+
+                try:
+                   # Stat before listing: changes made in between are caught by the next refresh
+                   mtime = fileSystems.current.stat(path).st_mtime
+                except OSError as stEx:
+                   self.removeTree(path)
+                   stats['removed'] += 1
+                   continue
+
+                if path not in forced and row is not None and row[0] == mtime:
+                   stats['unchanged'] += 1
+                   if not force:
+                      stack.extend(normalizedPathJoin(path, r[0]) for r in self.db.execute('SELECT name FROM directories WHERE parent=?', (path,)))
+                   continue
+
+                try:
+                   dirs, files = functionality.scanDirectory(path)
+                except OSError as lsEx:
+                   print('Exception during indexing:', str(lsEx))
+                   continue
+
+                stats['listed'] += 1
+                stats['files'] += len(files)
+                self.db.execute('DELETE FROM files WHERE parent=?', (path,))
+                self.db.executemany('INSERT OR REPLACE INTO files (parent, name, size, mtime, created) VALUES (?, ?, ?, ?, ?)',
+                                    (self.fileRow(path, f) for f in files))
+
+                names = set(d.name for d in dirs)
+                indexed = set(r[0] for r in self.db.execute('SELECT name FROM directories WHERE parent=?', (path,)).fetchall())
+                for n in indexed - names:
+                    self.removeTree(normalizedPathJoin(path, n))
+                    stats['removed'] += 1
+
+                # New subdirectories have no mtime yet and will be listed
+                self.db.executemany('INSERT OR IGNORE INTO directories (path, parent, name, mtime) VALUES (?, ?, ?, NULL)',
+                                    ((normalizedPathJoin(path, n), path, n) for n in names - indexed))
+                self.db.execute('UPDATE directories SET mtime=? WHERE path=?', (mtime, path))
+                stack.extend(normalizedPathJoin(path, n) for n in (names - indexed if force else names))
+
+          self.db.commit()
+          return(stats)
+
+
+
+      @staticmethod
+      def fileRow(parent, entry):
+          try:
+             st = entry.stat()
+             return((parent, entry.name, st.st_size, st.st_mtime, creationTimestamp(st)))
+          except OSError as stEx:
+             return((parent, entry.name, -1, None, None))
+
+
+
+      # Returns the indexed listing of directory path as two lists of IndexEntry
+      # objects (directories, files) sorted by name, as functionality.scanDirectory() does.
+      # Raises OSError if path has not been indexed.
+      def listing(self, path):
+          key = self.key(path)
+          if not self.contains(key):
+             raise OSError(f'Directory {path} not in index {self.dbPath}')
+
+          dirs = [IndexEntry(r[0], 0, r[1], r[1]) for r in self.db.execute('SELECT name, mtime FROM directories WHERE parent=? ORDER BY name', (key,))]
+          files = [IndexEntry(*r) for r in self.db.execute('SELECT name, size, mtime, created FROM files WHERE parent=? ORDER BY name', (key,))]
+          return(dirs, files)
+
+
+      # Same interface as functionality.DirectoryPrefetcher
+      def take(self, path, lvl):
+          return(self.listing(path))
+
+      def discard(self, path):
+          return
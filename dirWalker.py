@@ -39,6 +39,7 @@
 
 #import os
 import sys
+from contextlib import redirect_stdout
 #import time
 
 #import datetime
@@ -87,6 +88,12 @@ def main():
    # Directory TRAVERSAL related and CRITERIA
    cmdArgParser.add_argument('-d', '--directory', default="testDirectories/testDir0")
    cmdArgParser.add_argument('-mxt', '--maxTime',  type=float, default=-1)
+   # File the state of the traversal is saved in, so that a traversal stopped by -mxt can be resumed (see checkpoint.py)
+   cmdArgParser.add_argument('-CP', '--checkpoint', default='')
+   # Seconds between checkpoints
+   cmdArgParser.add_argument('-CPI', '--checkpointInterval', type=float, default=60)
+   # Continue from the checkpoint
+   cmdArgParser.add_argument('-RES', '--resume', action='store_true')
    cmdArgParser.add_argument('-mxl', '--maxLevels', type=int, default=-1)
    cmdArgParser.add_argument('-fip', '--fileinclusionPattern', default="")
    cmdArgParser.add_argument('-fxp', '--fileexclusionPattern', default="")
@@ -103,6 +110,42 @@ def main():
    cmdArgParser.add_argument('-lmdo', '--lastModifiedDateOp',  default='==')
    cmdArgParser.add_argument('-lmd', '--lastModifiedDate',  default='')
    cmdArgParser.add_argument('-NR', '--nonRecursive', action='store_true')
+   # Traverse each directory once, even if reachable through links or bind mounts (also stops loops)
+   cmdArgParser.add_argument('-UD', '--uniqueDirectories', action='store_true')
+   # Do not traverse directories on other file systems (mount points)
+   cmdArgParser.add_argument('-XDEV', '--oneFileSystem', '--one-file-system', dest='oneFileSystem', action='store_true')
+   # Use explicit stack instead of recursion when traversing
+   cmdArgParser.add_argument('-IT', '--iterative', action='store_true')
+   # Number of threads listing directories concurrently
+   cmdArgParser.add_argument('-W', '--workers', type=int, default=0)
+   # Number of processes traversing top level subdirectories
+   cmdArgParser.add_argument('-MP', '--processes', type=int, default=0)
+   # SQLite database of indexed directories (see dirIndex.py)
+   cmdArgParser.add_argument('-DB', '--index', default='')
+   # Create/refresh the index of the directory
+   cmdArgParser.add_argument('-RDB', '--refreshIndex', action='store_true')
+   # Traverse the directory even if it has been indexed
+   cmdArgParser.add_argument('-LIVE', '--liveWalk', action='store_true')
+   # Keep watching the directory and update index/export/search when it changes (see watcher.py)
+   cmdArgParser.add_argument('-WATCH', '--watch', action='store_true')
+   # Seconds without changes before updating
+   cmdArgParser.add_argument('-WD', '--watchDelay', type=float, default=1.0)
+   # Poll directory modification times instead of using inotify
+   cmdArgParser.add_argument('-POLL', '--poll', action='store_true')
+   # File system to traverse: local or memory:DEPTH,FANOUT,FILES (see fileSystems.py)
+   cmdArgParser.add_argument('-FS', '--fileSystem', default='local')
+   # Simulated seconds each listing/stat call takes
+   cmdArgParser.add_argument('-FSL', '--fsLatency', type=float, default=0)
+   # Simulated fraction of listing/stat calls failing
+   cmdArgParser.add_argument('-FSE', '--fsErrorRate', type=float, default=0)
+   # Traverse zip/tar archives as directories, without extracting them (see archives.py)
+   cmdArgParser.add_argument('-AR', '--archives', action='store_true')
+   # SQLite database caching the indexes of archives. Empty: cached in memory only
+   cmdArgParser.add_argument('-ARC', '--archiveCache', default='')
+   # Write the traversal to a snapshot file first; the operation then reads the snapshot (see snapshot.py)
+   cmdArgParser.add_argument('-SO', '--snapshotOut', default='')
+   # Read directories from snapshot files (separated by os.pathsep) instead of walking them
+   cmdArgParser.add_argument('-FSN', '--fromSnapshot', default='')
    
 
    # SEARCH functionality related
@@ -111,6 +154,8 @@ def main():
    # If set, exclude directories
    cmdArgParser.add_argument('-ND', '--noDirs', action='store_true')
    cmdArgParser.add_argument('-I', '--interactive', action='store_true')
+   # File the matching paths are also written to, one per line (compressed with -CMP or .gz/.bz2/.xz)
+   cmdArgParser.add_argument('-SRO', '--searchOutput', default='')
 
 
    # If set, this will display a gui showing the progress of search as it
@@ -119,9 +164,18 @@ def main():
    
    # EXPORT TEMPLATE  related
    cmdArgParser.add_argument('-tp', '--template', default="")
+   # template: rendered with the template file; virtual: rows of compact JSON the page renders in view only;
+   # ndjson, csv: one record per directory and file (see handlers.RecordExportVisitor)
+   cmdArgParser.add_argument('-EF', '--exportFormat', default='template', choices=['template', 'virtual', 'ndjson', 'csv'])
+   # Comma separated columns of ndjson and csv records
+   cmdArgParser.add_argument('-COL', '--columns', default='path,type,size,lastmodified')
    # How the (replaced) template items (files/directories) should be spararated
    cmdArgParser.add_argument('-tis', '--templateItemsSeparator', default='')
    cmdArgParser.add_argument('-o', '--outputFile', default="index.html")
+   # Compress the output while written (see compression.py); also by suffix of -o: .gz, .bz2, .xz
+   cmdArgParser.add_argument('-CMP', '--compress', default='', choices=['', 'gzip', 'bz2', 'xz'])
+   # Level of the codec, -1 for its default (bz2 has no level 0; see compression.codecOpen())
+   cmdArgParser.add_argument('-CL', '--compressLevel', type=int, default=-1, choices=range(-1, 10))
    # Note: if many css files are specified, enclose the arguments in double quotes "" and
    # separate individual css files with a comma (,) e.g. -s "a.css, folder/b.css, c.css"
    cmdArgParser.add_argument('-s', '--css', default="html/style.css")
@@ -129,6 +183,20 @@ def main():
    cmdArgParser.add_argument('-tl', '--title', default="")
    cmdArgParser.add_argument('-E', '--urlencode', action='store_true')
    cmdArgParser.add_argument('-RE', '--replaceEmptySubdirs', action='store_true')
+   # SQLite database with rendered subdirectories reused by the next export (see exportCache.py)
+   cmdArgParser.add_argument('-XC', '--exportCache', default='')
+   # Contents of directories every N levels in shards loaded when opened (see lazyExport.py)
+   cmdArgParser.add_argument('-LZ', '--lazyLevels', type=int, default=0)
+   # The starting directory and directories down to level N on pages of their own (see pagedExport.py)
+   cmdArgParser.add_argument('-PG', '--pageLevels', type=int, default=0)
+   # Export only the pages of this subdirectory (relative to -d) again
+   cmdArgParser.add_argument('-PGS', '--pageSubtree', default='')
+   
+   # DISK USAGE related
+   # Show the size of the directory and its largest directories and files (see diskUsage.py)
+   cmdArgParser.add_argument('-DU', '--diskUsage', action='store_true')
+   # Number of largest directories and files shown
+   cmdArgParser.add_argument('-TOP', '--top', type=int, default=10)
    
    # DIRECTORY COMPARISON related
    cmdArgParser.add_argument('-LDIR', '--leftdirectory', default='')
@@ -152,17 +220,27 @@ def main():
    
    mode = ''
    # If there is a searchquery of interactive mode, we do search
-   if config.get('searchquery', []) != []:
+   if config.get('searchquery', []) != [] or config.get('interactive', False):
       mode = 'search'
    elif config.get('leftdirectory', '') != '' or  config.get('rightdirectory', '') or config.get('synchronize', False):
         mode = 'compare'
+   elif config.get('diskUsage', False):
+        mode = 'usage'
+   elif config.get('refreshIndex', False):
+        mode = 'index'
    else:
         mode = 'export'
         
       
    
    # Settings done. Now, execute operation based on mode   
-   functionality.selector(mode, config, cmdArgParser)
+   if mode == 'export' and config.get('outputFile', '') == '-':
+      # The page goes to stdout, messages to stderr
+      out = sys.stdout
+      with redirect_stdout(sys.stderr):
+           functionality.selector(mode, config, cmdArgParser, out)
+   else:
+      functionality.selector(mode, config, cmdArgParser)
    
 
 
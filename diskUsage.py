@@ -0,0 +1,124 @@
+
+#
+#
+#
+# Disk usage of directory structures, aggregated while they are traversed.
+#
+# Visitors add the files they visit and close directories once they have been
+# traversed (i.e. in Visitor.updateCounts(), called after all subdirectories
+# of a directory have been closed). The totals of a closed directory are added
+# to its parent, the same way directory and file counts are propagated by the
+# traversal. Only directories still being traversed are kept in memory, plus the
+# top largest directories and files in bounded heaps.
+#
+# Sizes are counted twice: apparent (file sizes) and allocated (blocks on disk,
+# e.g. smaller for sparse or compressed files). Files with several hard links
+# are counted once.
+#
+# NOTE: With sharded traversals (-MP) and the export cache (-XC), hard links are
+#       counted once per shard and per rendered subdirectory respectively.
+#
+#
+#
+
+
+import os
+import heapq
+
+from utilities import InodeSet
+
+
+
+
+# Directory containing path; paths are normalized (see utilities.normalizedPathJoin())
+def parentOf(path):
+    return(os.path.dirname(path) or '.')
+
+
+
+
+class DiskUsage:
+
+      def __init__(self, top=10):
+          self.top = top
+          # directory -> [size, allocated] of the directories not closed yet
+          self.open = {}
+          # Hard linked files counted so far
+          self.linked = InodeSet()
+          # Heaps of (size, path); the smallest of the top largest is first
+          self.largestFiles = []
+          self.largestDirectories = []
+
+
+      def push(self, heap, size, path):
+          if len(heap) < self.top:
+             heapq.heappush(heap, (size, path))
+          elif self.top > 0 and (size, path) > heap[0]:
+             heapq.heapreplace(heap, (size, path))
+
+
+      def addFile(self, path, meta):
+          size = meta['size']
+          if size < 0:
+             return
+
+          fileid = meta['fileid']
+          if fileid is not None and not self.linked.add(fileid[0], fileid[1]):
+             return
+
+          t = self.open.setdefault(parentOf(path), [0, 0])
+          t[0] += size
+          t[1] += max(meta['allocated'], 0)
+          self.push(self.largestFiles, size, path)
+
+
+      # Called once directory path has been traversed. Returns its [size, allocated].
+      def closeDirectory(self, path):
+          t = self.open.pop(path, [0, 0])
+          p = self.open.setdefault(parentOf(path), [0, 0])
+          p[0] += t[0]
+          p[1] += t[1]
+          self.push(self.largestDirectories, t[0], path)
+          return(t)
+
+
+      # [size, allocated] of directory path (e.g. the root) not closed.
+      def totals(self, path):
+          return(self.open.get(os.path.normpath(path), [0, 0]))
+
+
+      # The (json serializable) usage of directory path, e.g. the root of a shard,
+      # to be merged into another DiskUsage.
+      def state(self, path):
+          return({'totals':self.totals(path),
+                  'files':self.largestFiles,
+                  'directories':self.largestDirectories})
+
+
+      # Merges the usage of directory path (see state()) traversed elsewhere.
+      # Must be called before directory path is closed.
+      def merge(self, path, state):
+          t = self.open.setdefault(os.path.normpath(path), [0, 0])
+          t[0] += state['totals'][0]
+          t[1] += state['totals'][1]
+          for size, p in state['files']:
+              self.push(self.largestFiles, size, p)
+          for size, p in state['directories']:
+              self.push(self.largestDirectories, size, p)
+
+
+      # Lists of (size, path), largest first
+      def largest(self):
+          return(sorted(self.largestDirectories, reverse=True), sorted(self.largestFiles, reverse=True))
+
+
+
+
+# Size in bytes with a unit e.g. 1.5 GB
+def humanSize(size):
+    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
+        if abs(size) < 1024 or unit == 'TB':
+           break
+        size /= 1024
+
+    return(f'{size:.0f} {unit}' if unit == 'B' else f'{size:.1f} {unit}')
@@ -0,0 +1,260 @@
+
+#
+#
+#
+# Cache of rendered export fragments, stored in a SQLite database.
+#
+# For every exported directory, the cache holds the rendered contents of the
+# directory (i.e. what replaces its ${SUBDIRECTORY}) together with its counts and
+# the modification time of the directory. In the rendered contents, the
+# contents of each subdirectory are only referenced by a marker; they are stored
+# in the record of the subdirectory. This way each file/directory is stored
+# once, no matter how deep it is.
+#
+# A directory's record can be reused if the directory's modification time has
+# not changed, the same templates and criteria are used, and the same holds for
+# all its (traversed) subdirectories. Otherwise the directory is listed and
+# rendered again, reusing the records of its unchanged subdirectories.
+# Exporting therefore depends on the amount of change and not on the size of
+# the directory structure.
+#
+# The cache is walked with explicit stacks, not recursion, so that directory structures
+# of any depth can be exported (see functionality.fsTraversalCached()).
+#
+# NOTE: Editing a file does not change the modification time of its directory.
+#       Templates showing file sizes or dates may hence show outdated values
+#       until something else changes in the directory, the directory is
+#       invalidated (see invalidate(); done by --watch), or the cache is deleted.
+#
+#
+#
+
+
+import os
+import re
+import json
+import time
+import hashlib
+import sqlite3
+
+
+
+
+SCHEMA = ['CREATE TABLE IF NOT EXISTS fragments (path TEXT, level INTEGER, config TEXT, mtime REAL, children TEXT, html TEXT, counts TEXT, totals TEXT, directories TEXT, run INTEGER, PRIMARY KEY (path, level))']
+
+
+# Criteria affecting the rendered output of an export
+CONFIGURATIONCRITERIA = ['fileexclusionPattern', 'fileinclusionPattern', 'direxclusionPattern', 'dirinclusionPattern',
+                         'minFileSize', 'maxFileSize',
+                         'creationDate', 'creationDateOp', 'lastModifiedDate', 'lastModifiedDateOp',
+                         'maxLevels', 'templateItemsSeparator']
+
+
+# Marks where the contents of a subdirectory go, until expanded.
+MARKER = re.compile('\x00DWF([0-9]+):([^\x00]*)\x00')
+
+def marker(path, level):
+    return(f'\x00DWF{level}:{path}\x00')
+
+
+
+
+# Hash of the templates and criteria an export is made with.
+# Records made with a different configuration are not reused.
+def configurationKey(templates, criteria):
+    cfg = json.dumps([list(templates), {k: criteria.get(k, None) for k in CONFIGURATIONCRITERIA}], sort_keys=True, default=str)
+    return(hashlib.sha256(cfg.encode('utf8')).hexdigest())
+
+
+
+
+# Removes the fragments of directories paths from the cache at dbPath (e.g. because
+# files in them were edited; see watcher.py). They, and the directories containing
+# them, are rendered again by the next export.
+def invalidate(dbPath, paths):
+    db = sqlite3.connect(dbPath)
+    try:
+       for stmt in SCHEMA:
+           db.execute(stmt)
+       db.executemany('DELETE FROM fragments WHERE path=?', ((p,) for p in paths))
+       db.commit()
+    finally:
+       db.close()
+
+
+
+
+# A directory's cached fragment
+class Fragment:
+      def __init__(self, row):
+          self.mtime = row[0]
+          self.children = json.loads(row[1])
+          self.html = row[2]
+          self.counts = tuple(json.loads(row[3]))
+          self.totals = json.loads(row[4])
+          self.directories = json.loads(row[5])
+
+
+
+
+class ExportCache:
+
+      # root: the starting directory of the export
+      def __init__(self, dbPath, config, root):
+          self.dbPath = dbPath
+          self.config = config
+          self.root = root
+          self.run = time.time_ns()
+          self.db = sqlite3.connect(dbPath)
+          for stmt in SCHEMA:
+              self.db.execute(stmt)
+          self.db.commit()
+          # Fragments found to be valid/invalid during this run (None means invalid)
+          self.checked = {}
+          self.reused = 0
+          self.rendered = 0
+
+
+      # Removes the records below root made with this configuration but not used during
+      # this run (e.g. of removed directories) and closes the cache. Records of other
+      # starting directories and configurations are kept.
+      def close(self):
+          prefix = os.path.join(self.root, '')
+          self.db.execute('DELETE FROM fragments WHERE run<>? AND config=? AND substr(path, 1, ?)=?', (self.run, self.config, len(prefix), prefix))
+          self.db.commit()
+          self.db.close()
+
+
+      def load(self, path, level):
+          row = self.db.execute('SELECT mtime, children, html, counts, totals, directories FROM fragments WHERE path=? AND level=? AND config=?', (path, level, self.config)).fetchone()
+          if row is None:
+             return(None)
+          return(Fragment(row))
+
+
+
+      # The stored fragment of directory path at level, if made when the directory had
+      # modification time mtime. None otherwise.
+      def candidate(self, path, level, mtime):
+          fragment = self.load(path, level)
+          if fragment is not None and fragment.mtime != mtime:
+             return(None)
+          return(fragment)
+
+
+      # Returns the fragment of directory path at level if it can be reused i.e. neither
+      # the directory nor any of its subdirectories changed. None otherwise.
+      # mtime is the current modification time of the directory.
+      def valid(self, path, level, mtime, stat):
+          if (path, level) in self.checked:
+             return(self.checked[(path, level)])
+
+          # Frames: [path, level, fragment (None once invalid), index of the next child to check]
+          stack = [[path, level, self.candidate(path, level, mtime), 0]]
+          while len(stack) > 0:
+                frame = stack[-1]
+                if frame[2] is not None and frame[3] < len(frame[2].children):
+                   child = frame[2].children[frame[3]]
+                   frame[3] += 1
+                   if (child, frame[1]+1) in self.checked:
+                      if self.checked[(child, frame[1]+1)] is None:
+                         frame[2] = None
+                      continue
+
+                   try:
+                      childMtime = stat(child)
+                   except OSError as stEx:
+                      frame[2] = None
+                      continue
+
+                   stack.append([child, frame[1]+1, self.candidate(child, frame[1]+1, childMtime), 0])
+                   continue
+
+                # All children checked, or one of them changed
+                stack.pop()
+                self.checked[(frame[0], frame[1])] = frame[2]
+                if frame[2] is None and len(stack) > 0:
+                   stack[-1][2] = None
+
+          return(self.checked[(path, level)])
+
+
+
+      # Stores the fragment of directory path at level.
+      # children: the paths of the subdirectories traversed.
+      # result: see handlers.ExportVisitor.shardResult().
+      def store(self, path, level, mtime, children, result, counts):
+          totals = [result['file_count'], result['directory_count'], result['nIgnored']]
+          if result.get('usage') is not None:
+             totals.append(result['usage'])
+          self.db.execute('INSERT OR REPLACE INTO fragments (path, level, config, mtime, children, html, counts, totals, directories, run) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                          (path, level, self.config, mtime, json.dumps(children), result['html'], json.dumps(list(counts)), json.dumps(totals), json.dumps(result['directoryList']), self.run))
+          self.rendered += 1
+
+
+
+      # Marks the (valid) fragment of directory path at level and the fragments of all
+      # its subdirectories as used during this run.
+      def use(self, path, level, count=True):
+          if count:
+             self.reused += 1
+
+          pending = [(path, level)]
+          while len(pending) > 0:
+                path, level = pending.pop()
+                self.db.execute('UPDATE fragments SET run=? WHERE path=? AND level=?', (self.run, path, level))
+                pending.extend((child, level+1) for child in self.checked[(path, level)].children)
+
+
+      # Returns html with all markers replaced by the (expanded) contents of the
+      # respective subdirectories.
+      def expand(self, html):
+          pieces = []
+          self.write(html, pieces.append)
+          return(''.join(pieces))
+
+
+      # Same as expand(), but passes the result to write() in pieces: the html of
+      # each fragment as it is loaded.
+      def write(self, html, write):
+          # (html, position to continue from) of the fragments being written
+          pending = [(html, 0)]
+          while len(pending) > 0:
+                html, start = pending.pop()
+                m = MARKER.search(html, start)
+                if m is None:
+                   write(html[start:])
+                   continue
+
+                write(html[start:m.start()])
+                pending.append((html, m.end()))
+                fragment = self.load(m.group(2), int(m.group(1)))
+                if fragment is not None and fragment.html is not None:
+                   pending.append((fragment.html, 0))
+
+
+      # The directories (see handlers.ExportVisitor.directoryList) of directory path and
+      # all its subdirectories.
+      def directoryList(self, path, level):
+          fragment = self.load(path, level)
+          if fragment is None:
+             return([])
+
+          # In the order of traversal: each subdirectory is followed by its own subdirectories.
+          # Frames: [fragment, level, index of the next directory]
+          dl = []
+          stack = [[fragment, level, 0]]
+          while len(stack) > 0:
+                frame = stack[-1]
+                if frame[2] == len(frame[0].directories):
+                   stack.pop()
+                   continue
+
+                d = frame[0].directories[frame[2]]
+                frame[2] += 1
+                dl.append(d)
+                if d['path'] in frame[0].children:
+                   sub = self.load(d['path'], frame[1]+1)
+                   if sub is not None:
+                      stack.append([sub, frame[1]+1, 0])
+          return(dl)
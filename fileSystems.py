@@ -0,0 +1,441 @@
+
+#
+#
+#
+# File systems traversals list directories and stat files in.
+#
+# Everything the traversals (see functionality.scanDirectory()), utilities.fileInfo()
+# and functionality.dirDifference() read goes through the current file system (see use()),
+# by default the local one. Other implementations allow measuring the traversal engines,
+# prefetching threads, indexes and caches deterministically on a single machine:
+#
+#   MemoryFileSystem   a directory structure held in memory, e.g. a synthetic tree of
+#                      any size or a copy of a real directory.
+#   LatencyFileSystem  wraps another file system, adding a delay to every listing and
+#                      stat call and failing a given fraction of them, as slow or
+#                      unreliable network shares do.
+#
+# A file system lists a directory as entries looking like os.DirEntry objects: name,
+# path, is_dir() (without stat-ing) and stat() (cached). stat() results look like
+# os.stat_result objects.
+#
+#    previous = fileSystems.use(fileSystems.LatencyFileSystem(fileSystems.MemoryFileSystem.synthetic('tree'), latency=0.002))
+#    try:
+#       functionality.search('dir00[13]', {'directory':'tree', 'workers':16})
+#    finally:
+#       fileSystems.use(previous)
+#
+# NOTE: Sharded traversals (-MP) hand the current file system to their processes;
+#       in-memory directory structures are copied to each of them.
+#
+#
+#
+
+
+
+import os
+import stat
+import time
+import errno
+import zlib
+import threading
+from abc import ABC, abstractmethod
+
+
+
+
+class FileSystem(ABC):
+
+      # Returns the entries of directory path (in no particular order).
+      # Raises OSError if path cannot be listed.
+      @abstractmethod
+      def listDirectory(self, path):
+          pass
+
+      # Returns the stat of path (following symbolic links).
+      # Raises OSError if path does not exist.
+      @abstractmethod
+      def stat(self, path):
+          pass
+
+      def isdir(self, path):
+          try:
+             return(stat.S_ISDIR(self.stat(path).st_mode))
+          except OSError:
+             return(False)
+
+      # Returns file path opened for reading (binary). Not all file systems hold contents.
+      def open(self, path):
+          raise OSError(errno.EOPNOTSUPP, 'File contents not available', path)
+
+
+
+
+class LocalFileSystem(FileSystem):
+
+      def listDirectory(self, path):
+          with os.scandir(path) as it:
+               return(list(it))
+
+      def stat(self, path):
+          return(os.stat(path))
+
+      def open(self, path):
+          return(open(path, 'rb'))
+
+      def isdir(self, path):
+          return(os.path.isdir(path))
+
+
+
+
+#
+# In-memory file system
+#
+
+
+# Looks like an os.stat_result
+class MemoryStat:
+
+      __slots__ = ('st_mode', 'st_ino', 'st_dev', 'st_nlink', 'st_size', 'st_blocks', 'st_atime', 'st_mtime', 'st_ctime')
+
+      def __init__(self, mode, ino, size=0, mtime=0.0):
+          self.st_mode = mode
+          self.st_ino = ino
+          self.st_dev = 0
+          self.st_nlink = 2 if stat.S_ISDIR(mode) else 1
+          self.st_size = size
+          self.st_blocks = (size + 511)//512
+          self.st_atime = mtime
+          self.st_mtime = mtime
+          self.st_ctime = mtime
+
+
+
+# A file or directory of a MemoryFileSystem. children: name -> MemoryNode, None for files.
+class MemoryNode:
+
+      __slots__ = ('st', 'children')
+
+      def __init__(self, st, children=None):
+          self.st = st
+          self.children = children
+
+
+
+# Looks like an os.DirEntry
+class MemoryEntry:
+
+      __slots__ = ('name', 'path', 'node')
+
+      def __init__(self, name, path, node):
+          self.name = name
+          self.path = path
+          self.node = node
+
+      def is_dir(self, follow_symlinks=True):
+          return(self.node.children is not None)
+
+      def is_file(self, follow_symlinks=True):
+          return(self.node.children is None)
+
+      def is_symlink(self):
+          return(False)
+
+      def stat(self, follow_symlinks=True):
+          return(self.node.st)
+
+      def inode(self):
+          return(self.node.st.st_ino)
+
+
+
+# Paths are looked up by their normalized components; relative and absolute paths
+# share the same tree.
+class MemoryFileSystem(FileSystem):
+
+      def __init__(self):
+          self.inodes = 0
+          self.root = self.newNode(True)
+
+
+      def newNode(self, isDir, size=0, mtime=0.0):
+          self.inodes += 1
+          if isDir:
+             return(MemoryNode(MemoryStat(stat.S_IFDIR | 0o755, self.inodes, 4096, mtime), {}))
+          return(MemoryNode(MemoryStat(stat.S_IFREG | 0o644, self.inodes, size, mtime)))
+
+
+      @staticmethod
+      def components(path):
+          return([c for c in os.path.normpath(path).split(os.sep) if c not in ('', '.')])
+
+
+      def node(self, path):
+          n = self.root
+          for c in self.components(path):
+              if n.children is None:
+                 raise NotADirectoryError(errno.ENOTDIR, os.strerror(errno.ENOTDIR), path)
+              n = n.children.get(c)
+              if n is None:
+                 raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+          return(n)
+
+
+      # Creates directory path and its missing parents
+      def makeDirectories(self, path, mtime=0.0):
+          n = self.root
+          for c in self.components(path):
+              if n.children is None:
+                 raise NotADirectoryError(errno.ENOTDIR, os.strerror(errno.ENOTDIR), path)
+              if c not in n.children:
+                 n.children[c] = self.newNode(True, mtime=mtime)
+              n = n.children[c]
+          return(n)
+
+
+      def addFile(self, path, size=0, mtime=0.0):
+          parent, name = os.path.split(os.path.normpath(path))
+          self.makeDirectories(parent).children[name] = self.newNode(False, size, mtime)
+
+
+      def listDirectory(self, path):
+          n = self.node(path)
+          if n.children is None:
+             raise NotADirectoryError(errno.ENOTDIR, os.strerror(errno.ENOTDIR), path)
+          return([MemoryEntry(name, os.path.join(path, name), c) for name, c in n.children.items()])
+
+
+      def stat(self, path):
+          return(self.node(path).st)
+
+
+      # A tree under root like benchmarks.makeSyntheticTree() creates: each directory
+      # gets filesPerDir files and fanout subdirectories, down to depth levels.
+      @staticmethod
+      def synthetic(root, depth=3, fanout=4, filesPerDir=40, mtime=0.0):
+          fs = MemoryFileSystem()
+          level = [fs.makeDirectories(root, mtime)]
+          for d in range(depth+1):
+              nextLevel = []
+              for parent in level:
+                  for f in range(filesPerDir):
+                      parent.children[f'file{f:04d}.txt'] = fs.newNode(False, f % 64, mtime)
+
+                  if d == depth:
+                     continue
+
+                  for s in range(fanout):
+                      sub = fs.newNode(True, mtime=mtime)
+                      parent.children[f'dir{s:03d}'] = sub
+                      nextLevel.append(sub)
+              level = nextLevel
+
+          return(fs)
+
+
+      # Copy of directory root of fileSystem (names, types, sizes and times). Directories
+      # that cannot be listed and symbolic links to directories are copied empty.
+      @staticmethod
+      def copyOf(root, fileSystem=None):
+          if fileSystem is None:
+             fileSystem = LocalFileSystem()
+
+          fs = MemoryFileSystem()
+          fs.makeDirectories(root, fileSystem.stat(root).st_mtime)
+          stack = [root]
+          while len(stack) > 0:
+                path = stack.pop()
+                try:
+                   entries = fileSystem.listDirectory(path)
+                except OSError:
+                   continue
+
+                for e in entries:
+                    p = os.path.join(path, e.name)
+                    try:
+                       isDir = e.is_dir()
+                       st = e.stat()
+                    except OSError:
+                       continue
+
+                    if not isDir:
+                       fs.addFile(p, st.st_size, st.st_mtime)
+                       continue
+
+                    fs.makeDirectories(p, st.st_mtime)
+                    if not e.is_symlink():
+                       stack.append(p)
+
+          return(fs)
+
+
+
+
+#
+# Latency and errors
+#
+
+
+# Entry of a LatencyFileSystem. Types come with the listing; stat() costs a call
+# the first time, as with os.DirEntry.
+class LatencyEntry:
+
+      __slots__ = ('entry', 'fs', 'st')
+
+      def __init__(self, entry, fs):
+          self.entry = entry
+          self.fs = fs
+          self.st = None
+
+      @property
+      def name(self):
+          return(self.entry.name)
+
+      @property
+      def path(self):
+          return(self.entry.path)
+
+      def is_dir(self, follow_symlinks=True):
+          return(self.entry.is_dir())
+
+      def is_file(self, follow_symlinks=True):
+          return(self.entry.is_file())
+
+      def is_symlink(self):
+          return(self.entry.is_symlink())
+
+      def stat(self, follow_symlinks=True):
+          if self.st is None:
+             self.fs.call('stat', self.entry.path)
+             self.st = self.entry.stat()
+          return(self.st)
+
+
+
+# Wraps fileSystem. Every listing and stat call takes latency seconds (plus up to jitter
+# seconds) and a fraction errorRate of them fails with OSError(EIO).
+#
+# Delays and failures depend only on seed, the kind of call and the path, not on the
+# order of the calls: the same paths fail in every run, also when listed by several
+# threads (-W) or processes (-MP). calls counts the calls made ('list', 'stat', 'open'), errors
+# the calls that failed; calls made in the processes of sharded traversals are not counted.
+class LatencyFileSystem(FileSystem):
+
+      def __init__(self, fileSystem, latency=0.0, errorRate=0.0, jitter=0.0, seed=0):
+          self.fileSystem = fileSystem
+          self.latency = latency
+          self.errorRate = errorRate
+          self.jitter = jitter
+          self.seed = seed
+          self.calls = {'list':0, 'stat':0, 'open':0}
+          self.errors = 0
+          self.lock = threading.Lock()
+
+
+      # Locks can not be pickled (see NOTE above)
+      def __getstate__(self):
+          state = self.__dict__.copy()
+          del state['lock']
+          return(state)
+
+      def __setstate__(self, state):
+          self.__dict__.update(state)
+          self.lock = threading.Lock()
+
+
+      # Fraction in [0, 1) determined by the call
+      def fraction(self, kind, call, path):
+          return(zlib.crc32(f'{self.seed}:{kind}:{call}:{path}'.encode('utf8', 'surrogateescape')) / 2**32)
+
+
+      def call(self, call, path):
+          with self.lock:
+               self.calls[call] += 1
+
+          delay = self.latency
+          if self.jitter > 0:
+             delay += self.jitter * self.fraction('jitter', call, path)
+          if delay > 0:
+             time.sleep(delay)
+
+          if self.errorRate > 0 and self.fraction('error', call, path) < self.errorRate:
+             with self.lock:
+                  self.errors += 1
+             raise OSError(errno.EIO, f'Simulated {call} error', path)
+
+
+      def listDirectory(self, path):
+          self.call('list', path)
+          return([LatencyEntry(e, self) for e in self.fileSystem.listDirectory(path)])
+
+
+      def stat(self, path):
+          self.call('stat', path)
+          return(self.fileSystem.stat(path))
+
+
+      def isdir(self, path):
+          try:
+             self.call('stat', path)
+          except OSError:
+             return(False)
+          return(self.fileSystem.isdir(path))
+
+
+      def open(self, path):
+          self.call('open', path)
+          return(self.fileSystem.open(path))
+
+
+
+
+# The file system traversals use
+current = LocalFileSystem()
+
+
+# Makes fileSystem (None: the local file system) the current one. Returns the previous one.
+def use(fileSystem):
+    global current
+
+    previous = current
+    current = LocalFileSystem() if fileSystem is None else fileSystem
+    return(previous)
+
+
+
+# The file system described by criteria:
+#   fileSystem: 'local' or 'memory:DEPTH,FANOUT,FILES' for a synthetic tree (see
+#               MemoryFileSystem.synthetic()) at criterium directory
+#   fsLatency, fsErrorRate: if set, the file system is wrapped in a LatencyFileSystem
+#   archives: if True, archives are traversed as directories (see archives.py), with
+#             their indexes cached in criterium archiveCache
+#   fromSnapshot: snapshot files (see snapshot.py), separated by os.pathsep; the
+#                 directories they hold are read from them
+# Raises ValueError if fileSystem or a snapshot is not valid, OSError if a snapshot
+# cannot be opened.
+def fromCriteria(criteria):
+    spec = criteria.get('fileSystem', 'local') or 'local'
+    if spec == 'local':
+       fs = LocalFileSystem()
+    elif spec.startswith('memory:'):
+       depth, fanout, files = (int(v) for v in spec[len('memory:'):].split(','))
+       fs = MemoryFileSystem.synthetic(criteria.get('directory', 'testDirectories/testDir0'), depth, fanout, files)
+    else:
+       raise ValueError(f'Unknown file system [{spec}]. Use local or memory:DEPTH,FANOUT,FILES')
+
+    latency = criteria.get('fsLatency', 0) or 0
+    errorRate = criteria.get('fsErrorRate', 0) or 0
+    if latency > 0 or errorRate > 0:
+       fs = LatencyFileSystem(fs, latency, errorRate)
+
+    if criteria.get('archives', False):
+       # archives.py builds on this module
+       import archives
+       fs = archives.ArchiveFileSystem(fs, criteria.get('archiveCache', '') or '')
+
+    snapshots = criteria.get('fromSnapshot', '') or ''
+    if snapshots != '':
+       import snapshot
+       fs = snapshot.SnapshotFileSystem(snapshots.split(os.pathsep), fs)
+    return(fs)
@@ -42,7 +42,7 @@ from os.path import join, commonprefix, relpath
 import sys
 import time
 
-from filecmp import dircmp
+from filecmp import DEFAULT_IGNORES
 
 import re
 import random
@@ -53,13 +53,30 @@ import json
 
 import shutil # for copying directories
 
+import io
+import threading
+import concurrent.futures
+from contextlib import redirect_stdout
+
 import configparser
 import argparse
 
 
 
-from utilities import fontColorPalette, readTemplateFile, normalizedPathJoin, fileInfo, strToBytes, nameMatches, getCurrentDateTime, tabularDisplay, getRelativePath
+from prettytable import PrettyTable
+
+from utilities import fontColorPalette, readTemplateFile, normalizedPathJoin, InodeSet, entryInfo, lazyEntryInfo, strToBytes, nameMatches, getCurrentDateTime, tabularDisplay, getRelativePath
 import handlers
+import dirIndex
+import exportCache
+import watcher
+import checkpoint
+import fileSystems
+import snapshot
+import lazyExport
+import pagedExport
+import compression
+from diskUsage import humanSize
 import GUI
 
 
@@ -109,26 +126,102 @@ def timeit(f):
 #
 #####################################################
 
-# Ths core part of the file system traversal. This traverses all objects.
-# How encountered files/directories should be handled are in the visitor classes  
-# NOTE: the idea was to keep this function as generic as possible
+# Lists the contents of directory root in the current file system (see fileSystems.py),
+# i.e. using os.scandir by default.
 #
-# TODO: Looks too large. Needs to be optimized?
-       
-def fsTraversal(root, lvl, visitor=None):
+# Returns two lists of os.DirEntry objects, (directories, files), sorted by
+# name. Entry types come from the directory listing itself (d_type) and
+# hence do not require a stat call. Symbolic links to directories are
+# reported as directories (same as os.walk).
+# Raises OSError if root cannot be listed.
+def scanDirectory(root):
+    dirs = []
+    files = []
+    for entry in fileSystems.current.listDirectory(root):
+        try:
+           isDir = entry.is_dir()
+        except OSError:
+           isDir = False
+
+        if isDir:
+           dirs.append(entry)
+        else:
+           files.append(entry)
+
+    dirs.sort(key=lambda e: e.name)
+    files.sort(key=lambda e: e.name)
+    return(dirs, files)
+
+
+
+
+# Keeps a traversal from entering the same directory twice, e.g. through symbolic links,
+# bind mounts or directory hard links (criterium uniqueDirectories), and from leaving the
+# file system of the root directory (criterium oneFileSystem).
+# Directories are identified by the (device, inode) pair of their os.stat().
+#
+# Each traversal has its own guard, held by its visitor (or TraversalCriteria) as
+# traversalGuard, so that traversals running at the same time do not interfere.
+class DirectoryGuard:
 
+      def __init__(self, root, unique=False, oneFileSystem=False):
+          self.visited = InodeSet() if unique else None
+          self.device = fileSystems.current.stat(root).st_dev if oneFileSystem else None
+          self.skipped = 0
 
-    # TODO: check this
-    global timeStarted
 
+      # Returns the guard for the traversal of root at level lvl with the criteria of
+      # visitor, or None if no guard is needed.
+      @staticmethod
+      def forTraversal(root, lvl, visitor):
+          unique = visitor.getCriterium('uniqueDirectories', False)
+          oneFileSystem = visitor.getCriterium('oneFileSystem', False)
+          if not unique and not oneFileSystem:
+             return(None)
 
+          # Shards (see traverseShard()) stay in the file system of the actual root
+          top = root if lvl <= 1 else visitor.getCriterium('directory', root)
+          try:
+             return(DirectoryGuard(top, unique, oneFileSystem))
+          except OSError as stEx:
+             print('Exception during walk:', str(stEx))
+             return(None)
+
+
+      # True if directory path may be traversed. st: the stat of path, if already made.
+      def allows(self, path, st=None):
+          if st is None:
+             try:
+                st = fileSystems.current.stat(path)
+             except OSError:
+                # Listing the directory reports the error
+                return(True)
+
+          if self.device is not None and st.st_dev != self.device:
+             print(f'Not traversing [{path}]: on another file system.')
+             self.skipped += 1
+             return(False)
+
+          if self.visited is not None and not self.visited.add(st.st_dev, st.st_ino):
+             print(f'Not traversing [{path}]: already traversed (loop, bind mount or link).')
+             self.skipped += 1
+             return(False)
+
+          return(True)
+
+
+
+
+# Checks the general purpose constraints (execution time and levels) before
+# directory root at level lvl is traversed and updates the gui window, if any.
+#
+# Raises criteriaException if the maximum execution time has been reached.
+# Returns False if root must not be traversed, True otherwise.
+def checkTraversalConstraints(root, lvl, visitor):
+
+    # TODO: check this
+    global timeStarted
 
-    #########################################################################################
-    # Check if traversal should continue based on the specified constraints. 
-    # Some constraints (general purpose such as related to level and execution time
-    # are checked at this level.
-    #########################################################################################
-    
     maxTime = visitor.getCriterium('maxTime', -1)
     if maxTime > 0:
        if timeStarted is None:
@@ -146,7 +239,11 @@ def fsTraversal(root, lvl, visitor=None):
     mxLvl = visitor.getCriterium('maxLevels', -1)
     if mxLvl > 0:
        if lvl > mxLvl:
-          return(0, 0, 0, 0, 0)
+          return(False)
+
+    guard = getattr(visitor, 'traversalGuard', None)
+    if guard is not None and not guard.allows(root):
+       return(False)
 
     # Update window if gui version is used
     guiWin = visitor.getCriterium('guiwindow', None)
@@ -162,41 +259,99 @@ def fsTraversal(root, lvl, visitor=None):
        except Exception as updEx:
           pass 
 
+    return(True)
 
-    #
-    # Ok, get actual list of directories and files
-    #
+
+
+# Lists directory root using lister (see scanDirectory()).
+# Returns (status, dirs, files) where status is 0 on success.
+# On failure, dirs and files are None and status is -2 if ON_TRAVERSE_ERROR_QUIT is set
+# or 0 otherwise.
+def listTraversedDirectory(root, lister=scanDirectory):
     try:
-      path, dirs, files = next(os.walk(root) )
+      dirs, files = lister(root)
     except Exception as wEx:
       print('Exception during walk:', str(wEx) )
       if ON_TRAVERSE_ERROR_QUIT:
-         return(-2, 0, 0, 0, 0)
+         return(-2, None, None)
       else:
-         return(0, 0, 0, 0, 0)
+         return(0, None, None)
 
-        
-    dirs.sort()
-    files.sort()
+    return(0, dirs, files)
 
 
-    #
-    # Handle files
-    #
-    
-    lfc = 0 # local file count
-    tfc = 0 # total file count until here
+
+# Visits the files (DirEntries) of directory root.
+# Returns the number of files not ignored by the visitor.
+def visitFiles(root, lvl, files, visitor):
+    nVisited = 0
     for encounteredFile in files:
         sys.stdout.flush()
         
-        filePath = normalizedPathJoin(root, encounteredFile)          
-        fMeta = fileInfo(filePath)
-        fv = handlers.File(encounteredFile, filePath, lvl, root, fMeta)
+        filePath = normalizedPathJoin(root, encounteredFile.name)
+        # Size and times come from the stat of the directory entry, made only
+        # if and when the visitor accesses them.
+        fMeta = lazyEntryInfo(encounteredFile)
+        fv = handlers.File(encounteredFile.name, filePath, lvl, root, fMeta)
         fv.accept(visitor)
         # TODO: Check this
         if not fv.ignored: 
-           lfc += 1
-           tfc += 1 
+           nVisited += 1
+
+    return(nVisited)
+
+
+
+# Creates the Directory object of directory entry dEntry found in root and
+# lets the visitor visit it.
+def visitDirectory(root, lvl, dEntry, visitor):
+    sys.stdout.flush()
+
+    directoryPath = normalizedPathJoin(root, dEntry.name)
+    dH = handlers.Directory(dEntry.name,
+                            directoryPath,
+                            lvl,
+                            root,
+                            -1,
+                            -1,
+                            lazyEntryInfo(dEntry))
+    dH.accept(visitor)
+    return(dH)
+
+
+
+
+# Ths core part of the file system traversal. This traverses all objects.
+# How encountered files/directories should be handled are in the visitor classes  
+# NOTE: the idea was to keep this function as generic as possible
+#
+# Returns a tuple (status, ldc, lfc, tdc, tfc) i.e. the status and the local/total
+# directory and file counts of root.
+       
+def fsTraversal(root, lvl, visitor=None):
+
+    #########################################################################################
+    # Check if traversal should continue based on the specified constraints. 
+    # Some constraints (general purpose such as related to level and execution time
+    # are checked at this level.
+    #########################################################################################
+    
+    if not checkTraversalConstraints(root, lvl, visitor):
+       return(0, 0, 0, 0, 0)
+
+    #
+    # Ok, get actual list of directories and files
+    #
+    status, dirs, files = listTraversedDirectory(root)
+    if dirs is None:
+       return(status, 0, 0, 0, 0)
+
+    #
+    # Handle files
+    #
+    
+    lfc = visitFiles(root, lvl, files, visitor) # local file count
+    tfc = lfc # total file count until here
 
            
     #
@@ -206,16 +361,7 @@ def fsTraversal(root, lvl, visitor=None):
     ldc = 0 # local directory count
     tdc = 0 # total directory count until here 
     for encounteredDirectory in dirs:
-        sys.stdout.flush()
-        
-        directoryPath = normalizedPathJoin(root, encounteredDirectory)           
-        dH = handlers.Directory(encounteredDirectory,
-                               directoryPath,
-                               lvl,
-                               root,
-                               -1,
-                               -1)
-        dH.accept(visitor)
+        dH = visitDirectory(root, lvl, encounteredDirectory, visitor)
         # if not ignored, traverse into if so specified
         if not dH.ignored:
            ldc += 1
@@ -223,7 +369,7 @@ def fsTraversal(root, lvl, visitor=None):
 
            if not visitor.getCriterium('nonRecursive', False):
               # Since not ignored, go into subdirectory and traverse it
-              subDirData = fsTraversal(directoryPath, lvl+1, visitor)
+              subDirData = fsTraversal(dH.path, lvl+1, visitor)
               # Update local directory and file counts
               dH.setLocalCounts(subDirData[1], subDirData[2], subDirData[3], subDirData[4], visitor)
               tdc += subDirData[3]
@@ -237,6 +383,729 @@ def fsTraversal(root, lvl, visitor=None):
 
 
 
+# Lists and stats directories concurrently in a thread pool ahead of the traversal.
+#
+# When a directory has been listed (by a worker thread), its subdirectories are submitted
+# to the pool as well, so listings are available when the traversal reaches them. Since
+# listing and stat calls mostly wait for the (network) filesystem, this overlaps their
+# latency. The traversal itself (and therefore all visitor calls) remains in the calling
+# thread and in the same order; it only takes the prefetched listings via take().
+#
+# The number of prefetched listings not yet taken is limited by maxPending. Directories
+# that will not be traversed (e.g. ignored by the visitor) should be discarded so that
+# their prefetched subtrees are released. Every directory is submitted at most once, so
+# late listings do not submit directories the traversal has already taken.
+
+class DirectoryPrefetcher:
+
+      def __init__(self, workers=4, maxLevels=-1, maxPending=-1, stat=True):
+          self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+          self.maxLevels = maxLevels
+          self.stat = stat
+          self.maxPending = maxPending if maxPending > 0 else 64*workers
+          self.nPending = 0
+          self.futures = {}
+          # Directories submitted or taken so far
+          self.seen = set()
+          self.lock = threading.Lock()
+
+
+      # Submits directory path (at traversal level lvl) to the pool, if the
+      # limit of pending listings allows it.
+      def submit(self, path, lvl):
+          if self.maxLevels > 0 and lvl > self.maxLevels:
+             return
+
+          # The future is registered along with its pending slot, so that take() finds it
+          with self.lock:
+               if self.nPending >= self.maxPending or path in self.seen:
+                  return
+
+               try:
+                  self.futures[path] = self.pool.submit(self.scan, path, lvl)
+               except RuntimeError:
+                  # Pool has been shut down
+                  return
+               self.seen.add(path)
+               self.nPending += 1
+
+
+      # Executed in worker threads. Lists directory path, stats all entries (DirEntry
+      # objects cache the result) unless stat is False and submits its subdirectories.
+      def scan(self, path, lvl):
+          dirs, files = scanDirectory(path)
+          if self.stat:
+             for e in files:
+                 entryInfo(e)
+             for d in dirs:
+                 entryInfo(d)
+
+          for d in dirs:
+              self.submit(normalizedPathJoin(path, d.name), lvl+1)
+
+          return(dirs, files)
+
+
+      # Returns the listing (dirs, files) of path. Waits for it if it is being prefetched
+      # or lists it in the calling thread if it has not been submitted.
+      # Raises the exception raised during listing, if any.
+      def take(self, path, lvl):
+          with self.lock:
+               future = self.futures.pop(path, None)
+               self.seen.add(path)
+
+          if future is None:
+             return(self.scan(path, lvl))
+
+          try:
+             return(future.result())
+          finally:
+             with self.lock:
+                  self.nPending -= 1
+
+
+      # Drops the (prefetched) listing of path and of all its prefetched subdirectories.
+      def discard(self, path):
+          with self.lock:
+               future = self.futures.pop(path, None)
+
+          if future is not None:
+             future.cancel()
+             future.add_done_callback(lambda f: self.discarded(path, f))
+
+
+      def discarded(self, path, future):
+          with self.lock:
+               self.nPending -= 1
+
+          if future.cancelled() or future.exception() is not None:
+             return
+
+          for d in future.result()[0]:
+              self.discard(normalizedPathJoin(path, d.name))
+
+
+      def close(self):
+          self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+
+
+# Generator traversing root without recursion. The basis of fsTraversalIterative() and walk().
+#
+# Yields the encountered files and directories in exactly the same order as fsTraversal()
+# visits them, as events:
+#
+#   ('files', path, level, files)        files: the os.DirEntry objects of the files in path
+#   ('directory', path, level, dEntry)   dEntry: os.DirEntry of a subdirectory of path
+#   ('counts', token, (status, ldc, lfc, tdc, tfc))
+#
+# For 'files' events the consumer send()s the number of files that were not ignored; None
+# (e.g. a plain for loop) means all of them. For 'directory' events the consumer sends False
+# to signal that the directory is ignored: it is not counted and not traversed. Any other value
+# accepts the directory and is returned as token in its 'counts' event, which is generated
+# once the directory has been traversed (i.e. when fsTraversal() calls setLocalCounts()).
+#
+# Returns (as the generator's return value) the same (status, ldc, lfc, tdc, tfc) tuple
+# as fsTraversal().
+#
+# An explicit stack is used instead of recursion; very deep directory structures do not hit
+# python's recursion limit. Each stack frame holds only the not yet visited subdirectories
+# of one directory, so memory depends on the pending directories and not on the total
+# number of items.
+#
+# constraints is the visitor (or TraversalCriteria) whose criteria are checked (see
+# checkTraversalConstraints()). If a DirectoryPrefetcher is given, directory listings are
+# taken from it.
+#
+# Stack frames are lists: [path, level, dirs, next dir index, ldc, lfc, tdc, tfc, token of directory being traversed]
+# If a list is given as frames, it is used as the stack, so that the caller can inspect it
+# (see fsTraversalResumable()). If it is not empty, the traversal continues from these frames
+# instead of starting at root.
+
+def iterTree(root, lvl, constraints, prefetcher=None, frames=None):
+
+    nonRecursive = constraints.getCriterium('nonRecursive', False)
+
+    # Opens directory path i.e. checks constraints, lists it and yields its files.
+    # Returns a new frame or a result tuple if the directory is not to be traversed.
+    def openDirectory(path, level):
+        if not checkTraversalConstraints(path, level, constraints):
+           if prefetcher is not None:
+              prefetcher.discard(path)
+           return(None, (0, 0, 0, 0, 0))
+
+        if prefetcher is None:
+           status, dirs, files = listTraversedDirectory(path)
+        else:
+           status, dirs, files = listTraversedDirectory(path, lambda p: prefetcher.take(p, level))
+        if dirs is None:
+           return(None, (status, 0, 0, 0, 0))
+
+        lfc = len(files)
+        if lfc > 0:
+           nVisited = yield ('files', path, level, files)
+           if nVisited is not None:
+              lfc = nVisited
+
+        return([path, level, dirs, 0, 0, lfc, 0, lfc, None], None)
+
+
+    if frames is not None and len(frames) > 0:
+       stack = frames
+    else:
+       frame, result = yield from openDirectory(root, lvl)
+       if frame is None:
+          return(result)
+
+       stack = [] if frames is None else frames
+       stack.append(frame)
+
+    while True:
+          frame = stack[-1]
+          
+          if frame[3] < len(frame[2]):
+             dEntry = frame[2][frame[3]]
+             # Release entry; it is not needed anymore
+             frame[2][frame[3]] = None
+             frame[3] += 1
+
+             token = yield ('directory', frame[0], frame[1], dEntry)
+             if token is False:
+                if prefetcher is not None:
+                   prefetcher.discard(normalizedPathJoin(frame[0], dEntry.name))
+                continue
+
+             frame[4] += 1
+             frame[6] += 1
+             if nonRecursive:
+                continue
+
+             frame[8] = token
+             subFrame, result = yield from openDirectory(normalizedPathJoin(frame[0], dEntry.name), frame[1]+1)
+             if subFrame is not None:
+                # Go into subdirectory. Counts are propagated when it is exhausted. 
+                stack.append(subFrame)
+                continue
+
+             # Nothing to traverse in the subdirectory; propagate result immediately
+          else:
+             # All subdirectories of the frame visited.
+             stack.pop()
+             result = (0, frame[4], frame[5], frame[6], frame[7])
+             if len(stack) == 0:
+                return(result)
+
+          # Propagate counts of the exhausted directory to its parent frames. If the
+          # status signals an error, unwind the stack the same way fsTraversal() returns.
+          while True:
+                parent = stack[-1]
+                yield ('counts', parent[8], result)
+                parent[8] = None
+                parent[6] += result[3]
+                parent[7] += result[4]
+                if result[0] >= 0:
+                   break
+
+                stack.pop()
+                result = (result[0], parent[4], parent[5], parent[6], parent[7])
+                if len(stack) == 0:
+                   return(result)
+
+
+
+
+# Non recursive version of fsTraversal().
+#
+# Visits files and directories in exactly the same order, calls the same visitor
+# methods and returns the same (status, ldc, lfc, tdc, tfc) tuple as fsTraversal(), by
+# handing the events of iterTree() to the visitor.
+# If a DirectoryPrefetcher is given, directory listings are taken from it.
+
+def fsTraversalIterative(root, lvl, visitor=None, prefetcher=None):
+
+    events = iterTree(root, lvl, visitor, prefetcher)
+    try:
+       event = next(events)
+       while True:
+             if event[0] == 'files':
+                event = events.send(visitFiles(event[1], event[2], event[3], visitor))
+             elif event[0] == 'directory':
+                dH = visitDirectory(event[1], event[2], event[3], visitor)
+                event = events.send(False if dH.ignored else dH)
+             else:
+                counts = event[2]
+                event[1].setLocalCounts(counts[1], counts[2], counts[3], counts[4], visitor)
+                event = next(events)
+    except StopIteration as si:
+       return(si.value)
+    finally:
+       events.close()
+
+
+
+
+# The criteria of a visitor, without maxTime (see fsTraversalResumable()).
+class UntimedConstraints:
+
+      def __init__(self, visitor):
+          self.visitor = visitor
+
+      def getCriterium(self, cname='', default=-1):
+          if cname == 'maxTime':
+             return(default)
+          return(self.visitor.getCriterium(cname, default))
+
+      def __getattr__(self, name):
+          return(getattr(self.visitor, name))
+
+
+
+
+# Resumable version of fsTraversalIterative() (see checkpoint.py).
+#
+# The state of the traversal is written to checkpointPath every interval seconds and when
+# maxTime is reached. If resume is True and a checkpoint made with the same root, visitor
+# and criteria exists, the traversal continues from it. Once the traversal completes, the
+# checkpoint is removed.
+#
+# maxTime is checked before a directory is visited instead of before it is traversed, i.e.
+# where the traversal can be resumed; criteriaException(-10) is raised after the checkpoint
+# has been written. Each run visits at least one directory. Chained runs hence visit every
+# file and directory once, in the same order as a single run.
+
+def fsTraversalResumable(root, lvl, visitor, checkpointPath, resume=False, interval=60):
+
+    maxTime = visitor.getCriterium('maxTime', -1)
+    key = checkpoint.configurationKey(root, lvl, visitor)
+    frames = []
+    if resume:
+       saved = checkpoint.load(checkpointPath)
+       if saved is None:
+          clrprint.clrprint(f'[{getCurrentDateTime()}] No checkpoint [{checkpointPath}]. Starting from [{root}].', clr='yellow')
+       elif saved['key'] != key:
+          clrprint.clrprint(f'[WARNING] Checkpoint [{checkpointPath}] made for another directory or with other criteria. Starting from [{root}].', clr='yellow')
+       else:
+          frames = checkpoint.restoreFrames(saved['frames'])
+          visitor.restoreCheckpoint(saved['state'])
+          if visitor.traversalGuard is not None and saved.get('guard') is not None:
+             visitor.traversalGuard.visited = saved['guard'].visited
+          clrprint.clrprint(f'[{getCurrentDateTime()}] Resuming from checkpoint [{checkpointPath}] at [{frames[-1][0] if len(frames) > 0 else root}].', clr='yellow')
+
+    started = time.perf_counter()
+    lastSaved = started
+    visited = False
+    events = iterTree(root, lvl, UntimedConstraints(visitor), frames=frames)
+    try:
+       event = next(events)
+       while True:
+             if event[0] == 'files':
+                event = events.send(visitFiles(event[1], event[2], event[3], visitor))
+             elif event[0] == 'directory':
+                now = time.perf_counter()
+                timeUp = visited and maxTime > 0 and now - started >= maxTime
+                if timeUp or now - lastSaved >= interval:
+                   checkpoint.save(checkpointPath, key, frames, event[3], visitor, visitor.traversalGuard)
+                   lastSaved = now
+                   if timeUp:
+                      raise handlers.criteriaException(-10, f'Maximum time constraint of {maxTime}s reached. Checkpoint saved in [{checkpointPath}]; resume with -RES.')
+
+                visited = True
+                dH = visitDirectory(event[1], event[2], event[3], visitor)
+                event = events.send(False if dH.ignored else dH)
+             else:
+                counts = event[2]
+                event[1].setLocalCounts(counts[1], counts[2], counts[3], counts[4], visitor)
+                event = next(events)
+    except StopIteration as si:
+       checkpoint.remove(checkpointPath)
+       return(si.value)
+    finally:
+       events.close()
+
+
+
+
+# Provides getCriterium() for traversals that are not driven by a visitor (see walk()).
+class TraversalCriteria:
+
+      def __init__(self, criteria={}):
+          self.criteria = criteria
+          self.file_count = 0
+          self.directory_count = 0
+          self.traversalGuard = None
+
+      def getCriterium(self, cname='', default=-1):
+          return(self.criteria.get(cname, default))
+
+
+
+
+# Generator yielding a handlers.TraversalEntry for each file and directory in root that
+# complies to criteria (see handlers.CompiledCriteria), lazily and in the same order as
+# fsTraversal() visits them. Directories that don't comply are not traversed.
+#
+# Nothing is kept in memory besides the traversal stack (see iterTree()), so results can
+# be filtered, counted or written out with constant memory. Breaking out of the loop stops
+# the traversal. Metadata (entry.meta) is only stat-ed if the criteria or the caller access it.
+#
+# Criteria maxTime, maxFiles and maxDirs do not raise criteriaException; the generator
+# simply stops. If status (a dictionary) is given, the keys 'code' and 'message' are set
+# when the generator finishes (see asyncWalker.walk()).
+#
+#    for entry in functionality.walk('some/dir', {'fileinclusionPattern':r'\.pdf$'}):
+#        print(entry.path, entry.meta['size'])
+
+def walk(root, criteria={}, status=None):
+    global timeStarted
+
+    if status is None:
+       status = {}
+    status['code'] = 0
+    status['message'] = ''
+
+    maxFiles = criteria.get('maxFiles', -1)
+    maxDirs = criteria.get('maxDirs', -1)
+
+    constraints = TraversalCriteria(criteria)
+    compiled = handlers.CompiledCriteria(criteria)
+    timeStarted = None
+    constraints.traversalGuard = DirectoryGuard.forTraversal(root, 1, constraints)
+    events = iterTree(root, 1, constraints)
+    try:
+       event = next(events)
+       while True:
+             if event[0] == 'files':
+                path, level = event[1], event[2]
+                nVisited = 0
+                for f in event[3]:
+                    fMeta = lazyEntryInfo(f)
+                    if compiled.fileFailure(f.name, fMeta) is not None:
+                       continue
+
+                    if maxFiles > 0 and constraints.file_count >= maxFiles:
+                       status['code'] = -9
+                       status['message'] = 'Maximum number of FILES reached.'
+                       return
+
+                    constraints.file_count += 1
+                    nVisited += 1
+                    yield handlers.TraversalEntry('file', f.name, normalizedPathJoin(path, f.name), level, path, fMeta)
+
+                event = events.send(nVisited)
+             elif event[0] == 'directory':
+                path, level, dEntry = event[1], event[2], event[3]
+                dMeta = lazyEntryInfo(dEntry)
+                if compiled.directoryFailure(dEntry.name) is not None:
+                   event = events.send(False)
+                   continue
+
+                if maxDirs > 0 and constraints.directory_count >= maxDirs:
+                   status['code'] = -10
+                   status['message'] = 'Maximum number of DIRECTORIES reached.'
+                   return
+
+                constraints.directory_count += 1
+                yield handlers.TraversalEntry('directory', dEntry.name, normalizedPathJoin(path, dEntry.name), level, path, dMeta)
+                event = events.send(True)
+             else:
+                event = next(events)
+    except StopIteration:
+       return
+    except handlers.criteriaException as ce:
+       status['code'] = ce.errorCode
+       status['message'] = str(ce)
+    finally:
+       events.close()
+
+
+
+
+# Executed in worker processes of fsTraversalSharded().
+# Traverses subdirectory path (found at level lvl) of fileSystem using the shard visitor.
+# Output is captured and returned, so that the parent can display it in the correct order.
+def traverseShard(visitor, path, lvl, fileSystem):
+    fileSystems.use(fileSystem)
+    out = io.StringIO()
+    error = None
+    with redirect_stdout(out):
+         try:
+            res = traverse(path, visitor, lvl+1)
+         except handlers.criteriaException as ce:
+            res = (ce.errorCode, -1, -1, visitor.directory_count, visitor.file_count)
+            error = (ce.errorCode, str(ce))
+
+         state = visitor.shardResult(lvl)
+
+    return({'counts':res, 'error':error, 'output':out.getvalue(), 'state':state})
+
+
+# Each worker process needs its own random state (used for ids and colors)
+def shardInitializer():
+    random.seed()
+
+
+
+# Sharded version of fsTraversal() using multiple processes.
+#
+# The top level subdirectories of root are traversed in a process pool, each by its
+# own visitor (see Visitor.shardVisitor()). Files and directories of root itself are
+# visited in this process and shard results are merged into visitor (see
+# Visitor.mergeShard()) in the same order a serial traversal would visit them. This
+# allows cpu bound visitors (regular expressions, templates) to use all cores.
+#
+# Criteria maxFiles and maxDirs can not be checked across processes and maxTime is checked
+# in each process separately; see traverse().
+
+def fsTraversalSharded(root, lvl, visitor, processes):
+
+    if not checkTraversalConstraints(root, lvl, visitor):
+       return(0, 0, 0, 0, 0)
+
+    status, dirs, files = listTraversedDirectory(root)
+    if dirs is None:
+       return(status, 0, 0, 0, 0)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes, initializer=shardInitializer) as pool:
+         # Submit all shards; they are traversed while this process handles root
+         shards = [pool.submit(traverseShard, visitor.shardVisitor(normalizedPathJoin(root, d.name), lvl), normalizedPathJoin(root, d.name), lvl, fileSystems.current) for d in dirs]
+
+         lfc = visitFiles(root, lvl, files, visitor)
+         tfc = lfc
+
+         ldc = 0
+         tdc = 0
+         try:
+            for encounteredDirectory, shard in zip(dirs, shards):
+                dH = visitDirectory(root, lvl, encounteredDirectory, visitor)
+                if dH.ignored:
+                   shard.cancel()
+                   continue
+
+                ldc += 1
+                tdc += 1
+
+                result = shard.result()
+                print(result['output'], end='')
+                subDirData = result['counts']
+                # Merged before the counts are set, i.e. before the directory is complete
+                visitor.mergeShard(dH.path, result['state'])
+                dH.setLocalCounts(subDirData[1], subDirData[2], subDirData[3], subDirData[4], visitor)
+                tdc += subDirData[3]
+                tfc += subDirData[4]
+
+                if result['error'] is not None:
+                   raise handlers.criteriaException(result['error'][0], result['error'][1])
+
+                if subDirData[0] < 0:
+                   return(subDirData[0], ldc, lfc, tdc, tfc)
+         finally:
+            for shard in shards:
+                shard.cancel()
+
+    return 0, ldc, lfc, tdc, tfc
+
+
+
+
+# Version of fsTraversal() that reuses the results of unchanged subdirectories
+# stored in an exportCache.ExportCache.
+#
+# Each subdirectory is traversed by its own visitor (see Visitor.shardVisitor()), the
+# same way fsTraversalSharded() does but in this process, and its result is stored
+# in the cache. Subdirectories whose stored result is still valid are not traversed
+# at all; the stored result is merged instead. The contents of subdirectories are
+# merged as markers that are expanded once the export is done (see exportCache.py).
+#
+# Like iterTree(), directories are kept on an explicit stack (see CachedDirectory) so
+# that directory structures of any depth can be exported.
+#
+# children: if a list, the paths of the traversed subdirectories of root are appended to it.
+# top: True if visitor is the visitor of the export, False for subdirectory visitors.
+
+def fsTraversalCached(root, lvl, visitor, cache, children=None, top=True):
+
+    frame, counts = openCachedDirectory(root, lvl, visitor, children, top)
+    if frame is None:
+       return(counts)
+
+    stack = [frame]
+    while True:
+          frame = stack[-1]
+          status = 0
+          if frame.pending is not None:
+             # The subdirectory has just been traversed; counts are its counts
+             dH, mtime, subVisitor, subChildren = frame.pending
+             frame.pending = None
+             state = subVisitor.shardResult(frame.lvl)
+             if mtime is not None:
+                cache.store(dH.path, frame.lvl, mtime, subChildren, state, counts)
+             status = frame.merge(dH, counts, cachedState(dH.path, frame, cache, state, state['html']))
+
+          while status >= 0 and frame.pending is None and frame.next < len(frame.dirs):
+                encounteredDirectory = frame.dirs[frame.next]
+                frame.next += 1
+                dH = visitDirectory(frame.root, frame.lvl, encounteredDirectory, frame.visitor)
+                if dH.ignored:
+                   continue
+
+                frame.ldc += 1
+                frame.tdc += 1
+
+                if frame.children is not None:
+                   frame.children.append(dH.path)
+
+                try:
+                   # Stat before listing: changes made in between are caught by the next export
+                   mtime = fileSystems.current.stat(dH.path).st_mtime
+                except OSError as stEx:
+                   mtime = None
+
+                fragment = None
+                if mtime is not None:
+                   fragment = cache.valid(dH.path, frame.lvl, mtime, lambda p: fileSystems.current.stat(p).st_mtime)
+
+                if fragment is not None:
+                   cache.use(dH.path, frame.lvl)
+                   state = {'file_count':fragment.totals[0], 'directory_count':fragment.totals[1], 'nIgnored':fragment.totals[2]}
+                   if len(fragment.totals) > 3:
+                      state['usage'] = fragment.totals[3]
+                   status = frame.merge(dH, fragment.counts, cachedState(dH.path, frame, cache, state, fragment.html))
+                   continue
+
+                subVisitor = frame.visitor.shardVisitor(dH.path, frame.lvl)
+                subVisitor.traversalGuard = frame.visitor.traversalGuard
+                subChildren = []
+                subFrame, counts = openCachedDirectory(dH.path, frame.lvl+1, subVisitor, subChildren, False)
+                frame.pending = (dH, mtime, subVisitor, subChildren)
+                if subFrame is not None:
+                   stack.append(subFrame)
+
+          if frame.pending is not None:
+             continue
+
+          # All subdirectories done, or one of them returned a negative status
+          stack.pop()
+          counts = (status, frame.ldc, frame.lfc, frame.tdc, frame.tfc)
+          if len(stack) == 0:
+             return(counts)
+
+
+
+# A directory being traversed by fsTraversalCached()
+class CachedDirectory:
+      __slots__ = ('root', 'lvl', 'visitor', 'children', 'top', 'dirs', 'next', 'ldc', 'lfc', 'tdc', 'tfc', 'pending')
+
+      def __init__(self, root, lvl, visitor, children, top, dirs, lfc):
+          self.root = root
+          self.lvl = lvl
+          self.visitor = visitor
+          self.children = children
+          self.top = top
+          self.dirs = dirs
+          # Index of the next subdirectory in dirs
+          self.next = 0
+          self.ldc = 0
+          self.lfc = lfc
+          self.tdc = 0
+          self.tfc = lfc
+          # (dH, mtime, subVisitor, subChildren) of the subdirectory being traversed
+          self.pending = None
+
+
+      # Merges the counts and state of subdirectory dH. Returns the status of the subdirectory.
+      def merge(self, dH, counts, state):
+          self.visitor.mergeShard(dH.path, state)
+          dH.setLocalCounts(counts[1], counts[2], counts[3], counts[4], self.visitor)
+          self.tdc += counts[3]
+          self.tfc += counts[4]
+          return(counts[0])
+
+
+
+# Visits the files of root. Returns (CachedDirectory, None) or, if root is not traversed,
+# (None, the counts of root).
+def openCachedDirectory(root, lvl, visitor, children, top):
+    if not checkTraversalConstraints(root, lvl, visitor):
+       return(None, (0, 0, 0, 0, 0))
+
+    status, dirs, files = listTraversedDirectory(root)
+    if dirs is None:
+       return(None, (status, 0, 0, 0, 0))
+
+    lfc = visitFiles(root, lvl, files, visitor)
+    return(CachedDirectory(root, lvl, visitor, children, top, dirs, lfc), None)
+
+
+
+# Completes state, the state to merge (see Visitor.mergeShard()) of subdirectory path of
+# frame, either from the cache or from traversing it. html is the contents of the subdirectory.
+def cachedState(path, frame, cache, state, html):
+    # Subdirectory visitors keep only their own directories; the export gets all of them.
+    state['directoryList'] = cache.directoryList(path, frame.lvl) if frame.top and frame.visitor.directoryList is not None else []
+    state['html'] = None if html is None else exportCache.marker(path, frame.lvl)
+    return(state)
+
+
+
+
+# Traverses root using the traversal implementation specified in the criteria
+# of the visitor (see fsTraversal() and fsTraversalIterative()).
+# If criterium index is set and root has been indexed in that database, the index is
+# traversed instead of the directory (unless criterium liveWalk is set).
+# If criterium workers is > 0, directories are listed by that many threads.
+# If criterium processes is > 0, top level subdirectories are traversed by that many
+# processes, given that the visitor supports it.
+# Criteria uniqueDirectories and oneFileSystem are enforced by a DirectoryGuard.
+def traverse(root, visitor, lvl=1):
+    visitor.traversalGuard = DirectoryGuard.forTraversal(root, lvl, visitor)
+
+    checkpointPath = visitor.getCriterium('checkpoint', '')
+    if checkpointPath not in (None, ''):
+       if visitor.checkpointState() is None:
+          clrprint.clrprint('[WARNING] Visitor does not support checkpoints. Traversing without.', clr='yellow')
+       else:
+          return(fsTraversalResumable(root, lvl, visitor, checkpointPath, visitor.getCriterium('resume', False), visitor.getCriterium('checkpointInterval', 60)))
+
+    indexPath = visitor.getCriterium('index', '')
+    if indexPath not in (None, '') and not visitor.getCriterium('liveWalk', False):
+       if os.path.isfile(indexPath):
+          index = dirIndex.DirectoryIndex(indexPath)
+          try:
+             if index.contains(root):
+                return(fsTraversalIterative(root, lvl, visitor, index))
+          finally:
+             index.close()
+
+       clrprint.clrprint(f'[WARNING] Directory [{root}] not in index [{indexPath}]. Traversing directory.', clr='yellow')
+
+    nProcesses = visitor.getCriterium('processes', 0)
+    if nProcesses is not None and nProcesses > 0:
+       if visitor.getCriterium('nonRecursive', False) or visitor.getCriterium('maxFiles', -1) > 0 or visitor.getCriterium('maxDirs', -1) > 0 or visitor.getCriterium('guiwindow', None) is not None:
+          clrprint.clrprint('[WARNING] Sharded traversal not supported with -NR, -nf, -nd or -P. Traversing in one process.', clr='yellow')
+       elif visitor.shardVisitor(root, lvl) is None:
+          clrprint.clrprint('[WARNING] Visitor does not support sharded traversal. Traversing in one process.', clr='yellow')
+       else:
+          return(fsTraversalSharded(root, lvl, visitor, nProcesses))
+
+    nWorkers = visitor.getCriterium('workers', 0)
+    if nWorkers is not None and nWorkers > 0:
+       maxLevels = lvl if visitor.getCriterium('nonRecursive', False) else visitor.getCriterium('maxLevels', -1)
+       prefetcher = DirectoryPrefetcher(nWorkers, maxLevels, stat=len(visitor.neededMetadata()) > 0)
+       prefetcher.submit(root, lvl)
+       try:
+          return(fsTraversalIterative(root, lvl, visitor, prefetcher))
+       finally:
+          prefetcher.close()
+
+    if visitor.getCriterium('iterative', False):
+       return(fsTraversalIterative(root, lvl, visitor))
+
+    return(fsTraversal(root, lvl, visitor))
+
+
+
+
 
 ###########################################################################
 #
@@ -258,66 +1127,49 @@ def fsTraversal(root, lvl, visitor=None):
 
 
 
-# TODO: Refactor
-@timeit
-def export(criteria={}):
-    global timeStarted
+# Applies replacements, pairs of (pseudovariable, value), to text in the given order.
+def replacePseudovariables(text, replacements):
+    for k, v in replacements:
+        text = text.replace(k, v)
+    return(text)
 
-    timeStarted = None
-    if not os.path.isdir(criteria.get('directory', 'testDirectories/testDir0')):
-       clrprint.clrprint(f'[Error] Not such directory [{criteria.get("directory", "testDirectories/testDir0")}]', clr="red")
-       return((-2, 0, 0, 0, 0))
 
-    try: 
-       dTemp, fTemp, pTemp = readTemplateFile(criteria.get('template', 'templates/htmlTemplate.tmpl'))
-    except Exception as tmpException:
-       clrprint.clrprint(f'[Error] Error loading template file [{criteria.get("template", "templates/htmlTemplate.tmpl")}]', clr="red") 
-       sys.exit(-4)
-       
-    # Create visitor
-    hE = handlers.ExportVisitor(dTemp, fTemp, pTemp, criteria)
-    
 
-    
-    # Add starting directory to stack
-    hE.stack.append({'type':'directory',
-                     'collapsed':False,
-                     'level':0,
-                     'name':criteria.get('directory', 'testDirectories/testDir0'),
-                     'dname':criteria.get('directory', 'testDirectories/testDir0'),
-                     'html':dTemp.replace('${ID}', '-8888').replace('${DIRNAME}', criteria.get('directory', 'testDirectories/testDir0')).replace('${PATH}', criteria.get('directory', 'testDirectories/testDir0')).replace('${RLVLCOLOR}', random.choice(fontColorPalette)).replace('${LEVEL}', '0')})
+# Copies the text of file f to write(), applying replacements (see replacePseudovariables()).
+# If stream is given, the counts of streamed directories are inserted first (see
+# handlers.ExportStream).
+# f is read in chunks; a pseudovariable or marker cut at the end of a chunk is kept for the
+# next one.
+def copyReplacing(f, write, replacements, stream=None, chunkSize=1<<16):
+    f.seek(0)
+    carry = ''
+    while True:
+          chunk = f.read(chunkSize)
+          if chunk == '':
+             break
 
-    try:
-      res=fsTraversal(criteria.get('directory', 'testDirectories/testDir0'), 1, visitor=hE)
-    except handlers.criteriaException as ce:
-      clrprint.clrprint('Terminated due to criteriaException. Message:', str(ce), clr='red')
-      res = (ce.errorCode, -1, -1, hE.directory_count, hE.file_count) # TODO: check and fix this.
-    else:
-      clrprint.clrprint(f'[{getCurrentDateTime()}] Terminated.', clr='yellow')
-      
-    # Final merge
-    hE.collapse(final=True)
+          text = carry + chunk
+          cut = len(text)
+          i = text.rfind('$')
+          if i >= 0 and '}' not in text[i:] and len(text) - i < 64:
+             cut = i
+          if stream is not None and text.count('\x00') % 2 == 1:
+             cut = min(cut, text.rfind('\x00'))
+          text, carry = text[:cut], text[cut:]
+          if stream is not None:
+             text = stream.insertCounts(text)
+          write(replacePseudovariables(text, replacements))
 
-    # if no directories and no files are in the initial folder,
-    # generate an empty result for the SUBDIRECTORY template variable.  
-    if res[3] == 0 and res[4] == 0:
-       subD = {'html': ''}
-    else:   
-       subD = hE.stack.pop()
+    if stream is not None:
+       carry = stream.insertCounts(carry)
+    write(replacePseudovariables(carry, replacements))
 
 
-    #
-    # Start replacing pseudovariables to prepare saving to file
-    #
-    
 
-    fullTree = hE.stack.pop()
-    fullTree['html'] = fullTree['html'].replace('${LEVELTABS}', "")
 
-    
-    #
-    # Preparing some things before replacing
-    #
+# Replacements of the page template related to the page, in the order they are made
+# (see export()).
+def pageReplacements(criteria):
 
     # Replacing external css files in page template.
     # Note: if many css files are specified, separate them with a comma (,)
@@ -329,41 +1181,206 @@ def export(criteria={}):
     # psudovariable ${CRITERIA}
     excludeKeys = ['guiwindow', 'guiprogress', 'guistatus']
 
-
-    ########################################################
-    # Start actual replacing
-    ########################################################
-    
-    # Replace psudovariables related to traversal
-
-    rootText = criteria.get('directory', 'testDirectories/testDir0')
-    if criteria.get('traversalRootDir', '') != '':
-       rootText = criteria.get('traversalRootDir', '')
-       
-    h = pTemp.replace('${SUBDIRECTORY}', subD['html']).replace('${TRAVERSALROOTDIR}', rootText).replace('${LNDIRS}', str(res[1])).replace('${LNFILES}', str(res[2])).replace('${NDIRS}', str(res[3])).replace('${NFILES}', str(res[4])).replace('${TERMINATIONCODE}', str(res[0])).replace('${TREE}', fullTree['html']).replace("${OPENSTATE}", "open").replace("${CRITERIA}", json.dumps({k: criteria[k] for k in set(list(criteria.keys())) - set(excludeKeys)}))
-    # TODO: not yet supported
-    h = h.replace('${LISTOFDIRECTORIES}', '')
-    
-    # Replace psudovariables related to page
-
     # TODO: Move this higher so that the intro can contain pseudovariables
     intro = criteria.get('introduction', '')
     if (os.path.isfile(criteria.get('introduction', ''))):
         with open(criteria.get('introduction', ''), 'r') as file:
              intro = file.read() 
-    
-    h = h.replace('${TITLE}', criteria.get('title', '')).replace('${INTROTEXT}', intro)
-    h = h.replace('${CSS}', cssImports)
 
-    
+    # TODO: ${LISTOFDIRECTORIES} not yet supported
+    page = [('${OPENSTATE}', 'open'), ('${CRITERIA}', json.dumps({k: criteria[k] for k in set(list(criteria.keys())) - set(excludeKeys)})), ('${LISTOFDIRECTORIES}', ''),
+            ('${TITLE}', criteria.get('title', '')), ('${INTROTEXT}', intro), ('${CSS}', cssImports), ('${BREADCRUMB}', criteria.get('breadcrumb', ''))]
 
     # Should remaining ${SUBDIRECTORY} -signifying empty directories - be replaced?
     if criteria.get('replaceEmptySubdirs', False):
-       h = h.replace('${SUBDIRECTORY}', '')
+       page.append(('${SUBDIRECTORY}', ''))
+
+    return(page)
+
+
 
-    # Replacements done. Save to file
-    with open(criteria.get('outputFile', 'index'+'-'+getCurrentDateTime().replace(':', '-') + '.html'), 'w', encoding='utf8') as sf:
-         sf.write(h)
+# Replacements related to the traversal; res as returned by traverse().
+def countReplacements(criteria, res):
+    rootText = criteria.get('directory', 'testDirectories/testDir0')
+    if criteria.get('traversalRootDir', '') != '':
+       rootText = criteria.get('traversalRootDir', '')
+
+    return([('${TRAVERSALROOTDIR}', rootText), ('${LNDIRS}', str(res[1])), ('${LNFILES}', str(res[2])), ('${NDIRS}', str(res[3])), ('${NFILES}', str(res[4])), ('${TERMINATIONCODE}', str(res[0]))])
+
+
+
+
+# TODO: Refactor
+# The page is written to criterium outputFile, or to out (a text file) if given. outputFile
+# - writes it to stdout.
+#
+# Directories are written to a temporary file as they are visited (see handlers.ExportStream),
+# so memory depends on the depth of the tree and not on its size. Once the traversal is done,
+# and the counts of the page are known, the page template is written with the temporary
+# file in place of ${SUBDIRECTORY} (and ${TREE}).
+# Directory templates containing ${SUBDIRECTORY} more than once are kept in memory until
+# complete, and so are all directories with checkpoints (-CP).
+#
+# With criterium pageLevels, the export is split into pages (see exportPages()).
+# links: the pages linked from this page, if it is one (see handlers.PageExportVisitor).
+# totals: if a list, the [size, allocated] of the starting directory is appended to it, if
+#         the templates show disk usage.
+@timeit
+def export(criteria={}, out=None, links=None, totals=None):
+    global timeStarted
+
+    timeStarted = None
+    if not fileSystems.current.isdir(criteria.get('directory', 'testDirectories/testDir0')):
+       clrprint.clrprint(f'[Error] Not such directory [{criteria.get("directory", "testDirectories/testDir0")}]', clr="red")
+       return((-2, 0, 0, 0, 0))
+
+    if criteria.get('exportFormat', 'template') == 'virtual':
+       return(exportVirtualTree(criteria, out))
+
+    if criteria.get('exportFormat', 'template') in handlers.RECORDFORMATS:
+       return(exportRecords(criteria, out))
+
+    try: 
+       dTemp, fTemp, pTemp = readTemplateFile(criteria.get('template', 'templates/htmlTemplate.tmpl'))
+    except Exception as tmpException:
+       clrprint.clrprint(f'[Error] Error loading template file [{criteria.get("template", "templates/htmlTemplate.tmpl")}]', clr="red") 
+       sys.exit(-4)
+
+    if (criteria.get('pageLevels', 0) or 0) > 0:
+       if out is not None or criteria.get('outputFile', '') == '-' or criteria.get('nonRecursive', False) or criteria.get('checkpoint', '') not in (None, ''):
+          clrprint.clrprint('[WARNING] Pages not supported with -o -, -NR or -CP. Exporting a single page.', clr='yellow')
+       else:
+          return(exportPages(criteria))
+       
+    # Create visitor
+    if links is None:
+       hE = handlers.ExportVisitor(dTemp, fTemp, pTemp, criteria)
+    else:
+       hE = handlers.PageExportVisitor(dTemp, fTemp, pTemp, criteria, links)
+    separator = criteria.get('templateItemsSeparator', ' ')
+    lazyLevels = criteria.get('lazyLevels', 0) or 0
+
+    # Cache of rendered subdirectories, if given
+    cache = None
+    if criteria.get('exportCache', '') not in (None, ''):
+       if criteria.get('nonRecursive', False) or criteria.get('maxFiles', -1) > 0 or criteria.get('maxDirs', -1) > 0 or criteria.get('maxTime', -1) > 0 or criteria.get('uniqueDirectories', False):
+          clrprint.clrprint('[WARNING] Export cache not supported with -NR, -nf, -nd, -mxt or -UD. Exporting without cache.', clr='yellow')
+       else:
+          cache = exportCache.ExportCache(criteria.get('exportCache', ''), exportCache.configurationKey((dTemp, fTemp), criteria), criteria.get('directory', 'testDirectories/testDir0'))
+
+    page = pageReplacements(criteria)
+
+    outputFile = criteria.get('outputFile', 'index'+'-'+getCurrentDateTime().replace(':', '-') + '.html')
+    if out is None and outputFile == '-':
+       out = sys.stdout
+
+    # Contents of the starting directory. Cached subdirectories are expanded while written.
+    spoolFile = compression.spool(criteria, encoding='utf8')
+    stream = handlers.ExportStream(spoolFile.write if cache is None else lambda html: cache.write(html, spoolFile.write), separator)
+    spool = stream.spool()
+
+    # Add starting directory to stack. Checkpoints hold the complete state of the
+    # traversal, so its items are kept until the end in that case.
+    root = handlers.ExportFrame(0, criteria.get('directory', 'testDirectories/testDir0'),
+                                dTemp.replace('${ID}', '-8888').replace('${DIRNAME}', criteria.get('directory', 'testDirectories/testDir0')).replace('${PATH}', criteria.get('directory', 'testDirectories/testDir0')).replace('${RLVLCOLOR}', random.choice(fontColorPalette)).replace('${LEVEL}', '0'))
+    if criteria.get('checkpoint', '') in (None, ''):
+       root.dirs = spool
+       if dTemp.count('${SUBDIRECTORY}') == 1:
+          hE.stream = stream
+          # Grows with the tree; ${LISTOFDIRECTORIES} is not supported yet
+          hE.directoryList = None
+    hE.stack.append(root)
+
+    # Contents of directories every lazyLevels levels in shards of their own, loaded when
+    # opened (see lazyExport.py). Written by threads as the directories are complete.
+    shards = None
+    if lazyLevels > 0:
+       if hE.stream is None or cache is not None or out is not None or (criteria.get('processes', 0) or 0) > 0:
+          clrprint.clrprint('[WARNING] Lazy loading not supported with -XC, -MP, -CP, -o - or directory templates without exactly one ${SUBDIRECTORY}. Exporting inline.', clr='yellow')
+       else:
+          shards = lazyExport.ExportShards(os.path.splitext(compression.plainPath(outputFile, criteria))[0] + '-shards', lambda f, write: copyReplacing(f, write, page, hE.stream), criteria.get('workers', 0) or 1)
+          stream.shards = shards
+          stream.shardLevels = lazyLevels
+          pTemp = lazyExport.withLoader(pTemp)
+          # Open directories would load their shards at once
+          page[0] = ('${OPENSTATE}', '')
+
+    try:
+      try:
+        if cache is None:
+           res=traverse(criteria.get('directory', 'testDirectories/testDir0'), hE)
+        else:
+           hE.traversalGuard = DirectoryGuard.forTraversal(criteria.get('directory', 'testDirectories/testDir0'), 1, hE)
+           res=fsTraversalCached(criteria.get('directory', 'testDirectories/testDir0'), 1, hE, cache)
+      except handlers.criteriaException as ce:
+        clrprint.clrprint('Terminated due to criteriaException. Message:', str(ce), clr='red')
+        res = (ce.errorCode, -1, -1, hE.directory_count, hE.file_count) # TODO: check and fix this.
+      else:
+        clrprint.clrprint(f'[{getCurrentDateTime()}] Terminated.', clr='yellow')
+
+      if links is not None:
+         res = hE.pageCounts(res)
+
+      # Final merge. The starting directory is the one on the stack: resumed traversals
+      # replace the stack with the one of the checkpoint (see ExportVisitor.restoreCheckpoint()).
+      hE.closeDirectories(root.level + 1)
+      root = hE.stack.pop()
+      if root.dirs is not spool:
+         for d in root.dirs:
+             spool.append(d)
+      for f in root.files[::-1]:
+          spool.append(f)
+
+      if cache is not None:
+         clrprint.clrprint(f'[{getCurrentDateTime()}] Export cache: {cache.rendered} directories rendered, {cache.reused} reused.', clr='yellow')
+
+
+      ########################################################
+      # Replacements, in the order they are made
+      ########################################################
+
+      # Disk usage of the starting directory, in the page template and ${TREE}
+      sizes = []
+      if hE.usage is not None:
+         t = hE.usage.totals(criteria.get('directory', 'testDirectories/testDir0'))
+         sizes = [('${DIRSIZE}', str(t[0])), ('${DIRALLOCATED}', str(t[1]))]
+         if totals is not None:
+            totals.append(t)
+
+      # Related to traversal; made before ${TREE} is inserted
+      counts = countReplacements(criteria, res)
+
+      # ${TREE} is the starting directory itself, its contents in place of its ${SUBDIRECTORY}
+      treeParts = root.html.split('${SUBDIRECTORY}') if len(spool) > 0 else [root.html]
+      treeReplacements = [('${LEVELTABS}', '')] + sizes + page
+
+      # Replacements done. Save to file
+      def writePage(sf):
+          for i, part in enumerate(re.split(r'(\$\{SUBDIRECTORY\}|\$\{TREE\})', pTemp)):
+              if i % 2 == 0:
+                 sf.write(replacePseudovariables(part, sizes + counts + page))
+              elif part == '${TREE}':
+                 for j, treePart in enumerate(treeParts):
+                     if j > 0:
+                        copyReplacing(spoolFile, sf.write, treeReplacements, hE.stream)
+                     sf.write(replacePseudovariables(treePart, treeReplacements))
+              # if no directories and no files are in the initial folder,
+              # generate an empty result for the SUBDIRECTORY template variable.
+              elif res[3] != 0 or res[4] != 0:
+                 copyReplacing(spoolFile, sf.write, counts + page, hE.stream)
+
+      if out is not None:
+         writePage(out)
+      else:
+         with compression.openOutput(outputFile, criteria, encoding='utf8') as sf:
+              writePage(sf)
+    finally:
+      if shards is not None:
+         shards.wait()
+      spoolFile.close()
+      stream.close()
+      if cache is not None:
+         cache.close()
 
     clrprint.clrprint(f'[{getCurrentDateTime()}] Total file count:{hE.file_count} Total directory count:{hE.directory_count}. Ignored:{hE.nIgnored}', clr='yellow')
   
@@ -373,6 +1390,303 @@ def export(criteria={}):
 
 
 
+# Worker processes of exportPages() get the file system once, not with every page
+def pageInitializer(fileSystem):
+    shardInitializer()
+    fileSystems.use(fileSystem)
+
+
+# Executed by the workers of exportPages(): exports one page (see export()). Output is
+# captured and returned, so that the pages are reported in order.
+def exportPage(criteria, links):
+    out = io.StringIO()
+    totals = []
+    with redirect_stdout(out):
+         counts = export(criteria, links=links, totals=totals)
+
+    return({'counts':counts, 'totals':totals[0] if len(totals) > 0 else None, 'output':out.getvalue()})
+
+
+
+# Exports the starting directory and every directory down to level pageLevels to pages of
+# their own (see pagedExport.py).
+#
+# The counts of a page are those of the pages it links to, so pages are exported the
+# deepest level first. Pages of the same level are independent of each other and exported
+# by -MP processes (in this process if 0); those of the last level, holding whole subtrees,
+# are where the time goes.
+#
+# With criterium pageSubtree, a directory relative to the starting directory, only the
+# pages of that subtree are exported again. Returns the counts of the top page.
+def exportPages(criteria={}):
+    root = criteria.get('directory', 'testDirectories/testDir0')
+    levels = criteria.get('pageLevels', 0)
+    maxLevels = criteria.get('maxLevels', -1)
+    outputFile = criteria.get('outputFile', 'index'+'-'+getCurrentDateTime().replace(':', '-') + '.html')
+    # Every page is compressed like the page of the starting directory, e.g. -o index.html.xz
+    if criteria.get('compress', '') in (None, '') and compression.codecOf(outputFile, criteria) is not None:
+       criteria = dict(criteria, compress=compression.codecOf(outputFile, criteria))
+    pages = pagedExport.ExportPages(root, outputFile, criteria)
+
+    top = pagedExport.pageParts(criteria.get('pageSubtree', '') or '')
+    if not fileSystems.current.isdir(pages.path(top)):
+       clrprint.clrprint(f'[Error] Not such directory [{pages.path(top)}]', clr="red")
+       return((-2, 0, 0, 0, 0))
+
+    if criteria.get('exportCache', '') not in (None, ''):
+       clrprint.clrprint('[WARNING] Export cache not supported with pages. Exporting without cache.', clr='yellow')
+
+    # Pages by level: (parts, parts of the subdirectories with pages)
+    compiledCriteria = handlers.CompiledCriteria(criteria)
+    byLevel = {}
+    pending = [top]
+    while len(pending) > 0:
+          parts = pending.pop()
+          subpages = []
+          if len(parts) < levels and (maxLevels <= 0 or len(parts) + 1 < maxLevels):
+             status, dirs, files = listTraversedDirectory(pages.path(parts))
+             for d in dirs or []:
+                 if compiledCriteria.directoryFailure(d.name) is None:
+                    subpages.append(parts + (d.name,))
+          byLevel.setdefault(len(parts), []).append((parts, subpages))
+          pending.extend(subpages)
+
+    clrprint.clrprint(f'[{getCurrentDateTime()}] Exporting {sum(len(p) for p in byLevel.values())} pages.', clr='yellow')
+
+    processes = criteria.get('processes', 0) or 0
+    pool = None
+    if processes > 0:
+       pool = concurrent.futures.ProcessPoolExecutor(max_workers=processes, initializer=pageInitializer, initargs=(fileSystems.current,))
+
+    results = {}
+    try:
+      for level in sorted(byLevel, reverse=True):
+          jobs = []
+          for parts, subpages in byLevel[level]:
+              c = handlers.shardCriteria(criteria)
+              c.update({'directory':pages.path(parts), 'outputFile':pages.file(parts), 'traversalRootDir':pages.rootDir(parts),
+                        'breadcrumb':pages.breadcrumb(parts), 'pageLevels':0, 'pageSubtree':'', 'exportCache':''})
+              if maxLevels > 0:
+                 c['maxLevels'] = maxLevels - len(parts)
+              if len(subpages) > 0:
+                 c['nonRecursive'] = True
+              links = {normalizedPathJoin(c['directory'], s[-1]): (pages.link(parts, s), results[s]['counts'][1:], results[s]['totals']) for s in subpages}
+
+              os.makedirs(os.path.dirname(c['outputFile']) or '.', exist_ok=True)
+              if pool is None:
+                 jobs.append((parts, exportPage(c, links)))
+              else:
+                 jobs.append((parts, pool.submit(exportPage, c, links)))
+
+          for parts, job in jobs:
+              results[parts] = job if pool is None else job.result()
+              print(results[parts]['output'], end='')
+    finally:
+      if pool is not None:
+         pool.shutdown(wait=True, cancel_futures=True)
+
+    return(results[top]['counts'])
+
+
+
+
+
+
+# Exports the tree as rows of compact JSON (see handlers.VirtualTreeVisitor) in place of
+# ${ROWS} of the page template; the page renders only the rows in view. The page template
+# of criterium template is used if it contains ${ROWS}, templates/virtualTemplate.tmpl
+# otherwise. Directory and file templates are not used.
+#
+# Rows are written to a temporary file as visited. Not used with -MP, -CP, -XC, -LZ and -PG.
+def exportVirtualTree(criteria={}, out=None):
+    try:
+       pTemp = readTemplateFile(criteria.get('template', 'templates/htmlTemplate.tmpl'))[2]
+       if '${ROWS}' not in pTemp:
+          pTemp = readTemplateFile('templates/virtualTemplate.tmpl')[2]
+    except Exception as tmpException:
+       clrprint.clrprint(f'[Error] Error loading template file [{criteria.get("template", "templates/htmlTemplate.tmpl")}]', clr="red")
+       sys.exit(-4)
+
+    if criteria.get('exportCache', '') not in (None, '') or (criteria.get('lazyLevels', 0) or 0) > 0 or (criteria.get('pageLevels', 0) or 0) > 0:
+       clrprint.clrprint('[WARNING] Export cache, lazy loading and pages not supported with virtual trees. Exporting without.', clr='yellow')
+
+    page = pageReplacements(criteria)
+    outputFile = criteria.get('outputFile', 'index'+'-'+getCurrentDateTime().replace(':', '-') + '.html')
+    if out is None and outputFile == '-':
+       out = sys.stdout
+
+    # Names that are not valid unicode (undecodable bytes) are written as JSON escapes
+    with compression.spool(criteria, encoding='utf8', errors='backslashreplace') as rowsFile:
+         hV = handlers.VirtualTreeVisitor(criteria.get('directory', 'testDirectories/testDir0'), criteria, rowsFile.write)
+         try:
+           res = traverse(criteria.get('directory', 'testDirectories/testDir0'), hV)
+         except handlers.criteriaException as ce:
+           clrprint.clrprint('Terminated due to criteriaException. Message:', str(ce), clr='red')
+           res = (ce.errorCode, -1, -1, hV.directory_count, hV.file_count)
+         else:
+           clrprint.clrprint(f'[{getCurrentDateTime()}] Terminated.', clr='yellow')
+
+         replacements = countReplacements(criteria, res) + page
+         def writePage(sf):
+             head, tail = pTemp.split('${ROWS}', 1)
+             sf.write(replacePseudovariables(head, replacements))
+             rowsFile.seek(0)
+             shutil.copyfileobj(rowsFile, sf, 1<<16)
+             sf.write(replacePseudovariables(tail, replacements))
+
+         if out is not None:
+            writePage(out)
+         else:
+            with compression.openOutput(outputFile, criteria, encoding='utf8') as sf:
+                 writePage(sf)
+
+    clrprint.clrprint(f'[{getCurrentDateTime()}] Total file count:{hV.file_count} Total directory count:{hV.directory_count}. Ignored:{hV.nIgnored}', clr='yellow')
+    return(res)
+
+
+
+
+
+
+# Exports one record per directory and file (see handlers.RecordExportVisitor) to criterium
+# outputFile (- for stdout) or out. Records are written as visited, through a buffer; no
+# templates are used. Not used with -CP, -XC, -LZ and -PG.
+def exportRecords(criteria={}, out=None):
+    try:
+       hR = handlers.RecordExportVisitor(criteria)
+    except ValueError as colEx:
+       clrprint.clrprint(f'[Error] {colEx}', clr='red')
+       return((-4, 0, 0, 0, 0))
+
+    if criteria.get('exportCache', '') not in (None, '') or (criteria.get('lazyLevels', 0) or 0) > 0 or (criteria.get('pageLevels', 0) or 0) > 0:
+       clrprint.clrprint('[WARNING] Export cache, lazy loading and pages not supported with record exports. Exporting without.', clr='yellow')
+
+    outputFile = criteria.get('outputFile', 'index'+'-'+getCurrentDateTime().replace(':', '-') + '.' + criteria.get('exportFormat'))
+    if out is None and outputFile == '-':
+       out = sys.stdout
+
+    f = None
+    try:
+      if out is None:
+         # Names that are not valid unicode (undecodable bytes) are written escaped
+         f = out = compression.openOutput(outputFile, criteria, buffering=1<<20, encoding='utf8', errors='backslashreplace', newline='')
+
+      hR.setOutput(out)
+      hR.writeHeader()
+      try:
+        res = traverse(criteria.get('directory', 'testDirectories/testDir0'), hR)
+      except handlers.criteriaException as ce:
+        clrprint.clrprint('Terminated due to criteriaException. Message:', str(ce), clr='red')
+        res = (ce.errorCode, -1, -1, hR.directory_count, hR.file_count)
+      else:
+        clrprint.clrprint(f'[{getCurrentDateTime()}] Terminated.', clr='yellow')
+    finally:
+      if f is not None:
+         f.close()
+
+    clrprint.clrprint(f'[{getCurrentDateTime()}] Total file count:{hR.file_count} Total directory count:{hR.directory_count}. Ignored:{hR.nIgnored}', clr='yellow')
+    return(res)
+
+
+
+
+
+
+###########################################################################
+# Index
+###########################################################################
+
+
+# Creates or refreshes the index (criterium index) of the directory.
+@timeit
+def refreshIndex(criteria={}):
+    root = criteria.get('directory', 'testDirectories/testDir0')
+    if not fileSystems.current.isdir(root):
+       clrprint.clrprint(f'[Error] Not such directory [{root}]', clr="red")
+       return(None)
+
+    index = dirIndex.DirectoryIndex(criteria.get('index', 'dirWalker.db'))
+    try:
+       stats = index.refresh(root)
+    finally:
+       index.close()
+
+    clrprint.clrprint(f'[{getCurrentDateTime()}] Indexed [{root}] in [{criteria.get("index", "dirWalker.db")}]. Directories listed:{stats["listed"]} unchanged:{stats["unchanged"]} removed:{stats["removed"]}. Files indexed:{stats["files"]}', clr='yellow')
+    return(stats)
+
+
+
+
+
+# Watches the directory (see watcher.py) and keeps its index (criterium index) up to date
+# until interrupted.
+# In export mode, the directory is exported again each time changes have settled. The
+# export cache (criterium exportCache) is used, so that only the changed directories
+# are rendered again.
+# In search mode, the query is answered from the index each time changes have settled;
+# interactive searches are answered from the index while it is being updated.
+# In usage mode, disk usage is shown again each time changes have settled.
+def watchDirectory(mode='export', cfg={}):
+    root = cfg.get('directory', 'testDirectories/testDir0')
+    if not fileSystems.current.isdir(root):
+       clrprint.clrprint(f'[Error] Not such directory [{root}]', clr="red")
+       return
+
+    if cfg.get('index', '') in (None, ''):
+       cfg['index'] = 'dirWalker.db'
+    cfg['liveWalk'] = False
+
+    # Files written here must not trigger changes themselves
+    ignore = [cfg['index'] + s for s in ('', '-wal', '-shm', '-journal')]
+    if mode == 'export':
+       if cfg.get('exportCache', '') in (None, ''):
+          cfg['exportCache'] = 'dirWalker-export.db'
+       ignore += [compression.outputPath(cfg.get('outputFile', 'index.html'), cfg)] + [cfg['exportCache'] + s for s in ('', '-journal')]
+
+    def onChange(changed, stats):
+        clrprint.clrprint(f'[{getCurrentDateTime()}] [{root}] changed. Events:{stats.get("events", 0)} Directories listed:{stats["listed"]} removed:{stats["removed"]}', clr='yellow')
+        if mode == 'export':
+           if changed is not None:
+              exportCache.invalidate(cfg['exportCache'], changed)
+           export(cfg)
+        elif mode == 'search' and not cfg.get('interactive', False):
+           print(search(query='', criteria=cfg))
+        elif mode == 'usage':
+           usage(cfg)
+
+    stop = threading.Event()
+    ready = threading.Event()
+    watchArgs = {'delay':cfg.get('watchDelay', 1.0), 'poll':cfg.get('poll', False), 'onChange':onChange,
+                 'stop':stop, 'ignore':ignore, 'ready':ready}
+
+    if mode == 'search' and cfg.get('interactive', False):
+       w = threading.Thread(target=watcher.watch, args=(root, cfg['index']), kwargs=watchArgs, daemon=True)
+       w.start()
+       ready.wait()
+       try:
+          interactiveSearch(cfg)
+       finally:
+          stop.set()
+          w.join()
+       return
+
+    if mode == 'export':
+       export(cfg)
+    elif mode == 'search':
+       refreshIndex(cfg)
+       print(search(query='', criteria=cfg))
+    elif mode == 'usage':
+       refreshIndex(cfg)
+       usage(cfg)
+
+    clrprint.clrprint(f'[{getCurrentDateTime()}] Watching [{root}]. Press Ctrl+C to stop.', clr='yellow')
+    try:
+       watcher.watch(root, cfg['index'], **watchArgs)
+    except KeyboardInterrupt:
+       clrprint.clrprint(f'[{getCurrentDateTime()}] Stopped watching [{root}].', clr='yellow')
+
+
+
 
 
 ###########################################################################
@@ -401,11 +1715,18 @@ def search(query='', criteria={}):
 
     sV = handlers.SearchVisitor(query, criteria)
 
+    # Matching paths are also written to criterium searchOutput, compressed if asked (see compression.py)
+    if criteria.get('searchOutput', '') not in (None, ''):
+       sV.results = compression.openOutput(criteria['searchOutput'], criteria, encoding='utf8', errors='backslashreplace')
+
     clrprint.clrprint(f'Search results for {q}:', clr='maroon')
     try:
-      fsTraversal(criteria.get('directory', 'testDirectories/testDir0'), 1, visitor=sV)
+      traverse(criteria.get('directory', 'testDirectories/testDir0'), sV)
     except handlers.criteriaException as ce:
       clrprint.clrprint('Terminated due to criterialException. Message:', str(ce), clr='red')
+    finally:
+      if sV.results is not None:
+         sV.results.close()
     
 
     clrprint.clrprint(f'\nFound {sV.file_count} files and {sV.directory_count} directories. Ignored:{sV.nIgnored}\n', clr='maroon')
@@ -414,6 +1735,54 @@ def search(query='', criteria={}):
 
 
 
+###########################################################################
+# Disk usage
+###########################################################################
+
+
+# Sizes of the directory and the top (criterium top) largest directories and files
+# below it, aggregated in a single traversal (see diskUsage.py).
+# Returns the termination code, the number of directories and files counted and the
+# apparent and allocated size in bytes.
+@timeit
+def usage(criteria={}):
+
+    global timeStarted
+
+    timeStarted = None
+    root = criteria.get('directory', 'testDirectories/testDir0')
+    if not fileSystems.current.isdir(root):
+       clrprint.clrprint(f'[Error] Not such directory [{root}]', clr="red")
+       return((-2, 0, 0, 0, 0))
+
+    uV = handlers.UsageVisitor(criteria)
+    status = 0
+    try:
+      status = traverse(root, uV)[0]
+    except handlers.criteriaException as ce:
+      clrprint.clrprint('Terminated due to criteriaException. Message:', str(ce), clr='red')
+      status = ce.errorCode
+
+    size, allocated = uV.usage.totals(root)
+    largestDirectories, largestFiles = uV.usage.largest()
+    for title, items in (('LARGEST DIRECTORIES', largestDirectories), ('LARGEST FILES', largestFiles)):
+        if len(items) == 0:
+           continue
+
+        table = PrettyTable()
+        table.align = "l"
+        table.title = title
+        table.field_names = ["size", "path"]
+        for s, p in items:
+            table.add_row([humanSize(s), p])
+        clrprint.clrprint(table, clr='y')
+
+    clrprint.clrprint(f'\n[{root}] Size:{humanSize(size)} ({size} bytes) Allocated:{humanSize(allocated)} ({allocated} bytes). Files:{uV.file_count} Directories:{uV.directory_count} Ignored:{uV.nIgnored}\n', clr='maroon')
+    return(status, uV.directory_count, uV.file_count, size, allocated)
+
+
+
+
 ###########################################################################
 # Comparing directories and synchronization
 # NOTE: implementation is not based on traversal function above.
@@ -453,6 +1822,32 @@ def defaultFH(l=1, side='right', path=''):
 
 
 
+# Compares the listings of directories left and right (in the current file system, see
+# fileSystems.py) the way filecmp.dircmp does, with the same attribute names: names in
+# filecmp.DEFAULT_IGNORES are ignored and names that are a directory on one side and a
+# file on the other are in neither common_dirs nor common_files. Entry types come from
+# the listings; no stat calls are made.
+# Raises OSError if left or right cannot be listed.
+class DirectoryComparison:
+
+      def __init__(self, left, right):
+          lDirs, lFiles = scanDirectory(left)
+          rDirs, rFiles = scanDirectory(right)
+          self.leftDirs = set(d.name for d in lDirs) - set(DEFAULT_IGNORES)
+          self.rightDirs = set(d.name for d in rDirs) - set(DEFAULT_IGNORES)
+          leftFiles = set(f.name for f in lFiles) - set(DEFAULT_IGNORES)
+          rightFiles = set(f.name for f in rFiles) - set(DEFAULT_IGNORES)
+
+          leftNames = sorted(self.leftDirs | leftFiles)
+          rightNames = sorted(self.rightDirs | rightFiles)
+          self.left_only = [n for n in leftNames if n not in self.rightDirs and n not in rightFiles]
+          self.right_only = [n for n in rightNames if n not in self.leftDirs and n not in leftFiles]
+          self.common_dirs = [n for n in leftNames if n in self.leftDirs and n in self.rightDirs]
+          self.common_files = [n for n in leftNames if n in leftFiles and n in rightFiles]
+
+
+
+
 def dirDifference(L_dir, R_dir, lvl=1, mxLvl=-1, dirOnly=False, matchFilter='', dirHandler=None, fileHandler=None, verbose=False, progress=None):
 
   """
@@ -490,18 +1885,18 @@ def dirDifference(L_dir, R_dir, lvl=1, mxLvl=-1, dirOnly=False, matchFilter='',
      return(-2, 0, L_only, R_only, C_only)
 
   try:  
-    dcmp = dircmp(L_dir, R_dir)
+    dcmp = DirectoryComparison(L_dir, R_dir)
     if not dcmp:
        return(-7, 0, L_only, R_only, C_only)   
               
-    L_only['D'] = [ join(L_dir, f)  for f in dcmp.left_only if  (os.path.isdir( join(L_dir, f)  ) and nameMatches(on=f, xP='', iP=matchFilter))  ]
-    R_only['D'] = [ join(R_dir, f)  for f in dcmp.right_only if (os.path.isdir( join(R_dir, f)  ) and nameMatches(on=f, xP='', iP=matchFilter))]
+    L_only['D'] = [ join(L_dir, f)  for f in dcmp.left_only if  (f in dcmp.leftDirs and nameMatches(on=f, xP='', iP=matchFilter))  ]
+    R_only['D'] = [ join(R_dir, f)  for f in dcmp.right_only if (f in dcmp.rightDirs and nameMatches(on=f, xP='', iP=matchFilter))]
     # for common files, take relative paths
     C_only['D'] = [ f  for f in dcmp.common_dirs if nameMatches(on=f, xP='', iP=matchFilter)  ]
     
     if not dirOnly:       
-       L_only['F'] = [ join(L_dir, f)  for f in dcmp.left_only if ((not os.path.isdir( join(L_dir, f))) and nameMatches(on=f, xP='', iP=matchFilter)) ]
-       R_only['F'] = [ join(R_dir, f)  for f in dcmp.right_only if ((not os.path.isdir( join(R_dir, f))) and nameMatches(on=f, xP='', iP=matchFilter))]
+       L_only['F'] = [ join(L_dir, f)  for f in dcmp.left_only if ((f not in dcmp.leftDirs) and nameMatches(on=f, xP='', iP=matchFilter)) ]
+       R_only['F'] = [ join(R_dir, f)  for f in dcmp.right_only if ((f not in dcmp.rightDirs) and nameMatches(on=f, xP='', iP=matchFilter))]
        # We use the left-sided root as the prefix for common files.
        # TODO: relative here too? 
        C_only['F'] = [ join(L_dir, f) for f in dcmp.common_files if nameMatches(on=f, xP='', iP=matchFilter)  ]
@@ -682,7 +2077,8 @@ def interactiveSearch(cfg={}):
 
 
 
-def selector(mode='export', cfg={}, cmdParams=None):
+# out: file exports are written to instead of criterium outputFile (see export()).
+def selector(mode='export', cfg={}, cmdParams=None, out=None):
       
     clrprint.clrprint(f"\nStarting [{mode}] mode from root [{cfg.get('directory', 'testDirectories/testDir0')}] with following paramters:")
     if cmdParams is None:
@@ -698,9 +2094,42 @@ def selector(mode='export', cfg={}, cmdParams=None):
     time.sleep(0.5) # small delay to allow starting messages to appear (even when executed from within IDLE)  
 
 
+    # Simulated file systems (see fileSystems.py)
+    try:
+       fileSystems.use(fileSystems.fromCriteria(cfg))
+    except (ValueError, OSError) as fsEx:
+       clrprint.clrprint(f'[Error] {fsEx}', clr='red')
+       return
+
+    # Keep the index (and export) up to date until interrupted
+    if cfg.get('watch', False) and mode != 'compare':
+       watchDirectory(mode, cfg)
+       return
+
+    # Walk once into a snapshot (see snapshot.py); the operation then reads the snapshot
+    if cfg.get('snapshotOut', '') not in (None, '') and mode != 'compare':
+       root = cfg.get('directory', 'testDirectories/testDir0')
+       try:
+          ts = time.perf_counter()
+          n = snapshot.write(root, cfg['snapshotOut'])
+          clrprint.clrprint(f"[{getCurrentDateTime()}] Snapshot of [{root}]: {n} entries written to [{cfg['snapshotOut']}] ({os.path.getsize(cfg['snapshotOut'])} bytes) in {time.perf_counter() - ts:.2f} seconds", clr='yellow')
+          fileSystems.use(snapshot.SnapshotFileSystem([cfg['snapshotOut']], fileSystems.current))
+       except OSError as snEx:
+          clrprint.clrprint(f'[Error] Snapshot failed: {snEx}', clr='red')
+          return
+
+    if cfg.get('resume', False) and cfg.get('checkpoint', '') in (None, ''):
+       cfg['checkpoint'] = 'dirWalker.ckpt'
+
+    # Refresh the index first; the operation is then answered from the index
+    if cfg.get('refreshIndex', False):
+       if cfg.get('index', '') in (None, ''):
+          cfg['index'] = 'dirWalker.db'
+       refreshIndex(cfg)
+       
     if mode == 'export':
        if not cfg.get('progress', False): 
-          result = export(cfg)
+          result = export(cfg, out)
           #print(result)
        else:
           GUI.progressCommand('export', '', cfg)  
@@ -712,8 +2141,19 @@ def selector(mode='export', cfg={}, cmdParams=None):
                print(result)
          else:
                GUI.progressCommand('search', ' '.join(cfg.get('searchquery', [])), cfg)  
-    else:
+    elif mode == 'compare':
          compareDirectories(cfg)
+    elif mode == 'usage':
+         usage(cfg)
+
+    # Wrapped file systems are reached through their fileSystem attribute
+    fs = fileSystems.current
+    while fs is not None:
+          if isinstance(fs, fileSystems.LatencyFileSystem):
+             clrprint.clrprint(f'[{getCurrentDateTime()}] File system calls: listings:{fs.calls["list"]} stats:{fs.calls["stat"]} opened:{fs.calls["open"]} failed:{fs.errors}', clr='yellow')
+          elif hasattr(fs, 'reused'):
+             clrprint.clrprint(f'[{getCurrentDateTime()}] Archives read:{fs.read} indexes reused:{fs.reused}', clr='yellow')
+          fs = getattr(fs, 'fileSystem', None)
          
             
 
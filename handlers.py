@@ -7,12 +7,21 @@ import datetime
 from dateutil.parser import parse
 
 import random
+import csv
+import json
+from json.encoder import encode_basestring as jsonString
+import shutil
+import struct
+import threading
+import tempfile
 
-# for stacks
-from collections import deque
+import collections
+import operator
 
 
-from utilities import searchNameComplies, printPath, fileInfo, strToBytes, normalizeDateTime, nameMatches
+from utilities import printPath, fileInfo, strToBytes, normalizeDateTime, FileMeta, formatDateTime
+import diskUsage
+import templateEngine
 
 
 
@@ -24,37 +33,246 @@ fontColorPalette = ['#4287f5', '#801408', '#08259c', '#4560d1', '#0a690a', '#9c5
 
 
 # List of pseudovariable.
-# Keys will be replaced in templates by eval-ing the values of the keys.
+# Keys will be replaced in templates by the values the functions return (see
+# templateEngine.py), called with the name, path, level and parent path of the
+# directory and its id.
 #
 # TODO: Place this in different file?
 
-DIRECTORYPSEUDOVARIABLES = {'${ID}': 'dId',
-                            '${DIRNAME}': 'name',
-                            '${PATH}':'path',
-                            '${RLVLCOLOR}':'random.choice(fontColorPalette)',
-                            '${LEVEL}': 'str(level)',
-                            '${OPENSTATE}': '""',
-                            '${PARENTPATH}':'parent',
-                            '${LEVELTABS}':'level*"\t"',
-                            '${LEVELNSBP}':'level*"&nbsp;"'}
+DIRECTORYPSEUDOVARIABLES = {'${ID}': lambda name, path, level, parent, dId: dId,
+                            '${DIRNAME}': lambda name, path, level, parent, dId: name,
+                            '${PATH}': lambda name, path, level, parent, dId: path,
+                            '${RLVLCOLOR}': lambda name, path, level, parent, dId: random.choice(fontColorPalette),
+                            '${LEVEL}': lambda name, path, level, parent, dId: str(level),
+                            '${OPENSTATE}': lambda name, path, level, parent, dId: "",
+                            '${PARENTPATH}': lambda name, path, level, parent, dId: parent,
+                            '${LEVELTABS}': lambda name, path, level, parent, dId: level*"\t",
+                            '${LEVELNSBP}': lambda name, path, level, parent, dId: level*"&nbsp;"}
 
 
-FILEPSEUDOVARIABLES = {'${ID}': 'dId',
-                       '${FILELINK}':'makeHtmlLink(path, name, False)',
-                       '${FILENAME}': 'name', '${PATH}':'path', '${RLVLCOLOR}':'random.choice(fontColorPalette)',
-                       '${LEVEL}': 'str(level)',
-                       '${FILESIZE}': 'str(finfo["size"])',
-                       '${FILELASTMODIFIED}':"finfo['lastmodified'].strftime('%d/%m/%Y %H:%M:%S')",
-                       '${FILECREATED}': "finfo['creationdate'].strftime('%d/%m/%Y %H:%M:%S')",
-                       '${PARENTPATH}':'parent',
-                       '${LEVELTABS}':'level*"\t"',
-                       '${LEVELNSBP}':'level*"&nbsp;"'}
+# File metadata fields (see utilities.FileMeta) file pseudovariables need. 
+METADATAPSEUDOVARIABLES = {'${FILESIZE}': 'size',
+                           '${FILELASTMODIFIED}': 'lastmodified',
+                           '${FILECREATED}': 'creationdate'}
 
 
+# Disk usage (see diskUsage.py) of a directory and everything in it, in bytes.
+# Also supported in the page template, for the starting directory.
+USAGEPSEUDOVARIABLES = {'${DIRSIZE}': 0,
+                        '${DIRALLOCATED}': 1}
 
+# Pseudovariables of a directory known once it has been traversed (see ExportVisitor.updateCounts())
+COUNTPSEUDOVARIABLES = ['${LNDIRS}', '${LNFILES}', '${NDIRS}', '${NFILES}', '${DIRSIZE}', '${DIRALLOCATED}']
 
+# File metadata fields needed for disk usage
+USAGEMETADATA = {'size', 'allocated', 'fileid'}
 
 
+# Returns the set of file metadata fields referenced by the given templates. 
+def templateMetadata(*templates):
+    return(set(field for pv, field in METADATAPSEUDOVARIABLES.items() if any(pv in t for t in templates)))
+
+
+# Pseudovariables of files, the same way. The functions are called with the name, path,
+# level and parent path of the file and its metadata (see utilities.FileMeta).
+FILEPSEUDOVARIABLES = {'${ID}': lambda name, path, level, parent, finfo: "f" + str(level) + "-" + str(random.randint(0, 1000000)),
+                       '${FILELINK}': lambda name, path, level, parent, finfo: makeHtmlLink(path, name, False),
+                       '${FILENAME}': lambda name, path, level, parent, finfo: name,
+                       '${PATH}': lambda name, path, level, parent, finfo: path,
+                       '${RLVLCOLOR}': lambda name, path, level, parent, finfo: random.choice(fontColorPalette),
+                       '${LEVEL}': lambda name, path, level, parent, finfo: str(level),
+                       '${FILESIZE}': lambda name, path, level, parent, finfo: str(finfo["size"]),
+                       '${FILELASTMODIFIED}': lambda name, path, level, parent, finfo: formatDateTime(finfo['lastmodified']),
+                       '${FILECREATED}': lambda name, path, level, parent, finfo: formatDateTime(finfo['creationdate']),
+                       '${PARENTPATH}': lambda name, path, level, parent, finfo: parent,
+                       '${LEVELTABS}': lambda name, path, level, parent, finfo: level*"\t",
+                       '${LEVELNSBP}': lambda name, path, level, parent, finfo: level*"&nbsp;",
+                       # fileExtension starts with a dot
+                       '${FILEEXTENSION}': lambda name, path, level, parent, finfo: (os.path.splitext(path)[1] or '.ukn')[1:]}
+
+
+
+
+
+
+
+
+
+
+# Keys of criteria that can not be pickled/serialized (e.g. gui objects).
+NONSERIALIZABLECRITERIA = ['guiwindow', 'guiprogress', 'guistatus']
+
+
+# Copy of criteria that can be sent to a worker process.
+# Worker processes never shard again.
+def shardCriteria(criteria):
+    c = {k: v for k, v in criteria.items() if k not in NONSERIALIZABLECRITERIA}
+    c['processes'] = 0
+    return(c)
+
+
+
+
+# Relations that can be used for creation/last modification date criteria
+DATEOPERATORS = {'==': operator.eq, '=': operator.eq, '!=': operator.ne,
+                 '<': operator.lt, '<=': operator.le,
+                 '>': operator.gt, '>=': operator.ge}
+
+
+
+# A single check of a compiled criteria chain.
+#
+# kind: 'name', 'size' or 'date'. code: value visit_file() of ExportVisitor returns
+# when the check fails. test(name, finfo): True if the item complies. message(name, finfo):
+# text displayed when an item is ignored due to this check, None if nothing is displayed.
+class CriteriaCheck:
+      __slots__ = ('kind', 'code', 'test', 'message')
+
+      def __init__(self, kind, code, test, message=None):
+          self.kind = kind
+          self.code = code
+          self.test = test
+          self.message = message
+
+
+
+# Name, size and date criteria compiled once per run into chains of checks: regular
+# expressions are compiled, dates parsed and relations resolved to operator functions
+# beforehand, so that checking a file does not involve any dictionary lookups, parsing
+# or eval.
+#
+# Checks are ordered cheapest first: name, size, date.
+# Used by all visitors as well as walk() and asyncWalker.walk().
+# keys: the criteria that are compiled; the others are not checked (see EXPORTKEYS).
+class CompiledCriteria:
+
+      # Criteria that are compiled
+      KEYS = ['fileexclusionPattern', 'fileinclusionPattern', 'direxclusionPattern', 'dirinclusionPattern',
+              'fileSize', 'minFileSize', 'maxFileSize',
+              'creationDate', 'creationDateOp', 'lastModifiedDate', 'lastModifiedDateOp']
+
+      # Criteria exports check: exports have never filtered on the exact file size (-fsz)
+      EXPORTKEYS = [k for k in KEYS if k != 'fileSize']
+
+      def __init__(self, criteria={}, keys=KEYS):
+          self.source = {k: criteria[k] for k in keys if k in criteria}
+          criteria = self.source
+          self.fileExclusion = self.compilePattern(criteria.get('fileexclusionPattern', ''))
+          self.fileInclusion = re.compile(criteria.get('fileinclusionPattern', ''))
+          self.dirExclusion = self.compilePattern(criteria.get('direxclusionPattern', ''))
+          self.dirInclusion = re.compile(criteria.get('dirinclusionPattern', ''))
+
+          # Metadata fields the checks need
+          self.metadata = set()
+
+          self.fileChecks = [CriteriaCheck('name', -200, self.nameTest(self.fileExclusion, self.fileInclusion))]
+          self.dirChecks = [CriteriaCheck('name', -201, self.nameTest(self.dirExclusion, self.dirInclusion))]
+
+          fileSize = criteria.get('fileSize', -1)
+          if fileSize >= 0:
+             self.fileChecks.append(CriteriaCheck('size', -204, lambda n, fi: int(fi['size']) == fileSize))
+
+          minFileSize = criteria.get('minFileSize', -1)
+          if minFileSize >= 0:
+             self.fileChecks.append(CriteriaCheck('size', -201, lambda n, fi: int(fi['size']) >= minFileSize))
+
+          maxFileSize = criteria.get('maxFileSize', -1)
+          if maxFileSize >= 0:
+             self.fileChecks.append(CriteriaCheck('size', -202, lambda n, fi: int(fi['size']) <= maxFileSize))
+
+          for dateKey, opKey, metaKey, label, description in [('creationDate', 'creationDateOp', 'creationdate', 'CREATIONDATE', 'CREATION DATE'),
+                                                              ('lastModifiedDate', 'lastModifiedDateOp', 'lastmodified', 'MODIFIEDDATE', 'MODIFIED DATE')]:
+              check = self.dateCheck(criteria.get(dateKey, ''), criteria.get(opKey, '=='), metaKey, label, description)
+              if check is not None:
+                 self.fileChecks.append(check)
+                 self.metadata.add(metaKey)
+
+          if len([c for c in self.fileChecks if c.kind == 'size']) > 0:
+             self.metadata.add('size')
+
+
+
+      # Checks can not be pickled (e.g. when sent to worker processes); compile again instead.
+      def __reduce__(self):
+          return(CompiledCriteria, (self.source,))
+
+
+      @staticmethod
+      def compilePattern(pattern):
+          if pattern == '':
+             return(None)
+          return(re.compile(pattern))
+
+
+      @staticmethod
+      def nameTest(exclusion, inclusion):
+          if exclusion is None:
+             return(lambda n, fi: inclusion.search(n) is not None)
+          return(lambda n, fi: exclusion.search(n) is None and inclusion.search(n) is not None)
+
+
+
+      # Returns the check for a creation/last modification date criterion or None if
+      # there is no such criterion or it is invalid (in which case it is ignored).
+      @staticmethod
+      def dateCheck(dateValue, op, metaKey, label, description):
+          if dateValue == '':
+             return(None)
+
+          if op == '=':
+             clrprint.clrprint(f"[WARNING] Did you mean == (seen {op}")
+
+          try:
+             if op not in DATEOPERATORS:
+                raise ValueError(f'Unknown relation {op}')
+             relation = DATEOPERATORS[op]
+             date = normalizeDateTime(dateValue)
+          except Exception as dateEx:
+             print(f"Invalid date [{dateValue}]. Ignored {label} constraint. Message:", str(dateEx))
+             return(None)
+
+          def test(n, fi):
+              try:
+                 return(relation(fi[metaKey].date(), date))
+              except Exception as dateEx:
+                 # Files without dates are not filtered out
+                 return(True)
+
+          return(CriteriaCheck('date', -203, test,
+                               lambda n, fi: f'Ignoring FILE [{n}] due to {description} criteria file created: {fi[metaKey].strftime("%d/%m/%Y")}'))
+
+
+
+      # Returns the first check file name with metadata finfo fails, None if it complies.
+      def fileFailure(self, name, finfo):
+          for check in self.fileChecks:
+              if not check.test(name, finfo):
+                 return(check)
+          return(None)
+
+
+      # Returns the first check directory name fails, None if it complies.
+      def directoryFailure(self, name):
+          for check in self.dirChecks:
+              if not check.test(name, None):
+                 return(check)
+          return(None)
+
+
+      # Checks if a file or directory (kind is 'file' or 'directory') complies, without
+      # displaying anything. Used by traversals that don't use visitors.
+      def complies(self, kind, name, finfo):
+          if kind == 'directory':
+             return(self.directoryFailure(name) is None)
+          return(self.fileFailure(name, finfo) is None)
+
+
+      # Replaces the matches of the inclusion pattern in name (see searchNameComplies()).
+      def markFileName(self, name, matchReplacement):
+          return(self.fileInclusion.sub(matchReplacement, name))
+
+      def markDirectoryName(self, name, matchReplacement):
+          return(self.dirInclusion.sub(matchReplacement, name))
 
 
 
@@ -93,6 +311,8 @@ class Visitor(ABC):
 
     def __init__(self):
         self.nIgnored = 0
+        # Set by the traversal (see functionality.DirectoryGuard)
+        self.traversalGuard = None
         
     @abstractmethod
     def getCriterium(self, cname='', default=-1):
@@ -117,6 +337,51 @@ class Visitor(ABC):
         self.nIgnored += 1
 
 
+    # Returns the set of file metadata fields (see utilities.FileMeta) the visitor
+    # may access. Metadata is fetched lazily in any case; the traversal uses this to
+    # decide whether stat-ing ahead of time (e.g. in prefetching threads) is worth it.
+    # Will get overwritten in derived classes that know what they need.
+    def neededMetadata(self):
+        return(set(FileMeta.__slots__))
+
+
+    #
+    # Support for sharded traversal (see functionality.fsTraversalSharded()).
+    # Visitors not overriding these can not be used for sharded traversals.
+    #
+
+    # Returns a new visitor with the same configuration but no state, that will
+    # traverse subdirectory path (at level) in a worker process.
+    # Must be picklable.
+    def shardVisitor(self, path, level):
+        return(None)
+
+    # Called in the worker process once the shard has been traversed. Returns the
+    # (picklable) state to send back and merge into the parent visitor.
+    def shardResult(self, level):
+        return(None)
+
+    # Merges the result of the shard traversing subdirectory path into this visitor.
+    # Called after the directory path itself has been visited and before its counts
+    # are updated (see updateCounts()).
+    def mergeShard(self, path, result):
+        return
+
+
+    #
+    # Support for resumable traversals (see functionality.fsTraversalResumable()).
+    # Visitors not overriding these can not be checkpointed.
+    #
+
+    # Returns the (picklable) state of the visitor, e.g. counts and results so far.
+    def checkpointState(self):
+        return(None)
+
+    # Restores the state returned by checkpointState() (in a later run).
+    def restoreCheckpoint(self, state):
+        return
+
+
 
 
 
@@ -145,12 +410,23 @@ class File(Visitable):
         
 
 
+# Lightweight record of a traversed file or directory.
+# Used by the generator based traversal APIs instead of File/Directory objects.
+#
+# type: 'file' or 'directory'
+# meta: utilities.FileMeta of the item
+TraversalEntry = collections.namedtuple('TraversalEntry', ['type', 'name', 'path', 'level', 'parent', 'meta'])
+
+
+
 class Directory(Visitable):
-    def __init__(self, name, path, level, parent, ldc, lfc):
+    def __init__(self, name, path, level, parent, ldc, lfc, dinfo=None):
         self.name = name
         self.path = path
         self.level = level
         self.parent = parent
+        # Metadata (utilities.FileMeta) of the directory itself, if available
+        self.dirMeta = dinfo
         self.localDirCount = ldc
         self.localFileCount = lfc
         self.ignored = False
@@ -231,141 +507,84 @@ class ExportVisitor(Visitor):
         self.fileTemplate = fileT
         self.pageTemplate = pageT
         self.criteria = criteria
+        self.compiledCriteria = CompiledCriteria(criteria, CompiledCriteria.EXPORTKEYS)
+        self.compileTemplates()
         
-        self.stack = deque()
+        # Directories being exported (see closeDirectories())
+        self.stack = []
+        # If set, directories are written as they are visited (see ExportStream)
+        self.stream = None
+
+        # Disk usage, only if the templates show it. Exports do not list the largest items.
+        self.usage = None
+        if any(pv in t for pv in USAGEPSEUDOVARIABLES for t in (dirT, pageT)):
+           self.usage = diskUsage.DiskUsage(0)
+        # Root of the shard traversed by this visitor (see shardVisitor())
+        self.shardRoot = None
+
+
+    
+    def compileTemplates(self):
+        self.compiledDirTemplate = templateEngine.Template(self.dirTemplate, DIRECTORYPSEUDOVARIABLES)
+        self.compiledFileTemplate = templateEngine.Template(self.fileTemplate, FILEPSEUDOVARIABLES)
+
+
+    # Compiled templates can not be pickled (e.g. when sent to worker processes); compile again instead.
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['compiledDirTemplate']
+        del state['compiledFileTemplate']
+        return(state)
 
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.compileTemplates()
 
     
     def getCriterium(self, cname='', default=-1):
         return(self.criteria.get(cname, default))
+
+
+    # Metadata needed by the criteria, the file template and disk usage
+    def neededMetadata(self):
+        if self.usage is not None:
+           return(self.compiledCriteria.metadata | templateMetadata(self.fileTemplate) | USAGEMETADATA)
+        return(self.compiledCriteria.metadata | templateMetadata(self.fileTemplate))
     
 
     # TODO: Check this
     def showStack(self):
-        elem = []
-        pos = 0
-        while True:
-              if len(self.stack) <= 0 :
-                 break
-                
-              sItem = self.stack.pop()
-              clrprint.clrprint(f'{len(self.stack) - pos}) {sItem["name"]}', clr='maroon')
-              elem.append(sItem)  
+        for i, frame in enumerate(self.stack[::-1]):
+            clrprint.clrprint(f'{len(self.stack) - 1 - i}) {frame.path} [{len(frame.dirs)} directories, {len(frame.files)} files]', clr='maroon')
 
-        # put back
-        for sI in elem[::-1]:
-            self.stack.append(sI)
 
 
-
-
-    # Collapses the items in the stack.
-    #
-    # Stack contains the visited directories in order (as visited) to create the desired html output.
-    # Directories in the stack are represented using dictionaries with the following keys:
-    # type: type of item (file or directory)
-    # collapsed: whether this directory has been collapsed i.e. all its subdirectories have been
-    #            visited, the respective html of subdirectories have been calculated and replaced
-    #            the subdirectory psudovariable of this directory
-    # level: level of item
-    # name: full path of item
-    # dname: only the name of item
-    # html: the html formated item using the loaded templates. If the subdirectory pseudovariable
-    #       of this key has been replaced, the directory is considered as collapsed
+    # The stack holds the directories being exported, from the root to the directory
+    # whose contents are visited. Each is an ExportFrame collecting the rendered items
+    # it contains.
     #
-    # An instance of a stack (first element in stack is always the initial root directory): 
-    # 
-    # {type:file, level:2, name:testDir0/1/excelFile.xlsx, html:''}
-    # {type:file, level:2, name:testDir0/1/anImageFile.jpg, html:''}
-    # {type:file, level:1, name:testDir0/1/, html:'...${SUBDIRECTORY}'}
-    # {type:file, level:0, name:testDir0/}
+    # A directory is complete once its counts are known (see updateCounts()). Its html
+    # then gets its counts and becomes an ExportNode in the frame of its parent; the
+    # html of the whole tree is written once, when the export is done (see ExportNode).
     #
-    # If collapsed, the stack will become:
+    # Directories whose counts are never updated (e.g. not traversed with -NR) are
+    # completed without counts, when the next item at their level or above is visited.
     #
-    # {type:file, level:1, name:testDir0/1/, html:'...<html of excelFile.xlsx, html of anImageFile.jpg>'}
-    # {type:file, level:0, name:testDir0/}
-    #
-    # in the above example, directory 1 has been collapsed.
-    # If exampleDir0 would have another dir (e.g. 2), the stack would become:
-    #
-    # {type:file, level:1, name:testDir0/2/, html:'...${SUBDIRECTORY}'}
-    # {type:file, level:1, name:testDir0/1/, html:'...<html of excelFile.xlsx, html of anImageFile.jpg>'}
-    # {type:file, level:0, name:testDir0/}
-    #
-    # All items in level 1 would be collapsed if all level 1 items have been exhausted (visited). The signal that
-    # all items in level 1 have been exhausted is generated when a new directory at a higher/upward level
-    # (smaller level) is encountered.
-    #
-    # By collapsing, the html for the directory that has been exhausted (i.e. all its containing items
-    # have been processed) is generated.
-    
-    def collapse(self, newD={'type':'directory', 'level':0, 'name':''}, stk=None, final=False):
+    # With a stream, the html of directories is written as they are visited instead.
+    def closeDirectories(self, level):
+        while len(self.stack) > 1 and self.stack[-1].level >= level:
+              frame = self.stack.pop()
+              if self.stream is not None:
+                 self.stream.closeFrame(frame)
+              else:
+                 self.stack[-1].dirs.append(frame.node())
 
 
-          if stk is None:
-             stk = self.stack
-             
-          #clrprint.clrprint(f"Seen: [{newD['name']}] Level[{newD['level']}]", clr='maroon')
-          sDir = ''
-          
-            
-          if len(stk) <= 0:
-             return
-
-          top = stk.pop()
-          if newD['level'] >= top['level']:
-             stk.append(top)
-             return
-                     
-          
-          if top['level'] - newD['level'] > 0:
-             #clrprint.clrprint(f"Entering collapse", clr='maroon')
-              
-             # The new directory that WILL be added is at a higher level than to current
-             # top of the list. i.e. we went one or more levels up.
-             # At this point top is the last directory/file found at the deepest level.
-             # Start collapsing now...
-
-                
-             # This means that the new directory encounterred
-             # is at a higher level. Hence collect all at the
-             # same level and merge/concatenate them
-             sDir = top['html']
-             nAtLevel = 0
-             while True:
-
-                 if len(stk) <= 0:
-                     break
-
-                 # get object below top (deepest encounterred)   
-                 s = stk.pop()
-                 #clrprint.clrprint(f"[Collapse]: popped [{s['name']}][{s['level']}]->[{s['collapsed']}] [top:{top['name']}][{top['level']}]->[{top['collapsed']}] [newD:{newD['name']}] [{newD['level']}]", clr='maroon') 
-                 if s['level'] == newD['level']:
-                    top['html'] = sDir
-                    s['html'] = s['html'].replace('${SUBDIRECTORY}', top['html'])
-                    s['collapsed'] = True
-                    stk.append(s) 
-                    stk.append(top)
-                    return
-                
-                
-                 if s['level'] == top['level']:
-                    nAtLevel += 1 
-                    #clrprint.clrprint(f"\t[Collapse]: Adding to [{s['name']}]", clr='yellow') 
-                    if s['type']=='directory': 
-                       sDir = s['html'] + self.criteria.get('templateItemsSeparator', ' ')  + sDir
-                    else:
-                       sDir = sDir + self.criteria.get('templateItemsSeparator', ' ') + s['html']
-                       
-                 elif top['level'] - s['level'] == 1:  
-                      sDir = s['html'].replace('${SUBDIRECTORY}', sDir)
-                      top = {'type':'directory', 'collapsed':True, 'level':s['level'], 'name':s['name'], 'dname':s['dname'], 'html':sDir}
-                      sDir = top['html']
-                      nAtLevel = 0
-                      
-                      
-          # TODO: Do we need this?   
-          return(sDir)
+    # Completes the export. Returns the ExportNode of the first directory on the stack
+    # (the root of the export or the placeholder of a shard).
+    def finish(self):
+        self.closeDirectories(self.stack[0].level + 1)
+        return(self.stack.pop().node())
 
 
 
@@ -376,72 +595,27 @@ class ExportVisitor(Visitor):
            if self.file_count >= self.criteria.get('maxFiles', -1):
               raise criteriaException(-9, 'Maximum number of FILES reached.')
 
-        if not nameMatches(name, self.criteria.get('fileexclusionPattern', ''), self.criteria.get('fileinclusionPattern', '') ):
-           clrprint.clrprint(f'Ignoring FILE [{name}] due to NAME criteria', clr='red')
+        failed = self.compiledCriteria.fileFailure(name, finfo)
+        if failed is not None:
+           if failed.kind == 'name':
+              clrprint.clrprint(f'Ignoring FILE [{name}] due to NAME criteria', clr='red')
+           elif failed.message is not None:
+              clrprint.clrprint(failed.message(name, finfo), clr='red')
            self.ignored()
-           return(-200)
-
-
-        if self.criteria.get('minFileSize', -1) >= 0:
-           if int(finfo['size']) < self.criteria.get('minFileSize', -1):
-              self.ignored() 
-              return(-201)
-
-        if self.criteria.get('maxFileSize', -1) >= 0:
-           if int(finfo['size']) > self.criteria.get('maxFileSize', -1):
-              self.ignored() 
-              return(-202)    
-
-
-        if self.criteria.get('creationDate', '') != '':
-           try:
-              if self.criteria.get('creationDateOp', '==') == '=':
-                 clrprint.clrprint(f"[WARNING] Did you mean == (seen {self.criteria.get('creationDateOp', '==')}")
-                 
-              expr = f"finfo['creationdate'].date() {self.criteria.get('creationDateOp', '==')} normalizeDateTime(self.criteria.get('creationDate', ''))"
-              if not eval(expr):
-                 clrprint.clrprint(f'Ignoring FILE [{name}] due to CREATION DATE criteria file created: {finfo["creationdate"].strftime("%d/%m/%Y")}', clr='red') 
-                 self.ignored()
-                 return(-203)
-           except Exception as dateEx:
-                 print(f"Invalid date [{self.criteria.get('creationDate', '')}]. Ignored CREATIONDATE constraint. Message:", str(dateEx))
-                 
-
-        if self.criteria.get('lastModifiedDate', '') != '':
-           try:
-              if self.criteria.get('lastModifiedDateOp', '==') == '=':
-                 clrprint.clrprint(f"[WARNING] Did you mean == (seen {self.criteria.get('lastModifiedDateOp', '==')}")
-                 
-              expr = f"finfo['lastmodified'].date() {self.criteria.get('lastModifiedDateOp', '==')} normalizeDateTime(self.criteria.get('lastModifiedDate', ''))"
-              if not eval(expr):
-                 clrprint.clrprint(f'Ignoring FILE [{name}] due to MODIFIED DATE criteria file created: {finfo["lastmodified"].strftime("%d/%m/%Y")}', clr='red') 
-                 self.ignored()
-                 return(-203)
-           except Exception as dateEx:
-                 print(f"Invalid date [{self.criteria.get('lastModifiedDate', '')}]. Ignored MODIFIEDDATE constraint. Message:", str(dateEx))
+           return(failed.code)
 
                  
         self.file_count += 1
 
-        dId = "f" + str(level) + "-" + str( random.randint(0, 1000000) )
-        nF={'type':'file',  'collapsed':False, 'level':level, 'name':path, 'dname':name, 'html':''}
+        # Only the pseudovariables in the template are evaluated; metadata is fetched on first access
+        html = self.compiledFileTemplate.render(name, path, level, parent, finfo)
 
-        # TODO: Test this more
-        nF['html'] = self.fileTemplate
-        for k, v in FILEPSEUDOVARIABLES.items():
-            nF['html'] = nF['html'].replace(k, eval(v))
-            
-        #nF['html'] = self.fileTemplate.replace('${FILELINK}', makeHtmlLink(path, name, False)).replace('${FILENAME}', name).replace('${PATH}', path).replace('${RLVLCOLOR}', random.choice(fontColorPalette)).replace('${LEVEL}', str(level)).replace('${FILESIZE}', str(finfo['size'])).replace('${FILELASTMODIFIED}', finfo['lastmodified'].strftime('%d/%m/%Y %H:%M:%S')).replace('${FILECREATED}', finfo['creationdate'].strftime('%d/%m/%Y %H:%M:%S')).replace('${PARENTPATH}', parent)
-        filename, fileExtension = os.path.splitext(path)
-        
-        if fileExtension == '':
-           fileExtension = '.ukn'
-        
-        # fileExtension starts with a dot
-        nF['html'] = nF['html'].replace('${FILEEXTENSION}', fileExtension[1:])
+        if self.usage is not None:
+           self.usage.addFile(path, finfo)
 
-        # Add to stack
-        self.stack.append(nF)
+        # Add to the directory containing it
+        self.closeDirectories(level)
+        self.stack[-1].files.append(html)
         return(0)
 
 
@@ -454,7 +628,7 @@ class ExportVisitor(Visitor):
            if self.directory_count >= self.criteria.get('maxDirs', -1):
               raise criteriaException(-10, 'Maximum number of DIRECTORIES reached.')
             
-        if not nameMatches(name, self.criteria.get('direxclusionPattern', ''), self.criteria.get('dirinclusionPattern', '')):
+        if self.compiledCriteria.directoryFailure(name) is not None:
            clrprint.clrprint(f'Ignoring DIRECTORY [{name}] due to name criteria', clr='red')
            self.ignored()
            return(-201)
@@ -466,24 +640,21 @@ class ExportVisitor(Visitor):
 
         
         
-        # Add to stack
-        nD = {'type':'directory', 'collapsed':False, 'level':level, 'name':path, 'dname':name, 'lndir':-1, 'lnfiles':-1, 'html':''}
-
-        # See if stack can be collapsed
-        self.collapse(newD=nD)
+        # Directories at the same level or below are complete
+        self.closeDirectories(level)
 
-        # Add to stack
         dId = "d" + str(level) + "-" + str( random.randint(0, 1000000) )
 
         # TODO: more tests for this
-        nD['html'] = self.dirTemplate
-        for k,v in DIRECTORYPSEUDOVARIABLES.items():
-            nD['html'] = nD['html'].replace(k, eval(v))
+        nD = ExportFrame(level, path, self.compiledDirTemplate.render(name, path, level, parent, dId))
 
         # Add to directory list. Will be used for  ${LISTOFDIRECTORIES}  
-        self.directoryList.append({'path':path, 'name':name, 'id':dId})
+        if self.directoryList is not None:
+           self.directoryList.append({'path':path, 'name':name, 'id':dId})
         
         #nD['html'] = self.dirTemplate.replace('${ID}', dId).replace('${DIRNAME}', name).replace('${PATH}', path).replace('${RLVLCOLOR}', random.choice(fontColorPalette)).replace('${LEVEL}', str(level)).replace("${OPENSTATE}", "").replace('${PARENTPATH}', parent)
+        if self.stream is not None:
+           self.stream.openFrame(self.stack[-1], nD)
         self.stack.append(nD)
         
         return(0)
@@ -491,29 +662,600 @@ class ExportVisitor(Visitor):
 
 
 
-    # TODO: Add comment.
+    # The shard's stack starts with a placeholder for the subdirectory, the same
+    # way export() starts with the root directory.
+    def shardVisitor(self, path, level):
+        v = ExportVisitor(self.dirTemplate, self.fileTemplate, self.pageTemplate, shardCriteria(self.criteria))
+        v.shardRoot = path
+        v.stack.append(ExportFrame(level, path, '${SUBDIRECTORY}'))
+        return(v)
+
+
+    # The html of the subdirectory's contents is the rendered placeholder (see export()).
+    # None if nothing has been exported.
+    def shardResult(self, level):
+        html = None
+        if len(self.stack) > 1 or not self.stack[0].empty():
+           html = self.finish().render(self.criteria.get('templateItemsSeparator', ' '))
+
+        return({'html':html,
+                'file_count':self.file_count,
+                'directory_count':self.directory_count,
+                'nIgnored':self.nIgnored,
+                'directoryList':self.directoryList,
+                'usage':None if self.usage is None else self.usage.state(self.shardRoot)})
+
+
+    # At this point, the top of the stack is the subdirectory (path) the shard
+    # traversed; its counts have not been updated yet. Its html becomes the contents
+    # of the subdirectory, so that its pseudovariables are not replaced again.
+    def mergeShard(self, path, result):
+        self.file_count += result['file_count']
+        self.directory_count += result['directory_count']
+        self.nIgnored += result['nIgnored']
+        if self.directoryList is not None:
+           self.directoryList.extend(result['directoryList'])
+        if self.usage is not None and result.get('usage') is not None:
+           self.usage.merge(path, result['usage'])
+
+        if result['html'] is None:
+           return
+
+        self.stack[-1].dirs.append(result['html'])
+
+
+
+
+    # The stack holds the rendered html of all directories not yet complete
+    def checkpointState(self):
+        return({'stack':list(self.stack),
+                'file_count':self.file_count,
+                'directory_count':self.directory_count,
+                'nIgnored':self.nIgnored,
+                'directoryList':self.directoryList,
+                'usage':self.usage})
+
+
+    def restoreCheckpoint(self, state):
+        self.stack = list(state['stack'])
+        self.file_count = state['file_count']
+        self.directory_count = state['directory_count']
+        self.nIgnored = state['nIgnored']
+        self.directoryList = state['directoryList']
+        self.usage = state['usage']
+
+
+
+    # Called once directory path has been traversed: it is the top of the stack,
+    # unless directories in it were not traversed (see closeDirectories()).
     def updateCounts(self, path, ldc, lfc, tdc, tfc):
-          stkbfr = []
-          nPops = 0
-          #clrprint.clrprint(f'Searching {path} in stack. Size:{len(self.stack)}')
-          while True:  
-              itm = self.stack.pop()
-              nPops += 1
-              if itm['name'] == path:
-                  #clrprint.clrprint(f'Found path [{path}]  in stack after {nPops} pops...')
-                  itm['html'] = itm['html'].replace('${LNDIRS}', str(ldc)).replace('${LNFILES}', str(lfc)).replace('${NDIRS}', str(tdc)).replace('${NFILES}', str(tfc))
-                  self.stack.append(itm)
-                  break
-
-              stkbfr.append(itm)
-
-          # put items back with the same order 
-          for i in stkbfr[::-1]:
-              self.stack.append(i)
-              
-
-     
-          
+          i = len(self.stack) - 1
+          while i > 0 and self.stack[i].path != path:
+                i -= 1
+          if i == 0:
+             return
+
+          self.closeDirectories(self.stack[i].level + 1)
+          frame = self.stack[-1]
+          t = (-1, -1) if self.usage is None else self.usage.closeDirectory(path)
+          if self.stream is not None:
+             self.stream.setCounts(frame, [ldc, lfc, tdc, tfc, t[0], t[1]])
+          else:
+             frame.html = frame.html.replace('${LNDIRS}', str(ldc)).replace('${LNFILES}', str(lfc)).replace('${NDIRS}', str(tdc)).replace('${NFILES}', str(tfc))
+             if self.usage is not None:
+                frame.html = frame.html.replace('${DIRSIZE}', str(t[0])).replace('${DIRALLOCATED}', str(t[1]))
+
+          self.closeDirectories(frame.level)
+
+
+
+
+# Exports a page of a paged export (see functionality.exportPages() and pagedExport.py),
+# traversed with -NR. Subdirectories with pages of their own get the link to their page
+# as contents, and the counts and disk usage of that page.
+#
+# links: path -> (html of the link, (ldc, lfc, tdc, tfc), [size, allocated] or None)
+class PageExportVisitor(ExportVisitor):
+
+      def __init__(self, dirT, fileT, pageT, criteria, links):
+          super().__init__(dirT, fileT, pageT, criteria)
+          self.links = links
+          # Total directories and files of the linked pages
+          self.linkedCounts = [0, 0]
+
+
+      def visit_directory(self, name, path, level, parent, ldc, lfc):
+          code = super().visit_directory(name, path, level, parent, ldc, lfc)
+          if code != 0 or path not in self.links:
+             return(code)
+
+          html, counts, sizes = self.links[path]
+          if self.usage is not None and sizes is not None:
+             self.usage.merge(path, {'totals':sizes, 'files':[], 'directories':[]})
+          self.stack[-1].dirs.append(html)
+          self.updateCounts(path, *counts)
+          self.linkedCounts[0] += counts[2]
+          self.linkedCounts[1] += counts[3]
+          return(code)
+
+
+      # Pages are exported by processes of their own
+      def shardVisitor(self, path, level):
+          return(None)
+
+
+      # res (see functionality.traverse()) with the counts of the linked pages
+      def pageCounts(self, res):
+          return((res[0], res[1], res[2], res[3] + self.linkedCounts[0], res[4] + self.linkedCounts[1]))
+
+
+
+
+# A directory being exported (see ExportVisitor.closeDirectories()): its html and the
+# rendered subdirectories (ExportNode or html) and files (html) it contains so far.
+class ExportFrame:
+
+      __slots__ = ('level', 'path', 'html', 'dirs', 'files', 'record', 'shard')
+
+      def __init__(self, level, path, html):
+          self.level = level
+          self.path = path
+          self.html = html
+          self.dirs = []
+          self.files = []
+          # Of the counts and the shard of the contents, if streamed (see ExportStream)
+          self.record = None
+          self.shard = None
+
+      def empty(self):
+          return(len(self.dirs) == 0 and len(self.files) == 0)
+
+      # Subdirectories come first, in order, followed by the files in reverse order
+      # (the order exports always had).
+      def node(self):
+          return(ExportNode(self.html, self.dirs + self.files[::-1]))
+
+
+
+# A complete directory of an export: its html split at ${SUBDIRECTORY} and the items
+# to insert there. Directories without contents keep ${SUBDIRECTORY} (see -RE).
+#
+# The html of a tree is written once, by write(), instead of inserting the html of each
+# directory into its parent: the contents of deep directories are not copied again
+# at every level above them.
+class ExportNode:
+
+      __slots__ = ('parts', 'contents')
+
+      def __init__(self, html, contents):
+          self.parts = html.split('${SUBDIRECTORY}') if len(contents) > 0 else [html]
+          self.contents = contents
+
+
+      # Passes the html of the tree to write() in pieces, items separated by separator.
+      # Pass contents=True to write only the contents of this directory.
+      def write(self, write, separator, contents=False):
+          # Items to write, last first: strings, or (node, index of next part)
+          pending = [(self, 0)] if not contents else self.pendingContents(separator)
+          while len(pending) > 0:
+                item = pending.pop()
+                if isinstance(item, str):
+                   write(item)
+                   continue
+
+                node, i = item
+                write(node.parts[i])
+                if i + 1 < len(node.parts):
+                   pending.append((node, i + 1))
+                   pending.extend(node.pendingContents(separator))
+
+
+      def pendingContents(self, separator):
+          pending = []
+          for j in range(len(self.contents) - 1, -1, -1):
+              c = self.contents[j]
+              pending.append(c if isinstance(c, str) else (c, 0))
+              if j > 0:
+                 pending.append(separator)
+          return(pending)
+
+
+      def render(self, separator, contents=False):
+          pieces = []
+          self.write(pieces.append, separator, contents)
+          return(''.join(pieces))
+
+
+
+# Takes the place of ExportFrame.dirs of a directory whose items are written, with
+# write(), as soon as they are complete instead of being kept (see export()).
+class ExportSpool:
+
+      __slots__ = ('write', 'separator', 'count')
+
+      def __init__(self, write, separator):
+          self.write = write
+          self.separator = separator
+          self.count = 0
+
+      # item: the html of an item or an ExportNode
+      def append(self, item):
+          if self.count > 0:
+             self.write(self.separator)
+
+          if isinstance(item, str):
+             self.write(item)
+          else:
+             item.write(self.write, self.separator)
+          self.count += 1
+
+      def __len__(self):
+          return(self.count)
+
+
+
+
+# Writes the html of the directories of an export, with write(), as soon as they are
+# visited instead of keeping it until they are complete (see ExportVisitor.closeDirectories()).
+# Memory then depends on the depth of the tree, not on its size.
+#
+# The counts of a directory are only known once it has been traversed. They are written
+# as markers, and the counts are kept in a file of fixed size records until the markers
+# are replaced, by insertCounts(), when the output is copied.
+#
+# If shards (see lazyExport.py) are given, the contents of directories every shardLevels
+# levels are written to shards of their own instead, loaded by the page when opened.
+#
+# Only for directory templates containing ${SUBDIRECTORY} exactly once.
+class ExportStream:
+
+      # -1: not known
+      RECORD = struct.Struct('<' + 'q'*len(COUNTPSEUDOVARIABLES))
+      MARKER = re.compile('\x00DWC([0-9]+):([0-9])\x00')
+
+      def __init__(self, write, separator, shards=None, shardLevels=0):
+          self.separator = separator
+          self.counts = tempfile.TemporaryFile()
+          self.records = 0
+          # Counts are also read by the threads finishing shards
+          self.lock = threading.Lock()
+          self.shards = shards
+          self.shardLevels = shardLevels
+          # Where the contents of the open directories go
+          self.outputs = [write]
+
+
+      def close(self):
+          self.counts.close()
+
+
+      # Contents of a directory (ExportFrame.dirs)
+      def spool(self):
+          return(ExportSpool(self.outputs[-1], self.separator))
+
+
+      # Opens frame, a subdirectory of parent: writes its html up to ${SUBDIRECTORY},
+      # keeping the rest for closeFrame().
+      def openFrame(self, parent, frame):
+          with self.lock:
+               frame.record = self.records
+               self.counts.seek(self.records*self.RECORD.size)
+               self.counts.write(self.RECORD.pack(*[-1]*len(COUNTPSEUDOVARIABLES)))
+               self.records += 1
+
+          html = frame.html
+          for i, pv in enumerate(COUNTPSEUDOVARIABLES):
+              html = html.replace(pv, f'\x00DWC{frame.record}:{i}\x00')
+          head, frame.html = html.split('${SUBDIRECTORY}', 1)
+          parent.dirs.append(head)
+
+          if self.shards is not None and frame.level % self.shardLevels == 0:
+             frame.shard = self.shards.open()
+             self.outputs.append(frame.shard.write)
+          frame.dirs = self.spool()
+
+
+      # Writes the files and the rest of the html of a complete directory. Directories
+      # without contents keep ${SUBDIRECTORY} (see ExportNode); those with a shard get
+      # the element loading it.
+      def closeFrame(self, frame):
+          for f in frame.files[::-1]:
+              frame.dirs.append(f)
+
+          if frame.shard is not None:
+             self.outputs.pop()
+             placeholder = self.shards.close(frame.shard, len(frame.dirs) > 0)
+
+          write = self.outputs[-1]
+          if len(frame.dirs) == 0:
+             write('${SUBDIRECTORY}')
+          elif frame.shard is not None:
+             write(placeholder)
+          write(frame.html)
+
+
+      # values: in the order of COUNTPSEUDOVARIABLES
+      def setCounts(self, frame, values):
+          with self.lock:
+               self.counts.seek(frame.record*self.RECORD.size)
+               self.counts.write(self.RECORD.pack(*values))
+
+
+      # text with markers replaced by the counts. Markers of unknown counts become the
+      # pseudovariables again.
+      def insertCounts(self, text):
+          def count(m):
+              with self.lock:
+                   self.counts.seek(int(m.group(1))*self.RECORD.size)
+                   v = self.RECORD.unpack(self.counts.read(self.RECORD.size))[int(m.group(2))]
+              return(COUNTPSEUDOVARIABLES[int(m.group(2))] if v < 0 else str(v))
+
+          return(self.MARKER.sub(count, text))
+
+
+
+
+
+
+#####################################################################
+#
+#     Virtualized tree export
+#
+#####################################################################
+
+
+# Writes every exported item, as it is visited, as a compact JSON array with write():
+#
+#      directories: [parent, name]
+#      files:       [parent, name, size]
+#
+# parent is the position of the row of the directory containing the item; the starting
+# directory is row 0 (parent -1). Items are written in the order visited, so a directory's
+# row always precedes the rows of its contents. The page (see templates/virtualTemplate.tmpl)
+# builds the tree and its counts from that and renders only the rows in view.
+#
+# Unlike ExportVisitor, nothing is kept: memory depends on the depth of the tree only.
+class VirtualTreeVisitor(Visitor):
+
+      def __init__(self, root, criteria, write):
+
+          super().__init__()
+
+          self.file_count = 0
+          self.directory_count = 0
+          self.criteria = criteria
+          self.compiledCriteria = CompiledCriteria(criteria, CompiledCriteria.EXPORTKEYS)
+
+          self.write = write
+          self.rows = 1
+          # Row of the directory being visited at each level
+          self.parents = [0]
+          self.write('[-1,' + self.jsonName(root) + ']')
+
+
+      # Name as a JSON string that can also be put in a <script> element
+      @staticmethod
+      def jsonName(name):
+          return(json.dumps(name, ensure_ascii=False).replace('<', '\\u003c'))
+
+
+      def getCriterium(self, cname='', default=-1):
+          return(self.criteria.get(cname, default))
+
+
+      def neededMetadata(self):
+          return(self.compiledCriteria.metadata | {'size'})
+
+
+      def visit_file(self, name, path, level, parent, finfo={}):
+
+          if self.criteria.get('maxFiles', -1) > 0:
+             if self.file_count >= self.criteria.get('maxFiles', -1):
+                raise criteriaException(-9, 'Maximum number of FILES reached.')
+
+          failed = self.compiledCriteria.fileFailure(name, finfo)
+          if failed is not None:
+             if failed.message is not None:
+                clrprint.clrprint(failed.message(name, finfo), clr='red')
+             self.ignored()
+             return(failed.code)
+
+          self.file_count += 1
+          self.write(f',[{self.parents[level-1]},{self.jsonName(name)},{finfo["size"]}]')
+          self.rows += 1
+          return(0)
+
+
+      def visit_directory(self, name, path, level, parent, ldc, lfc):
+
+          if self.criteria.get('maxDirs', -1) > 0:
+             if self.directory_count >= self.criteria.get('maxDirs', -1):
+                raise criteriaException(-10, 'Maximum number of DIRECTORIES reached.')
+
+          if self.compiledCriteria.directoryFailure(name) is not None:
+             clrprint.clrprint(f'Ignoring DIRECTORY [{name}] due to name criteria', clr='red')
+             self.ignored()
+             return(-201)
+
+          self.directory_count += 1
+          self.write(f',[{self.parents[level-1]},{self.jsonName(name)}]')
+          del self.parents[level:]
+          self.parents.append(self.rows)
+          self.rows += 1
+          return(0)
+
+
+
+
+
+
+#####################################################################
+#
+#     Record exports (NDJSON, CSV)
+#
+#####################################################################
+
+
+# Columns of record exports. The functions are called with the name, path, level and
+# parent path of the item and its metadata (see utilities.FileMeta); metadata is None
+# for directories.
+RECORDCOLUMNS = {'path': lambda name, path, level, parent, finfo: path,
+                 'name': lambda name, path, level, parent, finfo: name,
+                 'parent': lambda name, path, level, parent, finfo: parent,
+                 'type': lambda name, path, level, parent, finfo: 'directory' if finfo is None else 'file',
+                 'level': lambda name, path, level, parent, finfo: level,
+                 'extension': lambda name, path, level, parent, finfo: None if finfo is None else os.path.splitext(name)[1][1:],
+                 'size': lambda name, path, level, parent, finfo: None if finfo is None else finfo['size'],
+                 'lastmodified': lambda name, path, level, parent, finfo: None if finfo is None or finfo['lastmodified'] in ('', None) else finfo['lastmodified'].isoformat(),
+                 'created': lambda name, path, level, parent, finfo: None if finfo is None or finfo['creationdate'] in ('', None) else finfo['creationdate'].isoformat()}
+
+# File metadata fields columns need
+RECORDMETADATA = {'size': 'size', 'lastmodified': 'lastmodified', 'created': 'creationdate'}
+
+RECORDFORMATS = ['ndjson', 'csv']
+
+
+# A value of a column (str, int or None) as JSON
+def jsonValue(v):
+    if v.__class__ is str:
+       return(jsonString(v))
+    if v is None:
+       return('null')
+    return(str(v))
+
+
+# Writes one record per exported directory and file to out (a text file), as it is
+# visited: a JSON object per line (ndjson) or a row of comma separated values with a
+# header row (csv). Values are escaped by the json and csv modules, so the output is
+# always valid whatever the names. Nothing is kept in memory.
+#
+# Criterium columns: comma separated names of RECORDCOLUMNS.
+class RecordExportVisitor(Visitor):
+
+      def __init__(self, criteria, out=None):
+
+          super().__init__()
+
+          self.file_count = 0
+          self.directory_count = 0
+          self.criteria = criteria
+          self.compiledCriteria = CompiledCriteria(criteria, CompiledCriteria.EXPORTKEYS)
+
+          self.format = criteria.get('exportFormat', 'ndjson')
+          if self.format not in RECORDFORMATS:
+             raise ValueError(f'Unknown record format [{self.format}]. Supported: {", ".join(RECORDFORMATS)}')
+
+          self.columns = [c.strip() for c in criteria.get('columns', 'path,type,size,lastmodified').split(',') if c.strip() != '']
+          unknown = [c for c in self.columns if c not in RECORDCOLUMNS]
+          if len(unknown) > 0 or len(self.columns) == 0:
+             raise ValueError(f'Unknown columns [{", ".join(unknown)}]. Supported: {", ".join(RECORDCOLUMNS)}')
+
+          # Records of shards are written to a temporary file (see __setstate__())
+          self.spool = None
+          self.setOutput(out)
+
+
+      # Header row of csv
+      def writeHeader(self):
+          if self.writer is not None:
+             self.writer.writerow(self.columns)
+
+
+      def setOutput(self, out):
+          self.out = out
+          self.functions = [RECORDCOLUMNS[c] for c in self.columns]
+          # ndjson: the key of each column, as JSON, with its function
+          self.fields = [(('{' if i == 0 else ',') + jsonString(c) + ':', RECORDCOLUMNS[c]) for i, c in enumerate(self.columns)]
+          self.writer = None
+          if out is not None and self.format == 'csv':
+             self.writer = csv.writer(out)
+
+
+      # Objects are put together from their keys and values; about twice as fast as json.dumps()
+      def record(self, name, path, level, parent, finfo):
+          if self.writer is not None:
+             self.writer.writerow([f(name, path, level, parent, finfo) for f in self.functions])
+          else:
+             self.out.write(''.join([k + jsonValue(f(name, path, level, parent, finfo)) for k, f in self.fields]) + '}\n')
+
+
+      def getCriterium(self, cname='', default=-1):
+          return(self.criteria.get(cname, default))
+
+
+      def neededMetadata(self):
+          return(self.compiledCriteria.metadata | {RECORDMETADATA[c] for c in self.columns if c in RECORDMETADATA})
+
+
+      def visit_file(self, name, path, level, parent, finfo={}):
+
+          if self.criteria.get('maxFiles', -1) > 0:
+             if self.file_count >= self.criteria.get('maxFiles', -1):
+                raise criteriaException(-9, 'Maximum number of FILES reached.')
+
+          failed = self.compiledCriteria.fileFailure(name, finfo)
+          if failed is not None:
+             if failed.message is not None:
+                clrprint.clrprint(failed.message(name, finfo), clr='red')
+             self.ignored()
+             return(failed.code)
+
+          self.file_count += 1
+          self.record(name, path, level, parent, finfo)
+          return(0)
+
+
+      def visit_directory(self, name, path, level, parent, ldc, lfc):
+
+          if self.criteria.get('maxDirs', -1) > 0:
+             if self.directory_count >= self.criteria.get('maxDirs', -1):
+                raise criteriaException(-10, 'Maximum number of DIRECTORIES reached.')
+
+          if self.compiledCriteria.directoryFailure(name) is not None:
+             clrprint.clrprint(f'Ignoring DIRECTORY [{name}] due to name criteria', clr='red')
+             self.ignored()
+             return(-201)
+
+          self.directory_count += 1
+          self.record(name, path, level, parent, None)
+          return(0)
+
+
+      # Shard visitors are sent to worker processes without output; there, records go
+      # to a temporary file that mergeShard() appends to the output.
+      def __getstate__(self):
+          state = dict(self.__dict__)
+          for k in ('out', 'functions', 'fields', 'writer'):
+              del state[k]
+          return(state)
+
+      def __setstate__(self, state):
+          self.__dict__.update(state)
+          self.spool = tempfile.NamedTemporaryFile('w', encoding='utf8', errors='backslashreplace', newline='', suffix='.records', delete=False)
+          self.setOutput(self.spool)
+
+
+      def shardVisitor(self, path, level):
+          return(RecordExportVisitor(shardCriteria(self.criteria)))
+
+
+      def shardResult(self, level):
+          self.spool.close()
+          return({'records':self.spool.name,
+                  'file_count':self.file_count,
+                  'directory_count':self.directory_count,
+                  'nIgnored':self.nIgnored})
+
+
+      def mergeShard(self, path, result):
+          self.file_count += result['file_count']
+          self.directory_count += result['directory_count']
+          self.nIgnored += result['nIgnored']
+          try:
+             with open(result['records'], 'r', encoding='utf8', newline='') as f:
+                  shutil.copyfileobj(f, self.out, 1<<16)
+          finally:
+             os.remove(result['records'])
 
 
 
@@ -541,8 +1283,11 @@ class SearchVisitor(Visitor):
 
         self.query = qry
         self.criteria = criteria
+        self.compiledCriteria = CompiledCriteria({} if criteria is None else criteria)
         
         self.matches = []
+        # If set, a text file matching paths are also written to, one per line, as found
+        self.results = None
 
 
 
@@ -568,64 +1313,21 @@ class SearchVisitor(Visitor):
                if self.file_count >= self.criteria.get('maxFiles', -1):
                   raise criteriaException(-9, 'Maximum number of FILES reached.')
 
-            matchedFileName = searchNameComplies(name, self.criteria.get('fileexclusionPattern', ''),
-                                                 self.criteria.get('fileinclusionPattern', ''), r'/\1/', False)
-            if matchedFileName == '':
-               self.ignored() 
+            failed = self.compiledCriteria.fileFailure(name, finfo)
+            if failed is not None:
+               if failed.message is not None:
+                  clrprint.clrprint(failed.message(name, finfo), clr='red')
+               self.ignored()
                return(0)
 
-            
-            if self.criteria.get('fileSize', -1) >= 0:
-               if int(finfo['size']) != self.criteria.get('fileSize', -1):
-                  self.ignored()
-                  return(0)
-                   
-            if self.criteria.get('minFileSize', -1) >= 0:
-               if int(finfo['size']) < self.criteria.get('minFileSize', -1):
-                   self.ignored() 
-                   return(0)
-
-            if self.criteria.get('maxFileSize', -1) >= 0:
-               if int(finfo['size']) > self.criteria.get('maxFileSize', -1):
-                   self.ignored() 
-                   return(0)
-
-            if self.criteria.get('creationDate', '') != '':
-               try:
-                 if self.criteria.get('creationDateOp', '==') == '=':
-                    clrprint.clrprint(f"[WARNING] Did you mean == (seen {self.criteria.get('creationDateOp', '==')}")
-                 
-                 expr = f"finfo['creationdate'].date() {self.criteria.get('creationDateOp', '==')} normalizeDateTime(self.criteria.get('creationDate', ''))"
-                 if not eval(expr):
-                    clrprint.clrprint(f'Ignoring FILE [{name}] due to CREATION DATE criteria file created: {finfo["creationdate"].strftime("%d/%m/%Y")}', clr='red') 
-                    self.ignored()
-                    return(0)
-               except Exception as dateEx:
-                    print(f"Invalid date [{self.criteria.get('creationDate', '')}]. Ignored CREATIONDATE constraint. Message:", str(dateEx))
-                 
-
-            if self.criteria.get('lastModifiedDate', '') != '':
-               try:
-                 if self.criteria.get('lastModifiedDateOp', '==') == '=':
-                    clrprint.clrprint(f"[WARNING] Did you mean == (seen {self.criteria.get('lastModifiedDateOp', '==')}")
-                 
-                 expr = f"finfo['lastmodified'].date() {self.criteria.get('lastModifiedDateOp', '==')} normalizeDateTime(self.criteria.get('lastModifiedDate', ''))"
-                 if not eval(expr):
-                    clrprint.clrprint(f'Ignoring FILE [{name}] due to MODIFIED DATE criteria file created: {finfo["lastmodified"].strftime("%d/%m/%Y")}', clr='red') 
-                    self.ignored()
-                    return(0)
-                
-               except Exception as dateEx:
-                 print(f"Invalid date [{self.criteria.get('lastModifiedDate', '')}]. Ignored MODIFIEDDATE constraint. Message:", str(dateEx))
-
 
 
             self.file_count += 1
 
             clrprint.clrprint('\t[F] ', clr='green', end='')
-            clrprint.clrprint(f' [{finfo["size"]}][{finfo["creationdate"].strftime("%d/%m/%Y %H:%M:%S")}][{finfo["lastmodified"].strftime("%d/%m/%Y %H:%M:%S")}] ', clr='yellow', end='')
-            self.matches.append(path)
-            printPath(parent, matchedFileName, '/', 'green')
+            clrprint.clrprint(f' [{finfo["size"]}][{formatDateTime(finfo["creationdate"])}][{formatDateTime(finfo["lastmodified"])}] ', clr='yellow', end='')
+            self.found(path)
+            printPath(parent, self.compiledCriteria.markFileName(name, r'/\1/'), '/', 'green')
             return(0)
 
             
@@ -649,8 +1351,7 @@ class SearchVisitor(Visitor):
             # TODO: Should creation/modified date checked as well?
             
             
-            matchedDirName = searchNameComplies(name, self.criteria.get('direxclusionPattern', ''), self.criteria.get('dirinclusionPattern', ''), r'/\1/', False)
-            if matchedDirName == '':
+            if self.compiledCriteria.directoryFailure(name) is not None:
                self.ignored()  
                return(0)
 
@@ -659,10 +1360,160 @@ class SearchVisitor(Visitor):
             self.directory_count += 1
             
             clrprint.clrprint('\t[D] ', clr='red', end='')
-            self.matches.append(path)
-            printPath(parent, matchedDirName, '/', 'red')
+            self.found(path)
+            printPath(parent, self.compiledCriteria.markDirectoryName(name, r'/\1/'), '/', 'red')
             return(0)
 
 
 
+      def found(self, *paths):
+          self.matches.extend(paths)
+          if self.results is not None:
+             for p in paths:
+                 self.results.write(p + '\n')
+
+
+
+      # Found files are displayed with all their metadata
+      def neededMetadata(self):
+          if self.getCriterium('noFiles', False):
+             return(set())
+          return(set(FileMeta.__slots__))
+
+
+      def shardVisitor(self, path, level):
+          return(SearchVisitor(self.query, shardCriteria(self.criteria)))
+
+
+      def shardResult(self, level):
+          return({'matches':self.matches,
+                  'file_count':self.file_count,
+                  'directory_count':self.directory_count,
+                  'nIgnored':self.nIgnored})
+
+
+      def mergeShard(self, path, result):
+          self.found(*result['matches'])
+          self.file_count += result['file_count']
+          self.directory_count += result['directory_count']
+          self.nIgnored += result['nIgnored']
+
+
+      def checkpointState(self):
+          return(self.shardResult(0))
+
+
+      def restoreCheckpoint(self, state):
+          self.matches = []
+          self.found(*state['matches'])
+          self.file_count = state['file_count']
+          self.directory_count = state['directory_count']
+          self.nIgnored = state['nIgnored']
+
+
+
+
+#####################################################################
+#
+#     Disk usage
+#
+#####################################################################
+
+
+# Aggregates the disk usage of directories (see diskUsage.py) in the same traversal
+# that counts them, keeping the top largest directories and files.
+# Files and directories not complying with the criteria are not counted.
+class UsageVisitor(Visitor):
+
+      def __init__(self, criteria):
+
+        super().__init__()
+
+        self.file_count = 0
+        self.directory_count = 0
+
+        self.criteria = criteria
+        self.compiledCriteria = CompiledCriteria(criteria)
+        self.usage = diskUsage.DiskUsage(criteria.get('top', 10))
+        # Root of the shard traversed by this visitor (see shardVisitor())
+        self.shardRoot = None
+
+
+
+      def getCriterium(self, cname='', default=-1):
+          return(self.criteria.get(cname, default))
+
+
+
+      def visit_file(self, name, path, level, parent, finfo={}):
+
+            if self.criteria.get('maxFiles', -1) > 0:
+               if self.file_count >= self.criteria.get('maxFiles', -1):
+                  raise criteriaException(-9, 'Maximum number of FILES reached.')
+
+            if self.compiledCriteria.fileFailure(name, finfo) is not None:
+               self.ignored()
+               return(0)
+
+            self.file_count += 1
+            self.usage.addFile(path, finfo)
+            return(0)
+
+
+
+      # Excluded directories are not traversed
+      def visit_directory(self, name, path, level, parent, ldc, lfc):
+
+            if self.criteria.get('maxDirs', -1) > 0:
+               if self.directory_count >= self.criteria.get('maxDirs', -1):
+                  raise criteriaException(-10, 'Maximum number of DIRECTORIES reached.')
+
+            if self.compiledCriteria.directoryFailure(name) is not None:
+               self.ignored()
+               return(-201)
+
+            self.directory_count += 1
+            return(0)
+
+
+
+      def updateCounts(self, path, ldc, lfc, tdc, tfc):
+          self.usage.closeDirectory(path)
+
+
+      def neededMetadata(self):
+          return(self.compiledCriteria.metadata | USAGEMETADATA)
+
+
+      def shardVisitor(self, path, level):
+          v = UsageVisitor(shardCriteria(self.criteria))
+          v.shardRoot = path
+          return(v)
+
+
+      def shardResult(self, level):
+          return({'usage':self.usage.state(self.shardRoot),
+                  'file_count':self.file_count,
+                  'directory_count':self.directory_count,
+                  'nIgnored':self.nIgnored})
+
+
+      def mergeShard(self, path, result):
+          self.usage.merge(path, result['usage'])
+          self.file_count += result['file_count']
+          self.directory_count += result['directory_count']
+          self.nIgnored += result['nIgnored']
+
+
+      def checkpointState(self):
+          return({'usage':self.usage,
+                  'file_count':self.file_count,
+                  'directory_count':self.directory_count,
+                  'nIgnored':self.nIgnored})
+
 
+      def restoreCheckpoint(self, state):
+          self.usage = state['usage']
+          self.file_count = state['file_count']
+          self.directory_count = state['directory_count']
+          self.nIgnored = state['nIgnored']
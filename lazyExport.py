@@ -0,0 +1,169 @@
+#
+#
+#
+# Shards of lazy loaded exports (-LZ).
+#
+# The contents of directories every lazyLevels levels are not written in the page but in
+# shards of their own, next to the page in directory <page name>-shards. In their place the
+# page gets an element (PLACEHOLDER) that the script of the page (LOADER) replaces with the
+# contents of the shard once the <details> element of the directory is opened. Shards
+# contain the shards of their deeper directories the same way.
+#
+# The page therefore holds only the top levels, no matter the size of the tree, and is
+# shown at once.
+#
+# Shards are scripts (JSONP) calling dirWalkerShard(id, html): browsers do not allow
+# fetch() or $.get() of files for pages opened from the file system (file://).
+#
+# A directory is written to a temporary file in the shards directory while traversed
+# (see handlers.ExportStream). Once complete, it is turned into its shard by a pool of
+# threads while the traversal continues.
+#
+# NOTE: Shards get the pseudovariables of the page (${CRITERIA}, ${TITLE} etc) but not
+#       the counts of the whole traversal (${NDIRS} etc), which are not known yet.
+#
+#
+#
+
+
+import os
+import re
+import json
+import tempfile
+import urllib.parse
+import concurrent.futures
+
+
+
+
+PLACEHOLDER = '<span class="dirWalkerShard" data-id="{id}" data-src="{src}"></span>'
+
+# No ${ in here: the page template is searched for pseudovariables after it is inserted
+LOADER = '''
+<script>
+  // Contents of directories are loaded from shards when opened (see dirWalker -LZ)
+  function dirWalkerLoadShards(root){
+     root.querySelectorAll('.dirWalkerShard:not([data-loading])').forEach(function(p){
+         var d = p.closest('details');
+         if (d !== null && !d.open)
+            return;
+         p.setAttribute('data-loading', '');
+         var s = document.createElement('script');
+         s.src = p.getAttribute('data-src');
+         document.body.appendChild(s);
+     });
+  }
+
+  function dirWalkerShard(id, html){
+     var p = document.querySelector('.dirWalkerShard[data-id="' + id + '"]');
+     if (p === null)
+        return;
+     var parent = p.parentElement;
+     p.insertAdjacentHTML('afterend', html);
+     p.remove();
+     dirWalkerLoadShards(parent);
+  }
+
+  document.addEventListener('toggle', function(e){
+     if (e.target.open)
+        dirWalkerLoadShards(e.target);
+  }, true);
+
+  dirWalkerLoadShards(document);
+</script>
+'''
+
+
+# page with LOADER inserted before </body>. Pages that are not html (no </body>) are
+# returned as they are.
+def withLoader(page):
+    i = page.lower().rfind('</body>')
+    if i < 0:
+       return(page)
+    return(page[:i] + LOADER + page[i:])
+
+
+
+
+# Contents of a directory written to a shard
+class Shard:
+
+      __slots__ = ('id', 'file', 'write')
+
+      def __init__(self, id, file):
+          self.id = id
+          self.file = file
+          self.write = file.write
+
+
+
+
+# directory: where shards are written, created if needed. Shards of previous exports in it
+#            are removed.
+# finish:    finish(f, write) copies the text of a complete directory, file f, to write(),
+#            replacing its pseudovariables (see functionality.export()). Called by the threads.
+# workers:   number of threads finishing shards.
+class ExportShards:
+
+      def __init__(self, directory, finish, workers=1):
+          self.directory = directory
+          self.finish = finish
+          self.workers = max(1, workers)
+          # Relative to the page, which is in the parent of directory
+          self.url = urllib.parse.quote(os.path.basename(os.path.normpath(directory)))
+          self.count = 0
+          self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+          self.pending = []
+
+          os.makedirs(directory, exist_ok=True)
+          for name in os.listdir(directory):
+              if re.fullmatch(r'[0-9]+\.js', name):
+                 os.remove(os.path.join(directory, name))
+
+
+      def path(self, id):
+          return(os.path.join(self.directory, f'{id}.js'))
+
+
+      def open(self):
+          self.count += 1
+          return(Shard(self.count, tempfile.TemporaryFile('w+', encoding='utf8', dir=self.directory)))
+
+
+      # Closes a shard whose directory is complete. Returns the html to put in its place if
+      # the shard has contents.
+      def close(self, shard, contents=True):
+          if not contents:
+             shard.file.close()
+             return(None)
+
+          # Every pending shard holds an open file; wait for the oldest when too many
+          for p in self.pending:
+              if p.done():
+                 p.result()
+          self.pending = [p for p in self.pending if not p.done()]
+          if len(self.pending) >= 4*self.workers:
+             self.pending.pop(0).result()
+
+          self.pending.append(self.pool.submit(self.write, shard))
+          return(PLACEHOLDER.format(id=shard.id, src=f'{self.url}/{shard.id}.js'))
+
+
+      def write(self, shard):
+          try:
+             with open(self.path(shard.id), 'w', encoding='utf8') as f:
+                  f.write(f'dirWalkerShard({shard.id}, "')
+                  self.finish(shard.file, lambda text: f.write(json.dumps(text, ensure_ascii=False)[1:-1]))
+                  f.write('");\n')
+          finally:
+             shard.file.close()
+
+
+      # Waits for all shards to be written. Raises the first error of the threads, if any.
+      def wait(self):
+          try:
+             for p in self.pending:
+                 p.result()
+          finally:
+             self.pool.shutdown(wait=True)
+             self.pending = []
@@ -0,0 +1,104 @@
+#
+#
+#
+# Pages of paged exports (-PG).
+#
+# The starting directory and every directory down to level pageLevels get a page of their
+# own. The page of the starting directory is the output file; the others are written to
+# directory <output file name>-pages, at the path of their directory relative to the
+# starting directory, e.g. index-pages/a/b/index.html for directory a/b.
+#
+# Pages of directories at level pageLevels show their whole subtree. The others show their
+# files and subdirectories only: each subdirectory gets a link to its page (LINK) as its
+# contents, and the counts of that page. Every page therefore has the summaries (${NDIRS}
+# etc) of its whole subtree, as a single page export would. ${BREADCRUMB} of the page
+# template becomes the links to the pages above it (BREADCRUMB).
+#
+# Since the name of a page depends on its directory only, the pages of a subtree can be
+# exported again (see pageSubtree) without touching the others.
+#
+# See functionality.exportPages().
+#
+#
+#
+
+
+import os
+import html
+import urllib.parse
+
+import compression
+
+
+
+
+LINK = '<a class="dirWalkerPage" href="{href}">{name} &rarr;</a>'
+
+BREADCRUMB = '<div class="dirWalkerBreadcrumb">{items}</div>'
+
+
+
+
+# Names of the directories of path, relative to the starting directory
+def pageParts(path):
+    path = os.path.normpath(path)
+    if path in ('', '.'):
+       return(())
+    return(tuple(path.split(os.sep)))
+
+
+
+
+# root:       the starting directory.
+# outputFile: the page of root.
+class ExportPages:
+
+      def __init__(self, root, outputFile, criteria):
+          self.root = root
+          self.outputFile = outputFile
+          self.criteria = criteria
+          stem, self.extension = os.path.splitext(compression.plainPath(outputFile, criteria))
+          self.directory = stem + '-pages'
+
+          self.rootText = root
+          if criteria.get('traversalRootDir', '') not in (None, ''):
+             self.rootText = criteria.get('traversalRootDir', '')
+
+
+      # Directory of the page with parts (see pageParts())
+      def path(self, parts):
+          return(os.path.join(self.root, *parts))
+
+
+      # File the page is exported to (before the suffix of compression; see compression.outputPath())
+      def file(self, parts):
+          if len(parts) == 0:
+             return(self.outputFile)
+          return(os.path.join(self.directory, *parts, 'index' + self.extension))
+
+
+      # Url of the page to, relative to the page at
+      def href(self, at, to):
+          target = compression.outputPath(self.file(to), self.criteria)
+          url = os.path.relpath(target, os.path.dirname(self.file(at)) or '.')
+          return(urllib.parse.quote(url.replace(os.sep, '/')))
+
+
+      # Contents of directory to in the page at
+      def link(self, at, to):
+          return(LINK.format(href=self.href(at, to), name=html.escape(to[-1])))
+
+
+      # Links to the pages above the page at; its own name is not a link
+      def breadcrumb(self, at):
+          names = [self.rootText] + list(at)
+          items = [f'<a href="{self.href(at, at[:i])}">{html.escape(name)}</a>' for i, name in enumerate(names[:-1])]
+          items.append(f'<b>{html.escape(names[-1])}</b>')
+          return(BREADCRUMB.format(items=' / '.join(items)))
+
+
+      # ${TRAVERSALROOTDIR} of the page at
+      def rootDir(self, at):
+          if self.rootText == self.root:
+             return('')
+          return('/'.join([self.rootText] + list(at)))
@@ -0,0 +1,447 @@
+
+#
+#
+#
+# Snapshots: the result of traversing a directory, stored in a compact binary file,
+# so that it can be exported, searched and compared again without walking it.
+#
+# A snapshot holds every entry below its root (names, types, sizes, times, devices,
+# inodes, link counts) in columns:
+#
+#   header       magic, version, byte order, number of entries and names, root path
+#   names        each distinct name once (utf8), with their offsets
+#   columns      one array per field, one value per entry: size, blocks, mtime,
+#                created, dev, ino, mode, nlink, parent, name, first, children
+#
+# Entries are stored breadth first with the entries of every directory sorted by name,
+# so the entries of directory i are those from first[i] to first[i]+children[i]. Entry 0
+# is the root. Looking up a path is a binary search per component.
+#
+# Snapshots are read through SnapshotFileSystem (see fileSystems.py), which maps the file
+# instead of reading it: opening a snapshot takes the same time whatever its size, and
+# only the parts of it actually traversed are read from disk.
+#
+# NOTE: Directories reached twice (e.g. through symbolic links) are stored empty the
+#       second time. Listing and stat errors are stored and raised again when reading.
+#       Contents of files are not stored.
+#
+#
+#
+
+
+import os
+import sys
+import mmap
+import stat
+import time
+import errno
+import struct
+import tempfile
+import collections
+from array import array
+
+import fileSystems
+from utilities import InodeSet, creationTimestamp
+
+
+
+MAGIC = b'DWSNAP\x00\x00'
+VERSION = 1
+
+# magic, version, byte order, number of entries, number of names, time taken, length of root
+HEADER = struct.Struct('<8sI4sQQdQ')
+
+# (name, array typecode)
+COLUMNS = [('size', 'q'), ('blocks', 'q'), ('mtime', 'd'), ('created', 'd'), ('dev', 'Q'), ('ino', 'Q'),
+           ('mode', 'I'), ('nlink', 'I'), ('parent', 'I'), ('name', 'I'), ('first', 'I'), ('children', 'I')]
+
+# Columns taken from the stat of entries
+STATCOLUMNS = ['size', 'blocks', 'mtime', 'created', 'dev', 'ino', 'nlink']
+
+# Flags stored in the mode column above the actual mode
+STATFAILED = 1 << 31
+SYMLINK = 1 << 30
+MODEMASK = 0xFFFF
+
+# children of directories that could not be listed; first then holds the errno
+LISTFAILED = 0xFFFFFFFF
+NOPARENT = 0xFFFFFFFF
+
+# Entries buffered per column before being written
+CHUNK = 65536
+
+
+
+def padding(n):
+    return(b'\x00' * (-n % 8))
+
+
+
+
+# Column files of a snapshot being written. Entries are added in the order they are
+# stored; first and children are added separately, when the entry is listed.
+class ColumnWriter:
+
+      def __init__(self, directory):
+          self.files = {}
+          self.buffers = {}
+          for name, typecode in COLUMNS:
+              self.files[name] = open(os.path.join(directory, name), 'wb')
+              self.buffers[name] = array(typecode)
+
+
+      def append(self, name, value):
+          b = self.buffers[name]
+          b.append(value)
+          if len(b) >= CHUNK:
+             b.tofile(self.files[name])
+             del b[:]
+
+
+      def close(self):
+          for name, f in self.files.items():
+              self.buffers[name].tofile(f)
+              f.close()
+
+
+
+# Writes the snapshot of directory root, read from fileSystem (default: the current
+# file system), to file path. The file is replaced only once the snapshot is complete.
+# Returns the number of entries stored.
+# Raises OSError if root cannot be read.
+def write(root, path, fileSystem=None):
+    fs = fileSystems.current if fileSystem is None else fileSystem
+    root = os.path.normpath(root)
+    if not fs.isdir(root):
+       raise NotADirectoryError(errno.ENOTDIR, os.strerror(errno.ENOTDIR), root)
+
+    names = {}
+    visited = InodeSet()
+    started = time.time()
+    target = os.path.abspath(path)
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(target), prefix='.dwSnapshot-') as tmp:
+         columns = ColumnWriter(tmp)
+         nameFile = open(os.path.join(tmp, 'names'), 'wb')
+         nameOffsets = array('Q', [0])
+
+         def add(name, parent, st, isDir, isLink, error=0):
+             n = names.get(name)
+             if n is None:
+                n = names[name] = len(names)
+                encoded = name.encode('utf8', 'surrogateescape')
+                nameFile.write(encoded)
+                nameOffsets.append(nameOffsets[-1] + len(encoded))
+
+             if st is None:
+                mode = (stat.S_IFDIR if isDir else stat.S_IFREG) | STATFAILED
+                values = (-1, error, 0.0, 0.0, 0, 0, 1)
+             else:
+                blocks = getattr(st, 'st_blocks', None)
+                mode = stat.S_IFMT(st.st_mode) | stat.S_IMODE(st.st_mode)
+                values = (st.st_size, -1 if blocks is None else blocks, st.st_mtime, creationTimestamp(st),
+                          st.st_dev, st.st_ino, st.st_nlink)
+             if isLink:
+                mode |= SYMLINK
+
+             for c, v in zip(STATCOLUMNS, values):
+                 columns.append(c, v)
+             columns.append('mode', mode)
+             columns.append('parent', parent)
+             columns.append('name', n)
+
+         rootStat = fs.stat(root)
+         add(os.path.basename(os.path.abspath(root)), NOPARENT, rootStat, True, False)
+         # (path, is directory, stat) of the entries stored but not listed yet, in order
+         pending = collections.deque([(root, True, rootStat)])
+         count = 1
+         current = 0
+         try:
+            while len(pending) > 0:
+                  p, isDir, st = pending.popleft()
+                  first, n = 0, 0
+                  if isDir and (st is None or visited.add(st.st_dev, st.st_ino)):
+                     try:
+                        entries = sorted(fs.listDirectory(p), key=lambda e: e.name)
+                        first, n = count, len(entries)
+                     except OSError as lsEx:
+                        entries = []
+                        first, n = lsEx.errno or errno.EIO, LISTFAILED
+
+                     for e in entries:
+                         try:
+                            isEntryDir = e.is_dir()
+                         except OSError:
+                            isEntryDir = False
+                         try:
+                            isLink = e.is_symlink()
+                         except OSError:
+                            isLink = False
+                         try:
+                            est, error = e.stat(), 0
+                         except OSError as stEx:
+                            est, error = None, stEx.errno or errno.EIO
+
+                         add(e.name, current, est, isEntryDir, isLink, error)
+                         pending.append((os.path.join(p, e.name), isEntryDir, est))
+                         count += 1
+
+                  columns.append('first', first)
+                  columns.append('children', n)
+                  current += 1
+         finally:
+            columns.close()
+            nameFile.close()
+
+         tmpPath = target + '.tmp'
+         with open(tmpPath, 'wb') as sf:
+              rootPath = os.path.abspath(root).encode('utf8', 'surrogateescape')
+              sf.write(HEADER.pack(MAGIC, VERSION, sys.byteorder[0].encode().ljust(4, b'\x00'), count, len(names), started, len(rootPath)))
+              sf.write(rootPath + padding(len(rootPath)))
+              sf.write(nameOffsets.tobytes())
+              for name in ['names'] + [c for c, t in COLUMNS]:
+                  with open(os.path.join(tmp, name), 'rb') as cf:
+                       size = 0
+                       while True:
+                             chunk = cf.read(1 << 20)
+                             if not chunk:
+                                break
+                             sf.write(chunk)
+                             size += len(chunk)
+                  sf.write(padding(size))
+         os.replace(tmpPath, target)
+
+    return(count)
+
+
+
+
+# Looks like an os.stat_result
+class SnapshotStat:
+
+      __slots__ = ('st_mode', 'st_ino', 'st_dev', 'st_nlink', 'st_size', 'st_blocks', 'st_atime', 'st_mtime', 'st_ctime', 'st_birthtime')
+
+      def __init__(self, snapshot, i):
+          self.st_mode = snapshot.mode[i] & MODEMASK
+          self.st_ino = snapshot.ino[i]
+          self.st_dev = snapshot.dev[i]
+          self.st_nlink = snapshot.nlink[i]
+          self.st_size = snapshot.size[i]
+          if snapshot.blocks[i] >= 0:
+             self.st_blocks = snapshot.blocks[i]
+          self.st_mtime = self.st_atime = snapshot.mtime[i]
+          # See utilities.creationTimestamp()
+          self.st_ctime = self.st_birthtime = snapshot.created[i]
+
+
+
+# Looks like an os.DirEntry
+class SnapshotEntry:
+
+      __slots__ = ('snapshot', 'id', 'name', 'path')
+
+      def __init__(self, snapshot, i, name, path):
+          self.snapshot = snapshot
+          self.id = i
+          self.name = name
+          self.path = path
+
+      def is_dir(self, follow_symlinks=True):
+          return(stat.S_ISDIR(self.snapshot.mode[self.id]))
+
+      def is_file(self, follow_symlinks=True):
+          return(not self.is_dir())
+
+      def is_symlink(self):
+          return(self.snapshot.mode[self.id] & SYMLINK != 0)
+
+      def stat(self, follow_symlinks=True):
+          return(self.snapshot.stat(self.id, self.path))
+
+      def inode(self):
+          return(self.snapshot.ino[self.id])
+
+
+
+
+# A snapshot file, mapped into memory. Raises ValueError if path is not a snapshot
+# that can be read here.
+class Snapshot:
+
+      def __init__(self, path):
+          self.path = path
+          with open(path, 'rb') as sf:
+               self.map = mmap.mmap(sf.fileno(), 0, access=mmap.ACCESS_READ)
+
+          self.views = []
+          try:
+             self.parse()
+          except Exception:
+             self.close()
+             raise
+
+
+      def section(self, offset, length, typecode=None):
+          v = memoryview(self.map)[offset:offset + length]
+          self.views.append(v)
+          if typecode is not None:
+             v = v.cast(typecode)
+             self.views.append(v)
+          return(v, offset + length + (-length % 8))
+
+
+      def parse(self):
+          if len(self.map) < HEADER.size:
+             raise ValueError(f'[{self.path}] is not a snapshot')
+          magic, version, byteorder, self.entries, nNames, self.taken, rootLength = HEADER.unpack_from(self.map, 0)
+          if magic != MAGIC:
+             raise ValueError(f'[{self.path}] is not a snapshot')
+          if version != VERSION:
+             raise ValueError(f'Snapshot [{self.path}] made by another version')
+          if byteorder.rstrip(b'\x00') != sys.byteorder[0].encode():
+             raise ValueError(f'Snapshot [{self.path}] made on a machine with another byte order')
+
+          offset = HEADER.size
+          self.root = str(self.map[offset:offset + rootLength], 'utf8', 'surrogateescape')
+          self.prefix = os.path.join(self.root, '')
+          offset += rootLength + (-rootLength % 8)
+
+          self.nameOffsets, offset = self.section(offset, 8*(nNames + 1), 'Q')
+          self.names, offset = self.section(offset, self.nameOffsets[nNames])
+          for name, typecode in COLUMNS:
+              column, offset = self.section(offset, self.entries * array(typecode).itemsize, typecode)
+              setattr(self, name, column)
+
+
+      def close(self):
+          for v in reversed(self.views):
+              v.release()
+          self.views = []
+          self.map.close()
+
+
+      def nameOf(self, i):
+          n = self.name[i]
+          return(str(self.names[self.nameOffsets[n]:self.nameOffsets[n+1]], 'utf8', 'surrogateescape'))
+
+
+      # Components of path below the root; None if path is not in this snapshot.
+      def components(self, path):
+          path = os.path.abspath(path)
+          if path == self.root:
+             return([])
+          if not path.startswith(self.prefix):
+             return(None)
+          return(path[len(self.prefix):].split(os.sep))
+
+
+      # Entry named name in directory i, or None
+      def child(self, i, name):
+          lo, hi = self.first[i], self.first[i] + self.children[i]
+          while lo < hi:
+                mid = (lo + hi) // 2
+                midName = self.nameOf(mid)
+                if midName == name:
+                   return(mid)
+                if midName < name:
+                   lo = mid + 1
+                else:
+                   hi = mid
+          return(None)
+
+
+      # Entry of path given by its components (see components())
+      def lookup(self, components, path):
+          i = 0
+          for c in components:
+              if not stat.S_ISDIR(self.mode[i]):
+                 raise NotADirectoryError(errno.ENOTDIR, os.strerror(errno.ENOTDIR), path)
+              i = None if self.children[i] == LISTFAILED else self.child(i, c)
+              if i is None:
+                 raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+          return(i)
+
+
+      def stat(self, i, path):
+          if self.mode[i] & STATFAILED:
+             error = self.blocks[i]
+             raise OSError(error, os.strerror(error), path)
+          return(SnapshotStat(self, i))
+
+
+      def listDirectory(self, i, path):
+          if not stat.S_ISDIR(self.mode[i]):
+             raise NotADirectoryError(errno.ENOTDIR, os.strerror(errno.ENOTDIR), path)
+          if self.children[i] == LISTFAILED:
+             error = self.first[i]
+             raise OSError(error, os.strerror(error), path)
+
+          first = self.first[i]
+          entries = []
+          for c in range(first, first + self.children[i]):
+              name = self.nameOf(c)
+              entries.append(SnapshotEntry(self, c, name, os.path.join(path, name)))
+          return(entries)
+
+
+
+
+# Reads the directories stored in snapshots (paths of snapshot files) instead of
+# fileSystem (default: the local one); everything else is read from fileSystem.
+class SnapshotFileSystem(fileSystems.FileSystem):
+
+      def __init__(self, paths, fileSystem=None):
+          self.paths = list(paths)
+          self.fileSystem = fileSystems.LocalFileSystem() if fileSystem is None else fileSystem
+          self.snapshots = []
+          try:
+             for p in self.paths:
+                 self.snapshots.append(Snapshot(p))
+          except Exception:
+             self.close()
+             raise
+
+
+      # Sharded traversals (-MP) hand the file system to other processes, which map
+      # the snapshots themselves.
+      def __getstate__(self):
+          return({'paths':self.paths, 'fileSystem':self.fileSystem})
+
+      def __setstate__(self, state):
+          self.__init__(state['paths'], state['fileSystem'])
+
+
+      def close(self):
+          for s in self.snapshots:
+              s.close()
+          self.snapshots = []
+
+
+      # (snapshot, entry) of path, or (None, None) if path is in no snapshot.
+      # Raises OSError if path is in a snapshot but was not there.
+      def locate(self, path):
+          for s in self.snapshots:
+              components = s.components(path)
+              if components is not None:
+                 return(s, s.lookup(components, path))
+          return(None, None)
+
+
+      def listDirectory(self, path):
+          s, i = self.locate(path)
+          if s is None:
+             return(self.fileSystem.listDirectory(path))
+          return(s.listDirectory(i, path))
+
+
+      def stat(self, path):
+          s, i = self.locate(path)
+          if s is None:
+             return(self.fileSystem.stat(path))
+          return(s.stat(i, path))
+
+
+      def open(self, path):
+          s, i = self.locate(path)
+          if s is None:
+             return(self.fileSystem.open(path))
+          raise OSError(errno.EOPNOTSUPP, 'Contents of files are not stored in snapshots', path)
@@ -0,0 +1,60 @@
+
+#
+#
+#
+# Templates compiled once, before exporting (see handlers.ExportVisitor).
+#
+# A template is split at its pseudovariables into literal text and fields. Rendering an
+# item evaluates only the fields the template contains, each once, and joins the pieces
+# in one go. Before, every known pseudovariable was replaced with str.replace() and the
+# value computed with eval(), for every item.
+#
+# Pseudovariables that are not fields of the template (e.g. ${SUBDIRECTORY} or the counts
+# of directories) are kept as literal text; they are replaced later.
+#
+# NOTE: Values are not searched for pseudovariables again: a file named ${LEVEL}.txt is
+#       exported as such.
+#
+#
+#
+
+
+import re
+
+
+
+PSEUDOVARIABLE = re.compile(r'(\$\{[A-Z]+\})')
+
+
+
+# source: the text of the template.
+# fields: pseudovariable -> function returning its value (a string) for the arguments
+#         render() is called with.
+class Template:
+
+      __slots__ = ('source', 'parts', 'fields')
+
+      def __init__(self, source, fields):
+          self.source = source
+          # Literal text at even positions, pseudovariables at odd ones
+          self.parts = PSEUDOVARIABLE.split(source)
+
+          positions = {}
+          for i in range(1, len(self.parts), 2):
+              if self.parts[i] in fields:
+                 positions.setdefault(self.parts[i], []).append(i)
+
+          # (function, positions of its pseudovariable), in the order of first appearance
+          self.fields = [(fields[pv], tuple(p)) for pv, p in positions.items()]
+
+
+      def render(self, *args):
+          if len(self.fields) == 0:
+             return(self.source)
+
+          parts = self.parts.copy()
+          for field, positions in self.fields:
+              value = field(*args)
+              for i in positions:
+                  parts[i] = value
+          return(''.join(parts))
@@ -7,12 +7,40 @@
 #
 #
 
+import asyncio
+import bz2
+import csv
+import gzip
+import io
+import json
+import lzma
+import os
+import random
+import re
+import shutil
+import sqlite3
+import sys
+import tarfile
+import tempfile
+import threading
+import time
 import unittest
+import zipfile
 
 import pathlib as pl
 
 import GUI
+import archives
 import functionality 
+import asyncWalker
+import dirIndex
+import fileSystems
+import handlers
+import lazyExport
+import snapshot
+import templateEngine
+import utilities
+import watcher
 
 
 
@@ -182,5 +210,746 @@ class TestCriteria(unittest.TestCase):
    
 
 
+
+      #
+      # Traversal tests
+      #
+
+      def test_traversal_scandirMetadataMatchesStat(self):
+          # Metadata taken from the directory listing (DirEntry) must be the
+          # same as the metadata of an explicit stat call.
+          dirs, files = functionality.scanDirectory('testDirectories/testDir2')
+          self.assertEqual(len(dirs), 0, 'Directory should not contain any SUBDIRECTORY')
+          self.assertEqual(len(files), 6, 'Directory should contain 6 FILES')
+          for f in files:
+              eMeta = utilities.entryInfo(f)
+              sMeta = utilities.fileInfo(f.path)
+              self.assertEqual(eMeta['size'], sMeta['size'])
+              self.assertEqual(eMeta['lastmodified'], sMeta['lastmodified'])
+
+          self.assertEqual([f.name for f in files], sorted(f.name for f in files), 'Files should be sorted by name')
+
+
+      def test_traversal_iterativeSameAsRecursive(self):
+          rResult = functionality.search(query=r'.*', criteria={'directory':'testDirectories/testDir0'})
+          iResult = functionality.search(query=r'.*', criteria={'directory':'testDirectories/testDir0', 'iterative':True})
+          self.assertEqual(rResult, iResult, 'Iterative and recursive traversal should return the same results')
+
+
+      def test_traversal_workersSameAsSerial(self):
+          sVisitor = handlers.SearchVisitor('', {'directory':'testDirectories', 'fileinclusionPattern':'(.*)', 'dirinclusionPattern':'(.*)'})
+          pVisitor = handlers.SearchVisitor('', {'directory':'testDirectories', 'fileinclusionPattern':'(.*)', 'dirinclusionPattern':'(.*)', 'workers':4})
+          sResult = functionality.traverse('testDirectories', sVisitor)
+          pResult = functionality.traverse('testDirectories', pVisitor)
+          self.assertEqual(sResult, pResult, 'Traversal with worker threads should return the same counts')
+          self.assertEqual(sVisitor.matches, pVisitor.matches, 'Traversal with worker threads should visit items in the same order')
+
+          pages = []
+          for workers in (0, 4):
+              out = io.StringIO()
+              random.seed(1)
+              functionality.export({'directory':'testDirectories', 'template':'templates/jsonTemplate.tmpl', 'outputFile':'-', 'workers':workers}, out)
+              pages.append(out.getvalue())
+          self.assertEqual(pages[1], pages[0], 'Export with worker threads should be the same')
+
+
+      def test_traversal_prefetcherListsEachDirectoryOnce(self):
+          scanned = []
+          class CountingPrefetcher(functionality.DirectoryPrefetcher):
+                def scan(self, path, lvl):
+                    scanned.append(path)
+                    return(super().scan(path, lvl))
+
+          sVisitor = handlers.SearchVisitor('', {'directory':'testDirectories', 'fileinclusionPattern':'(.*)', 'dirinclusionPattern':'(.*)'})
+          pVisitor = handlers.SearchVisitor('', {'directory':'testDirectories', 'fileinclusionPattern':'(.*)', 'dirinclusionPattern':'(.*)'})
+          functionality.fsTraversalIterative('testDirectories', 1, sVisitor)
+          # Few pending listings, so that the traversal often takes directories not prefetched
+          prefetcher = CountingPrefetcher(4, maxPending=2)
+          prefetcher.submit('testDirectories', 1)
+          try:
+             functionality.fsTraversalIterative('testDirectories', 1, pVisitor, prefetcher)
+             # E.g. by a late listing of its parent
+             prefetcher.submit('testDirectories/testDir0', 2)
+          finally:
+             prefetcher.pool.shutdown(wait=True)
+
+          self.assertEqual(pVisitor.matches, sVisitor.matches, 'Prefetched traversal should find the same items in the same order')
+          self.assertEqual(sorted(scanned), sorted(set(scanned)), 'Directories should be listed once')
+          self.assertEqual(prefetcher.nPending, 0, 'No pending listings should be left')
+          self.assertEqual(len(prefetcher.futures), 0, 'Taken directories should not be submitted again')
+
+
+      def test_traversal_processesSameAsSerial(self):
+          sVisitor = handlers.SearchVisitor(r'(?i:p)', {'directory':'testDirectories', 'fileinclusionPattern':'((?i:p))', 'dirinclusionPattern':'((?i:p))'})
+          pVisitor = handlers.SearchVisitor(r'(?i:p)', {'directory':'testDirectories', 'fileinclusionPattern':'((?i:p))', 'dirinclusionPattern':'((?i:p))', 'processes':2})
+          sResult = functionality.traverse('testDirectories', sVisitor)
+          pResult = functionality.traverse('testDirectories', pVisitor)
+          self.assertEqual(sResult, pResult, 'Sharded traversal should return the same counts')
+          self.assertEqual(sVisitor.matches, pVisitor.matches, 'Sharded traversal should find the same matches in the same order')
+
+
+      def test_traversal_asyncWalkFindsSameItems(self):
+          sVisitor = handlers.SearchVisitor('', {'directory':'testDirectories', 'fileinclusionPattern':'(.*)', 'dirinclusionPattern':'(.*)'})
+          functionality.traverse('testDirectories', sVisitor)
+
+          async def collect():
+                return([e.path async for e in asyncWalker.walk('testDirectories', {}, concurrency=4)])
+
+          aPaths = asyncio.run(collect())
+          self.assertEqual(sorted(aPaths), sorted(sVisitor.matches), 'Async walk should yield all files and directories')
+
+
+      def test_traversal_asyncWalkBoundedBySlowConsumer(self):
+          tmpDir = tempfile.mkdtemp()
+          try:
+             for i in range(200):
+                 os.makedirs(os.path.join(tmpDir, f'd{i}', 'sub'))
+
+             async def consume():
+                   n = 0
+                   gen = asyncWalker.walk(tmpDir, {}, concurrency=4)
+                   try:
+                      async for e in gen:
+                            n += 1
+                            if n == 200:
+                               # All subdirectories of tmpDir found; let the listers run ahead as far as they can
+                               await asyncio.sleep(0.2)
+                               nTasks = len(asyncio.all_tasks())
+                   finally:
+                      await gen.aclose()
+                   return(n, nTasks)
+
+             n, nTasks = asyncio.run(consume())
+             self.assertEqual(n, 400, 'Async walk should yield all directories')
+             self.assertLessEqual(nTasks, 4 + 1, 'Only the listers and the consumer should be running')
+          finally:
+             shutil.rmtree(tmpDir, ignore_errors=True)
+
+
+      def test_traversal_asyncWalkStopsAtMaxFiles(self):
+          async def collect(status):
+                return([e async for e in asyncWalker.walk('testDirectories', {'maxFiles':3}, status=status)])
+
+          status = {}
+          entries = asyncio.run(collect(status))
+          self.assertEqual(len([e for e in entries if e.type == 'file']), 3, 'Should yield 3 FILES')
+          self.assertEqual(status['code'], -9, 'Status code should be -9 (maximum number of files)')
+
+
+      def test_traversal_walkYieldsSameItemsAsSearch(self):
+          sVisitor = handlers.SearchVisitor('', {'directory':'testDirectories', 'fileinclusionPattern':'(.*)', 'dirinclusionPattern':'(.*)'})
+          functionality.traverse('testDirectories', sVisitor)
+
+          wPaths = [e.path for e in functionality.walk('testDirectories')]
+          self.assertEqual(wPaths, sVisitor.matches, 'walk should yield all files and directories in traversal order')
+
+          # Stop early
+          for e in functionality.walk('testDirectories'):
+              break
+          self.assertEqual(e.path, sVisitor.matches[0], 'walk should yield the first item first')
+
+
+      def test_criteria_compiledChecksCheapestFirst(self):
+          compiled = handlers.CompiledCriteria({'fileinclusionPattern':r'\.pdf$', 'minFileSize':10, 'lastModifiedDate':'01/01/2100', 'lastModifiedDateOp':'<'})
+          self.assertEqual([c.kind for c in compiled.fileChecks], ['name', 'size', 'date'], 'Checks should be ordered name, size, date')
+
+          meta = utilities.fileInfo('unitTests.py')
+          self.assertEqual(compiled.fileFailure('unitTests.py', meta).kind, 'name', 'Name check should fail first')
+          self.assertIsNone(compiled.fileFailure('a.pdf', meta), 'File should comply')
+          self.assertEqual(handlers.CompiledCriteria({'lastModifiedDate':'01/01/2100', 'lastModifiedDateOp':'>'}).fileFailure('a.pdf', meta).kind, 'date', 'Date check should fail')
+
+
+      def test_criteria_exportIgnoresExactFileSize(self):
+          pages = []
+          for extra in ({}, {'fileSize':176820}):
+              random.seed(1)
+              out = io.StringIO()
+              res = functionality.export(dict({'directory':'testDirectories', 'template':'templates/jsonTemplate.tmpl', 'outputFile':'-'}, **extra), out)
+              self.assertEqual(res[0], 0, 'Status should be 0')
+              pages.append(out.getvalue())
+          self.assertEqual(pages[1], pages[0], 'Exports should not filter on -fsz')
+
+          result = functionality.search(query=r'.*', criteria={'directory':'testDirectories', 'fileSize':176820, 'noDirs':True})
+          self.assertEqual(result[2], 1, 'Searches should still filter on -fsz')
+
+
+      def test_traversal_lazyMetadataOnlyWhenNeeded(self):
+          entries = list(functionality.walk('testDirectories', {'fileinclusionPattern':r'\.pdf$'}))
+          self.assertTrue(all(not e.meta.loaded() for e in entries), 'Name criteria should not stat')
+
+          entries = list(functionality.walk('testDirectories', {'minFileSize':1}))
+          self.assertTrue(all(e.meta.loaded() for e in entries if e.type == 'file'), 'Size criteria should stat')
+          self.assertEqual(entries[0].meta['size'], os.stat(entries[0].path).st_size, 'Lazily fetched size should be the file size')
+
+
+      def test_index_searchSameAsLive(self):
+          tmpDir = tempfile.mkdtemp()
+          db = os.path.join(tmpDir, 'index.db')
+          try:
+             stats = functionality.refreshIndex({'directory':'testDirectories', 'index':db})
+             self.assertEqual(stats['unchanged'], 0, 'All directories should be listed')
+             stats = functionality.refreshIndex({'directory':'testDirectories', 'index':db})
+             self.assertEqual(stats['listed'], 0, 'Unchanged directories should not be listed again')
+
+             live = handlers.SearchVisitor('', {'fileinclusionPattern':'((?i:p))', 'dirinclusionPattern':'((?i:p))'})
+             functionality.traverse('testDirectories', live)
+             indexed = handlers.SearchVisitor('', {'fileinclusionPattern':'((?i:p))', 'dirinclusionPattern':'((?i:p))', 'index':db})
+             functionality.traverse('testDirectories', indexed)
+             self.assertEqual(indexed.matches, live.matches, 'Search from index should find the same items')
+          finally:
+             shutil.rmtree(tmpDir, ignore_errors=True)
+
+
+      def test_export_treeModelSameAsReference(self):
+          tmpDir = tempfile.mkdtemp()
+          try:
+             # Nested (a/b), empty (e) and excluded (x) directories
+             for d in ('a/b', 'e', 'x'):
+                 os.makedirs(os.path.join(tmpDir, d))
+             for f in ('a/b/f1.txt', 'a/f2.txt', 'a/f3.txt', 'x/f4.txt', 'r.txt'):
+                 open(os.path.join(tmpDir, f), 'w').close()
+
+             dTemp = '<d ${DIRNAME} ${LNDIRS}/${LNFILES} ${NDIRS}/${NFILES}>${SUBDIRECTORY}</d>'
+             hE = handlers.ExportVisitor(dTemp, '<f ${FILENAME}>', '${TREE}', {'directory':tmpDir, 'direxclusionPattern':'^x$'})
+             hE.stack.append(handlers.ExportFrame(0, tmpDir, '<root>${SUBDIRECTORY}</root>'))
+             res = functionality.traverse(tmpDir, hE)
+             self.assertEqual(res[0], 0, 'Status should be 0')
+
+             # Subdirectories first, then the files in reverse order; empty directories keep ${SUBDIRECTORY}
+             reference = ('<root><d a 1/2 1/3><d b 0/1 0/1><f f1.txt></d> <f f3.txt> <f f2.txt></d> '
+                          '<d e 0/0 0/0>${SUBDIRECTORY}</d> <f r.txt></root>')
+             tree = hE.finish()
+             self.assertEqual(tree.render(' '), reference, 'Tree model should render the reference export')
+             pieces = []
+             tree.write(pieces.append, ' ')
+             self.assertEqual(''.join(pieces), reference, 'Written tree should be the rendered tree')
+             self.assertEqual(tree.render(' ', contents=True), reference[len('<root>'):-len('</root>')], 'Contents should not include the directory itself')
+          finally:
+             shutil.rmtree(tmpDir, ignore_errors=True)
+
+
+      def test_export_cacheSameCountsAsExport(self):
+          tmpDir = tempfile.mkdtemp()
+          try:
+             criteria = {'directory':'testDirectories', 'outputFile':os.path.join(tmpDir, 'index.html')}
+             res = functionality.export(criteria)
+             cached = dict(criteria, exportCache=os.path.join(tmpDir, 'cache.db'))
+             self.assertEqual(functionality.export(cached), res, 'First cached export should return the same counts')
+             self.assertEqual(functionality.export(cached), res, 'Export from cache should return the same counts')
+          finally:
+             shutil.rmtree(tmpDir, ignore_errors=True)
+
+
+      def test_export_cacheKeepsOtherRoots(self):
+          tmpDir = tempfile.mkdtemp()
+          try:
+             db = os.path.join(tmpDir, 'cache.db')
+             def fragments(root):
+                 conn = sqlite3.connect(db)
+                 try:
+                    return(conn.execute('SELECT COUNT(*) FROM fragments WHERE path LIKE ?', (root + '/%',)).fetchone()[0])
+                 finally:
+                    conn.close()
+
+             functionality.export({'directory':'testDirectories/testDir0/1', 'outputFile':os.path.join(tmpDir, 'a.html'), 'exportCache':db})
+             stored = fragments('testDirectories/testDir0/1')
+             self.assertGreater(stored, 0, 'Subdirectories should be stored')
+             functionality.export({'directory':'testDirectories/testDir0/2', 'outputFile':os.path.join(tmpDir, 'b.html'), 'exportCache':db})
+             self.assertGreater(fragments('testDirectories/testDir0/2'), 0, 'Subdirectories should be stored')
+             self.assertEqual(fragments('testDirectories/testDir0/1'), stored, 'Records of the other starting directory should be kept')
+          finally:
+             shutil.rmtree(tmpDir, ignore_errors=True)
+
+
+      def test_export_cacheDeepTree(self):
+          tmpDir = tempfile.mkdtemp()
+          path = root = os.path.join(tmpDir, 'deep')
+          try:
+             os.mkdir(path)
+             for i in range(1200):
+                 path = os.path.join(path, 'd')
+                 os.mkdir(path)
+             criteria = {'directory':root, 'iterative':True, 'template':'templates/jsonTemplate.tmpl', 'outputFile':os.path.join(tmpDir, 'index.json')}
+             pages = []
+             for extra in ({}, {'exportCache':os.path.join(tmpDir, 'cache.db')}, {'exportCache':os.path.join(tmpDir, 'cache.db')}):
+                 random.seed(1)
+                 res = functionality.export(dict(criteria, **extra))
+                 self.assertEqual(res[0], 0, 'Status should be 0')
+                 self.assertEqual(res[3], 1200, 'All directories should be exported')
+                 with open(criteria['outputFile'], encoding='utf8') as f:
+                      pages.append(f.read())
+             self.assertEqual(pages[1], pages[0], 'Cached export should be the same')
+             self.assertEqual(pages[2], pages[0], 'Export from cache should be the same')
+          finally:
+             # shutil.rmtree() recurses once per level
+             while path != tmpDir:
+                   if os.path.isdir(path):
+                      os.rmdir(path)
+                   path = os.path.dirname(path)
+             shutil.rmtree(tmpDir, ignore_errors=True)
+
+
+      def test_export_streamedSameAsKept(self):
+          tmpDir = tempfile.mkdtemp()
+          try:
+             # Checkpoints keep the items of the starting directory until the end
+             pages = []
+             for extra in ({}, {'checkpoint':os.path.join(tmpDir, 'export.ckpt')}):
+                 random.seed(1)
+                 out = io.StringIO()
+                 res = functionality.export(dict({'directory':'testDirectories', 'template':'templates/jsonTemplate.tmpl', 'outputFile':'-'}, **extra), out)
+                 self.assertEqual(res[0], 0, 'Status should be 0')
+                 pages.append(out.getvalue())
+             self.assertEqual(pages[0], pages[1], 'Streamed page should be the same')
+             self.assertEqual(pages[0].count('"type":"directory"'), res[3] + 1, 'Page should contain all directories')
+          finally:
+             shutil.rmtree(tmpDir, ignore_errors=True)
+
+
+      def test_export_lazyShardsSameAsInline(self):
+          tmpDir = tempfile.mkdtemp()
+          try:
+             page = os.path.join(tmpDir, 'export.json')
+             pages = []
+             for lazyLevels in (0, 2):
+                 random.seed(1)
+                 res = functionality.export({'directory':'testDirectories', 'template':'templates/jsonTemplate.tmpl', 'outputFile':page, 'lazyLevels':lazyLevels})
+                 self.assertEqual(res[0], 0, 'Status should be 0')
+                 with open(page, encoding='utf8') as f:
+                      pages.append(f.read())
+
+             # Put the contents of the shards back in place of their placeholders
+             placeholder = lazyExport.PLACEHOLDER.format(id='([0-9]+)', src='([^"]+)')
+             def shard(m):
+                 with open(os.path.join(tmpDir, m.group(2)), encoding='utf8') as f:
+                      js = f.read()
+                 self.assertTrue(js.startswith(f'dirWalkerShard({m.group(1)}, '), 'Shard should call the loader')
+                 return(re.sub(placeholder, shard, json.loads(js[js.index(',')+1:js.rindex(')')])))
+
+             self.assertGreater(len(re.findall(placeholder, pages[1])), 0, 'Page should contain shards')
+             self.assertEqual(re.sub(placeholder, shard, pages[1]), pages[0], 'Shards should hold the rest of the page')
+          finally:
+             shutil.rmtree(tmpDir, ignore_errors=True)
+
+
+      def test_export_virtualRowsFormTree(self):
+          out = io.StringIO()
+          res = functionality.export({'directory':'testDirectories', 'exportFormat':'virtual', 'outputFile':'-'}, out)
+          self.assertEqual(res[0], 0, 'Status should be 0')
+
+          rows = json.loads(re.search(r'id="dirWalkerRows">(.*?)</script>', out.getvalue(), re.DOTALL).group(1))
+          self.assertEqual(len(rows), res[3] + res[4] + 1, 'Every directory and file should have a row')
+
+          paths = ['testDirectories']
+          for i, row in enumerate(rows[1:], 1):
+              self.assertTrue(0 <= row[0] < i and len(rows[row[0]]) == 2, 'Parent should be a previous directory row')
+              paths.append(os.path.join(paths[row[0]], row[1]))
+
+          walked = {'testDirectories'}
+          for d, subdirs, files in os.walk('testDirectories'):
+              walked |= {os.path.join(d, e) for e in subdirs + files}
+          self.assertEqual(set(paths), walked, 'Rows should hold the whole tree')
+
+
+      def test_export_recordsEscapeAnyName(self):
+          tmpDir = tempfile.mkdtemp()
+          try:
+             names = ['plain.txt', 'comma, "quoted".txt', 'back\\slash.txt', 'new\nline.txt', '{"json"}.txt']
+             os.mkdir(os.path.join(tmpDir, 'sub, dir'))
+             for n in names:
+                 with open(os.path.join(tmpDir, 'sub, dir', n), 'w') as f:
+                      f.write(n)
+             expected = {(os.path.join(tmpDir, 'sub, dir'), 'directory', '')} | {(os.path.join(tmpDir, 'sub, dir', n), 'file', str(len(n))) for n in names}
+
+             out = io.StringIO()
+             functionality.export({'directory':tmpDir, 'exportFormat':'ndjson', 'columns':'path,type,size', 'outputFile':'-'}, out)
+             records = [json.loads(line) for line in out.getvalue().splitlines()]
+             self.assertEqual({(r['path'], r['type'], '' if r['size'] is None else str(r['size'])) for r in records}, expected, 'ndjson should hold every item')
+
+             out = io.StringIO()
+             functionality.export({'directory':tmpDir, 'exportFormat':'csv', 'columns':'path,type,size', 'outputFile':'-'}, out)
+             rows = list(csv.reader(io.StringIO(out.getvalue(), newline='')))
+             self.assertEqual(rows[0], ['path', 'type', 'size'], 'csv should start with the header')
+             self.assertEqual({tuple(r) for r in rows[1:]}, expected, 'csv should hold every item')
+          finally:
+             shutil.rmtree(tmpDir, ignore_errors=True)
+
+
+      def test_export_compressedSameAsPlain(self):
+          tmpDir = tempfile.mkdtemp()
+          try:
+             pages = []
+             for output, extra in (('export.json', {}), ('export.json', {'compress':'bz2'}), ('export.json.xz', {'compressLevel':1})):
+                 random.seed(1)
+                 res = functionality.export(dict({'directory':'testDirectories', 'template':'templates/jsonTemplate.tmpl', 'outputFile':os.path.join(tmpDir, output)}, **extra))
+                 self.assertEqual(res[0], 0, 'Status should be 0')
+             with open(os.path.join(tmpDir, 'export.json'), encoding='utf8') as f:
+                  pages.append(f.read())
+             with bz2.open(os.path.join(tmpDir, 'export.json.bz2'), 'rt', encoding='utf8') as f:
+                  pages.append(f.read())
+             with lzma.open(os.path.join(tmpDir, 'export.json.xz'), 'rt', encoding='utf8') as f:
+                  pages.append(f.read())
+             self.assertEqual(pages[1], pages[0], 'bz2 export should decompress to the same page')
+             self.assertEqual(pages[2], pages[0], 'xz export should decompress to the same page')
+
+             res = functionality.search('pdf$', {'directory':'testDirectories', 'searchOutput':os.path.join(tmpDir, 'found.txt'), 'compress':'gzip'})
+             with gzip.open(os.path.join(tmpDir, 'found.txt.gz'), 'rt', encoding='utf8') as f:
+                  found = f.read().splitlines()
+             self.assertEqual(len(found), res[1] + res[2], 'Search output should hold every match')
+
+             # Unsupported levels are replaced by the nearest supported one
+             for output, level in (('low.json.bz2', 0), ('high.json.gz', 12), ('high.json.xz', 12)):
+                 random.seed(1)
+                 res = functionality.export({'directory':'testDirectories', 'template':'templates/jsonTemplate.tmpl', 'outputFile':os.path.join(tmpDir, output), 'compressLevel':level})
+                 self.assertEqual(res[0], 0, 'Status should be 0')
+                 with {'.bz2':bz2, '.gz':gzip, '.xz':lzma}[os.path.splitext(output)[1]].open(os.path.join(tmpDir, output), 'rt', encoding='utf8') as f:
+                      self.assertEqual(f.read(), pages[0], f'Level {level} export should decompress to the same page')
+          finally:
+             shutil.rmtree(tmpDir, ignore_errors=True)
+
+
+      def test_export_pagesHaveSubtreeCounts(self):
+          tmpDir = tempfile.mkdtemp()
+          try:
+             page = os.path.join(tmpDir, 'index.html')
+             criteria = {'directory':'testDirectories', 'template':'templates/htmlTemplate.tmpl', 'outputFile':page, 'introduction':'', 'pageLevels':2, 'processes':2}
+             res = functionality.export(criteria)
+             self.assertEqual(res[0], 0, 'Status should be 0')
+
+             # Every directory down to level 2 has a page with the counts of its whole subtree
+             pages = {}
+             for d, subdirs, files in os.walk('testDirectories'):
+                 rel = os.path.relpath(d, 'testDirectories')
+                 if rel.count(os.sep) >= 2:
+                    continue
+                 pagePath = page if rel == '.' else os.path.join(tmpDir, 'index-pages', rel, 'index.html')
+                 with open(pagePath, encoding='utf8') as f:
+                      pages[pagePath] = f.read()
+                 nDirs = sum(len(s) for _, s, _ in os.walk(d))
+                 nFiles = sum(len(f) for _, _, f in os.walk(d))
+                 self.assertIn(f'({len(subdirs)} - {len(files)} / {nDirs} - {nFiles})', pages[pagePath], f'Page of {rel} should have the counts of its subtree')
+
+             # Breadcrumbs and links lead to pages
+             for pagePath, text in pages.items():
+                 breadcrumb = re.search(r'<div class="dirWalkerBreadcrumb">.*?</div>', text).group(0)
+                 for href in re.findall(r'class="dirWalkerPage" href="([^"]+)"', text) + re.findall(r'<a href="([^"]+)"', breadcrumb):
+                     self.assertIn(os.path.normpath(os.path.join(os.path.dirname(pagePath), href)), pages, f'Link {href} of {pagePath} should lead to a page')
+
+             # Only the pages of the subtree are exported again
+             with open(page, 'w') as f:
+                  f.write('untouched')
+             res = functionality.export(dict(criteria, pageSubtree='testDir0'))
+             self.assertEqual(res[0], 0, 'Status should be 0')
+             with open(page) as f:
+                  self.assertEqual(f.read(), 'untouched', 'Pages outside the subtree should not be touched')
+          finally:
+             shutil.rmtree(tmpDir, ignore_errors=True)
+
+
+      def test_export_pagesCompressedLikeRoot(self):
+          tmpDir = tempfile.mkdtemp()
+          try:
+             page = os.path.join(tmpDir, 'index.html.xz')
+             res = functionality.export({'directory':'testDirectories', 'template':'templates/htmlTemplate.tmpl', 'outputFile':page, 'introduction':'', 'pageLevels':1})
+             self.assertEqual(res[0], 0, 'Status should be 0')
+
+             pagePaths = [page] + [os.path.join(tmpDir, 'index-pages', d, 'index.html.xz') for d in os.listdir('testDirectories') if os.path.isdir(os.path.join('testDirectories', d))]
+             for pagePath in pagePaths:
+                 with lzma.open(pagePath, 'rt', encoding='utf8') as f:
+                      text = f.read()
+                 for href in re.findall(r'class="dirWalkerPage" href="([^"]+)"', text):
+                     self.assertIn(os.path.normpath(os.path.join(os.path.dirname(pagePath), href)), pagePaths, f'Link {href} of {pagePath} should lead to a compressed page')
+             self.assertFalse(os.path.exists(os.path.join(tmpDir, 'index-pages', 'testDir0', 'index.html')), 'Pages should not be written uncompressed')
+          finally:
+             shutil.rmtree(tmpDir, ignore_errors=True)
+
+
+      def test_watch_indexFollowsChanges(self):
+          def indexed(db, root):
+              idx = dirIndex.DirectoryIndex(db)
+              try:
+                 items = set()
+                 stack = [root]
+                 while len(stack) > 0:
+                       p = stack.pop()
+                       dirs, files = idx.listing(p)
+                       items |= {(os.path.join(p, f.name), f.st_size) for f in files}
+                       stack.extend(os.path.join(p, d.name) for d in dirs)
+                 return(items)
+              finally:
+                 idx.close()
+
+          def live(root):
+              return({(os.path.join(p, f), os.stat(os.path.join(p, f)).st_size) for p, ds, fs in os.walk(root) for f in fs})
+
+          for poll in (False, True):
+              tmpDir = tempfile.mkdtemp()
+              root = os.path.join(tmpDir, 'root')
+              db = os.path.join(tmpDir, 'index.db')
+              os.makedirs(os.path.join(root, 'a', 'b'))
+              stop = threading.Event()
+              ready = threading.Event()
+              w = threading.Thread(target=watcher.watch, args=(root, db), kwargs={'delay':0.05, 'poll':poll, 'stop':stop, 'ready':ready})
+              w.start()
+              try:
+                 ready.wait()
+                 # Burst of creates, then renames, deletes, a new subtree and modified files
+                 for i in range(2000):
+                     with open(os.path.join(root, 'a', f'f{i}'), 'w') as fh:
+                          fh.write('x')
+                 os.makedirs(os.path.join(root, 'new', 'deeper'))
+                 with open(os.path.join(root, 'new', 'deeper', 'g'), 'w') as fh:
+                      fh.write('g')
+                 os.rename(os.path.join(root, 'a', 'b'), os.path.join(root, 'new', 'b'))
+                 os.rename(os.path.join(root, 'a', 'f0'), os.path.join(root, 'new', 'b', 'f0'))
+                 for i in range(1, 1000):
+                     os.remove(os.path.join(root, 'a', f'f{i}'))
+                 with open(os.path.join(root, 'a', 'f1999'), 'a') as fh:
+                      fh.write('longer')
+
+                 # Polling does not notice edited files
+                 edited = (lambda e: poll and e[0].endswith('f1999'))
+                 deadline = time.monotonic() + 20
+                 while time.monotonic() < deadline:
+                       try:
+                          got = {e for e in indexed(db, root) if not edited(e)}
+                       except OSError:
+                          # The index was updated between the listings read by indexed()
+                          got = None
+                       expected = {e for e in live(root) if not edited(e)}
+                       if got == expected:
+                          break
+                       time.sleep(0.1)
+                 self.assertEqual(got, expected, f'Index should follow changes (poll:{poll})')
+              finally:
+                 stop.set()
+                 w.join()
+                 shutil.rmtree(tmpDir, ignore_errors=True)
+
+
+      def test_traversal_resumedRunsSameAsOneRun(self):
+          tmpDir = tempfile.mkdtemp()
+          criteria = {'fileinclusionPattern':'((?i:e))', 'dirinclusionPattern':'((?i:e))'}
+          resumable = dict(criteria, checkpoint=os.path.join(tmpDir, 'search.ckpt'), resume=True, maxTime=1e-9)
+          try:
+             full = handlers.SearchVisitor('', criteria)
+             expected = functionality.traverse('testDirectories', full)
+
+             runs = 0
+             result = None
+             while result is None and runs < 1000:
+                   runs += 1
+                   v = handlers.SearchVisitor('', resumable)
+                   try:
+                      result = functionality.traverse('testDirectories', v)
+                   except handlers.criteriaException as ce:
+                      self.assertEqual(ce.errorCode, -10, 'Runs should stop due to maxTime')
+                      self.assertTrue(os.path.isfile(resumable['checkpoint']), 'Checkpoint should be saved')
+
+             self.assertGreater(runs, 1, 'Traversal should be resumed')
+             self.assertEqual(result, expected, 'Resumed runs should return the same counts')
+             self.assertEqual(v.matches, full.matches, 'Resumed runs should find the same items')
+             self.assertFalse(os.path.isfile(resumable['checkpoint']), 'Checkpoint should be removed')
+          finally:
+             shutil.rmtree(tmpDir, ignore_errors=True)
+
+
+      def test_export_resumedRunsSameAsOneRun(self):
+          tmpDir = tempfile.mkdtemp()
+          criteria = {'directory':'testDirectories', 'template':'templates/jsonTemplate.tmpl', 'outputFile':os.path.join(tmpDir, 'export.json')}
+          resumable = dict(criteria, checkpoint=os.path.join(tmpDir, 'export.ckpt'), resume=True, maxTime=1e-9)
+          try:
+             expected = functionality.export(criteria)
+             with open(criteria['outputFile'], encoding='utf8') as f:
+                  page = f.read()
+
+             runs = 0
+             result = (-10,)
+             while result[0] == -10 and runs < 1000:
+                   runs += 1
+                   result = functionality.export(resumable)
+
+             self.assertGreater(runs, 1, 'Export should be resumed')
+             self.assertEqual(result, expected, 'Resumed runs should return the same counts')
+             with open(criteria['outputFile'], encoding='utf8') as f:
+                  self.assertEqual(f.read(), page, 'Resumed runs should export the same page')
+             self.assertFalse(os.path.isfile(resumable['checkpoint']), 'Checkpoint should be removed')
+          finally:
+             shutil.rmtree(tmpDir, ignore_errors=True)
+
+
+      def test_traversal_uniqueDirectoriesStopsLoops(self):
+          tmpDir = tempfile.mkdtemp()
+          try:
+             os.makedirs(os.path.join(tmpDir, 'a', 'sub'))
+             os.mkdir(os.path.join(tmpDir, 'b'))
+             pl.Path(os.path.join(tmpDir, 'a', 'sub', 'f')).touch()
+             try:
+                # Loop and duplicate
+                os.symlink('..', os.path.join(tmpDir, 'a', 'sub', 'up'))
+                os.symlink(os.path.join('..', 'a'), os.path.join(tmpDir, 'b', 'alias'))
+             except (OSError, NotImplementedError):
+                self.skipTest('Symbolic links not supported')
+
+             for iterative in (False, True):
+                 result = functionality.search(query=r'.', criteria={'directory':tmpDir, 'uniqueDirectories':True, 'iterative':iterative})
+                 # a, b, a/sub, a/sub/up, b/alias and a/sub/f
+                 self.assertEqual(result[1:3], (5, 1), 'Directories should be traversed once')
+
+             # Walks running at the same time have guards of their own
+             walks = [functionality.walk(tmpDir, {'uniqueDirectories':True}) for i in range(2)]
+             entries = [[], []]
+             for pair in zip(*walks):
+                 for i, e in enumerate(pair):
+                     entries[i].append(e.path)
+             for i, w in enumerate(walks):
+                 entries[i].extend(e.path for e in w)
+             self.assertEqual(len(entries[0]), 6, 'Interleaved walks should yield every entry once')
+             self.assertEqual(entries[1], entries[0], 'Interleaved walks should yield the same entries')
+
+             async def collect():
+                   return([e.path async for e in asyncWalker.walk(tmpDir, {'uniqueDirectories':True})])
+             self.assertEqual(sorted(asyncio.run(collect())), sorted(entries[0]), 'Async walk should traverse directories once')
+          finally:
+             shutil.rmtree(tmpDir, ignore_errors=True)
+
+
+      def test_usage_sameAsSumOfFileSizes(self):
+          expected = 0
+          for dirPath, dirNames, fileNames in os.walk('testDirectories'):
+              expected += sum(os.stat(os.path.join(dirPath, f)).st_size for f in fileNames)
+
+          for processes in (0, 2):
+              result = functionality.usage(criteria={'directory':'testDirectories', 'processes':processes})
+              self.assertEqual(result[3], expected, 'Size should be the sum of file sizes')
+
+          tmpDir = tempfile.mkdtemp()
+          try:
+             os.mkdir(os.path.join(tmpDir, 'a'))
+             with open(os.path.join(tmpDir, 'a', 'f'), 'wb') as f:
+                  f.write(b'x'*1000)
+             try:
+                os.link(os.path.join(tmpDir, 'a', 'f'), os.path.join(tmpDir, 'g'))
+             except (OSError, NotImplementedError):
+                self.skipTest('Hard links not supported')
+
+             result = functionality.usage(criteria={'directory':tmpDir})
+             self.assertEqual(result[2:4], (2, 1000), 'Hard linked files should be counted once')
+          finally:
+             shutil.rmtree(tmpDir, ignore_errors=True)
+
+
+      def test_fileSystems_memoryAndLatencySameAsLocal(self):
+          search = {'fileinclusionPattern':'((?i:p))', 'dirinclusionPattern':'((?i:p))'}
+          local = handlers.SearchVisitor('', search)
+          functionality.traverse('testDirectories', local)
+
+          memory = fileSystems.MemoryFileSystem.copyOf('testDirectories')
+          previous = fileSystems.use(fileSystems.LatencyFileSystem(memory, latency=0.001))
+          try:
+             for workers in (0, 8):
+                 v = handlers.SearchVisitor('', {**search, 'workers':workers})
+                 functionality.traverse('testDirectories', v)
+                 self.assertEqual(v.matches, local.matches, 'Simulated file system should give the same results')
+
+             # Failing calls depend on the path only
+             fileSystems.use(fileSystems.LatencyFileSystem(memory, errorRate=0.3, seed=1))
+             results = []
+             for workers in (0, 8):
+                 v = handlers.SearchVisitor('', {**search, 'workers':workers})
+                 functionality.traverse('testDirectories', v)
+                 results.append(v.matches)
+             self.assertEqual(results[0], results[1], 'Errors should be the same in every run')
+             self.assertGreater(fileSystems.current.errors, 0, 'Some calls should fail')
+          finally:
+             fileSystems.use(previous)
+
+
+      def test_archives_membersTraversedWithoutExtracting(self):
+          tmpDir = tempfile.mkdtemp()
+          try:
+             with zipfile.ZipFile(os.path.join(tmpDir, 'a.zip'), 'w', zipfile.ZIP_DEFLATED) as z:
+                  z.writestr('docs/report.txt', 'x'*1000)
+                  z.writestr('../outside.txt', 'xy')
+             with tarfile.open(os.path.join(tmpDir, 'b.tar.gz'), 'w:gz') as t:
+                  t.add(os.path.join('testDirectories', 'testDir0'), arcname='testDir0')
+
+             search = {'fileinclusionPattern':'(.+)', 'dirinclusionPattern':'(.+)'}
+             archiveFs = archives.ArchiveFileSystem()
+             previous = fileSystems.use(archiveFs)
+             try:
+                for workers in (0, 8):
+                    v = handlers.SearchVisitor('', {**search, 'workers':workers})
+                    functionality.traverse(tmpDir, v)
+                    self.assertIn(os.path.join(tmpDir, 'a.zip', 'docs', 'report.txt'), v.matches, 'Zip members should be traversed')
+                    self.assertIn(os.path.join(tmpDir, 'a.zip', 'outside.txt'), v.matches, 'Member names should be sanitized')
+                    inTar = sorted(os.path.relpath(m, os.path.join(tmpDir, 'b.tar.gz')) for m in v.matches if 'b.tar.gz' + os.sep in m)
+                    inDir = sorted(['testDir0'] + [os.path.relpath(os.path.join(p, n), 'testDirectories') for p, ds, fs in os.walk(os.path.join('testDirectories', 'testDir0')) for n in ds + fs])
+                    self.assertEqual(inTar, inDir, 'Tar members should be the archived directory')
+
+                self.assertEqual(utilities.fileInfo(os.path.join(tmpDir, 'a.zip', 'docs', 'report.txt'))['size'], 1000, 'Members should have their uncompressed size')
+                self.assertEqual(archiveFs.read, 2, 'Each archive should be read once')
+             finally:
+                fileSystems.use(previous)
+          finally:
+             shutil.rmtree(tmpDir)
+
+
+      def test_snapshot_sameResultsAsWalking(self):
+          search = {'fileinclusionPattern':'((?i:p))', 'dirinclusionPattern':'((?i:p))'}
+          live = handlers.SearchVisitor('', search)
+          functionality.traverse('testDirectories', live)
+          liveUsage = handlers.UsageVisitor({'directory':'testDirectories'})
+          functionality.traverse('testDirectories', liveUsage)
+
+          tmpDir = tempfile.mkdtemp()
+          try:
+             snapshotPath = os.path.join(tmpDir, 'test.snap')
+             self.assertGreater(snapshot.write('testDirectories', snapshotPath), 50, 'All entries should be stored')
+             previous = fileSystems.use(snapshot.SnapshotFileSystem([snapshotPath]))
+             try:
+                for workers in (0, 8):
+                    v = handlers.SearchVisitor('', {**search, 'workers':workers})
+                    functionality.traverse('testDirectories', v)
+                    self.assertEqual(v.matches, live.matches, 'Searching the snapshot should give the same results')
+
+                u = handlers.UsageVisitor({'directory':'testDirectories'})
+                functionality.traverse('testDirectories', u)
+                self.assertEqual(u.usage.totals('testDirectories'), liveUsage.usage.totals('testDirectories'), 'Sizes should be stored')
+                self.assertRaises(FileNotFoundError, fileSystems.current.stat, os.path.join('testDirectories', 'missing'))
+             finally:
+                fileSystems.use(previous).close()
+          finally:
+             shutil.rmtree(tmpDir)
+
+
+      def test_templates_onlyUsedFieldsEvaluated(self):
+          calls = []
+          fields = {'${NAME}': lambda name, level: calls.append('name') or name,
+                    '${LEVEL}': lambda name, level: calls.append('level') or str(level),
+                    '${SIZE}': lambda name, level: calls.append('size') or '0'}
+          t = templateEngine.Template('<li id="${NAME}">${NAME} ${LEVEL}${SUBDIRECTORY}</li>', fields)
+          self.assertEqual(t.render('a${LEVEL}', 2), '<li id="a${LEVEL}">a${LEVEL} 2${SUBDIRECTORY}</li>', 'Other pseudovariables and values should be kept as they are')
+          self.assertEqual(calls, ['name', 'level'], 'Each field in the template should be evaluated once')
+
+
+      def test_traversal_iterativeDeepDirectory(self):
+          # Directory structure deeper than python's recursion limit
+          depth = sys.getrecursionlimit() + 200
+          tmpDir = tempfile.mkdtemp()
+          # NOTE: os.makedirs() and shutil.rmtree() are recursive themselves
+          paths = [tmpDir]
+          for i in range(depth):
+              paths.append(os.path.join(paths[-1], 'd'))
+              os.mkdir(paths[-1])
+          try:
+             result=functionality.search(query=r'd', criteria={'directory':tmpDir, 'iterative':True})
+             self.assertEqual(result[0], 0, 'Status should be 0')
+             self.assertEqual(result[1], depth, f'Should return {depth} DIRECTORIES')
+          finally:
+             for p in paths[::-1]:
+                 os.rmdir(p)
+
+
 if __name__ == "__main__":
     unittest.main(verbosity=2)
@@ -19,9 +19,12 @@ from dateutil.parser import parse
 
 import clrprint
 import itertools
+from array import array
 #from filecmp import dircmp
 from prettytable import PrettyTable
 
+import fileSystems
+
 
 # Global flag
 ON_TRAVERSE_ERROR_QUIT = False
@@ -51,6 +54,13 @@ def normalizeDateTime(td):
     return(parse(td, dayfirst=True).date())
 
 
+# Formats a date of a FileMeta record; dates not available ('') remain empty.
+def formatDateTime(dt, fmt='%d/%m/%Y %H:%M:%S'):
+    if dt == '' or dt is None:
+       return('')
+    return(dt.strftime(fmt))
+
+
 # Prints path formated so that 
 # substrings enclosed by delim in the directory or file name
 # is displayed with different color.
@@ -285,30 +295,203 @@ def fileCreationDate(filePath):
  
 
 
-# File metadata.
-# All fields are returned as strings...
-# TODO: should this be changed???
+# Typed file metadata record passed to handlers.File/Directory.
+#
+# Replaces the plain dictionary fileInfo() used to return. Fields are
+# still accessible the old way (finfo['size'], finfo.get('lastmodified'))
+# so that visitors and templates don't need to change.
+#
+# size: size in bytes (int). -1 if not available
+# lastmodified: datetime of last modification. '' if not available
+# creationdate: datetime of creation (last modification on Linux). '' if not available
+# allocated: bytes allocated on disk (int). size if not available, -1 if neither is
+# fileid: (device, inode) of files with more than one hard link, None otherwise
+class FileMeta:
+
+    __slots__ = ('size', 'lastmodified', 'creationdate', 'allocated', 'fileid')
+
+    def __init__(self, size=-1, lastmodified='', creationdate='', allocated=-1, fileid=None):
+        self.size = size
+        self.lastmodified = lastmodified
+        self.creationdate = creationdate
+        self.allocated = allocated
+        self.fileid = fileid
+
+    def __getitem__(self, key):
+        try:
+           return(getattr(self, key))
+        except (AttributeError, TypeError):
+           raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+           return(self[key])
+        except KeyError:
+           return(default)
+
+    def keys(self):
+        return(self.__slots__)
+
+    def __repr__(self):
+        return(f'FileMeta(size={self.size!r}, lastmodified={self.lastmodified!r}, creationdate={self.creationdate!r}, allocated={self.allocated!r}, fileid={self.fileid!r})')
+
+
+
+# Creation time (seconds since the epoch) of an os.stat_result.
+# Same rules as fileCreationDate() apply.
+def creationTimestamp(st):
+    try:
+       return(st.st_birthtime)
+    except AttributeError:
+       # See fileCreationDate()
+       return(st.st_ctime if platform.system() == 'Windows' else st.st_mtime)
+
+
+
+# Creates a FileMeta record out of an os.stat_result.
+# st_blocks is in units of 512 bytes; it is not available on Windows (nor in indexes).
+def statToMeta(st):
+    blocks = getattr(st, 'st_blocks', None)
+    fileid = None
+    if getattr(st, 'st_nlink', 1) > 1 and getattr(st, 'st_ino', 0) != 0:
+       fileid = (st.st_dev, st.st_ino)
+
+    return(FileMeta(st.st_size,
+                    datetime.datetime.fromtimestamp(st.st_mtime),
+                    datetime.datetime.fromtimestamp(creationTimestamp(st)),
+                    st.st_size if blocks is None else 512*blocks,
+                    fileid))
+
+
+
+# FileMeta of a directory entry that is only stat-ed when one of its fields is
+# accessed for the first time. If no field is ever accessed (e.g. a search on
+# names only), no stat call is made at all.
+class LazyFileMeta(FileMeta):
+
+    __slots__ = ('entry',)
+
+    def __init__(self, entry):
+        self.entry = entry
+
+    # Called only for fields not set yet
+    def __getattr__(self, key):
+        if key not in FileMeta.__slots__ or self.entry is None:
+           raise AttributeError(key)
+
+        try:
+           meta = statToMeta(self.entry.stat())
+        except Exception as stEx:
+           meta = FileMeta()
+
+        self.entry = None
+        self.size = meta.size
+        self.lastmodified = meta.lastmodified
+        self.creationdate = meta.creationdate
+        self.allocated = meta.allocated
+        self.fileid = meta.fileid
+        return(getattr(self, key))
+
+    def loaded(self):
+        return(self.entry is None)
+
+    def __repr__(self):
+        if not self.loaded():
+           return('LazyFileMeta(<not loaded>)')
+        return(super().__repr__())
+
+
+
+# File metadata using a single stat call (in the current file system, see fileSystems.py).
+# NOTE: earlier versions called getsize(), getmtime() and stat() separately.
 def fileInfo( filePath ):
-    fInf = {}
     try:
-      # In bytes  
-      fInf['size']  = str(os.path.getsize(filePath)) # TODO: don't change type?
-    except Exception as fszEx:
-          fInf['size'] = "-1"
+       return(statToMeta(fileSystems.current.stat(filePath)))
+    except Exception as stEx:
+       return(FileMeta())
+
 
-    try: 
-       lmd = datetime.datetime.fromtimestamp(os.path.getmtime(filePath)) 
-       fInf['lastmodified'] = lmd #.strftime("%d/%m/%Y, %H:%M:%S")
-    except Exception as dtmEx:
-        fInf['lastmodified'] = ''
 
+# File metadata of an os.DirEntry (as returned by os.scandir).
+# DirEntry caches the result of stat() so no additional system call
+# is made if the entry has already been stat-ed. On Windows, stat data
+# comes for free with the directory listing.
+def entryInfo( entry ):
     try:
-       # TODO: is this correct? 
-       fInf['creationdate'] = fileCreationDate(filePath)
-    except Exception as fcdEx:
-        fInf['creationdate'] = ''
+       return(statToMeta(entry.stat()))
+    except Exception as stEx:
+       return(FileMeta())
+
+
+
+# Same as entryInfo() but stats the entry only when a field is accessed (see LazyFileMeta).
+def lazyEntryInfo( entry ):
+    return(LazyFileMeta(entry))
+
+
+
+# Set of (device, inode) pairs, e.g. of the directories traversed.
+# A python set of tuples takes about 150 bytes per pair; here each device has an open
+# addressing hash table of inode numbers in an array of 64 bit integers, kept between a
+# quarter and half full, i.e. 16-32 bytes per pair. Tens of millions of directories fit
+# in a few hundred MB.
+class InodeSet:
+
+      __slots__ = ('tables', 'count')
+
+      MULTIPLIER = 0x9E3779B97F4A7C15
+      MASK64 = (1 << 64) - 1
+
+      def __init__(self):
+          # device -> [table, number of inodes]
+          self.tables = {}
+          self.count = 0
+
+      def __len__(self):
+          return(self.count)
+
+
+      # Returns the slot of inode key (inode + 1; 0 marks empty slots) in table
+      @classmethod
+      def slot(cls, table, key):
+          bits = len(table).bit_length() - 1
+          i = ((key * cls.MULTIPLIER) & cls.MASK64) >> (64 - bits)
+          mask = len(table) - 1
+          while table[i] != 0 and table[i] != key:
+                i = (i + 1) & mask
+          return(i)
+
+
+      def __contains__(self, pair):
+          t = self.tables.get(pair[0])
+          if t is None:
+             return(False)
+          key = pair[1] + 1
+          return(t[0][self.slot(t[0], key)] == key)
+
+
+      # Adds the pair; returns False if it was already in the set.
+      def add(self, device, inode):
+          t = self.tables.get(device)
+          if t is None:
+             t = self.tables[device] = [array('Q', [0]) * 1024, 0]
+
+          key = inode + 1
+          table = t[0]
+          i = self.slot(table, key)
+          if table[i] == key:
+             return(False)
 
-    return(fInf)
+          table[i] = key
+          t[1] += 1
+          self.count += 1
+          if 2*t[1] > len(table):
+             grown = array('Q', [0]) * (2*len(table))
+             for k in table:
+                 if k != 0:
+                    grown[self.slot(grown, k)] = k
+             t[0] = grown
+          return(True)
 
 
 
@@ -0,0 +1,302 @@
+
+#
+#
+#
+# Watches a directory structure for changes and keeps its index (see dirIndex.py)
+# up to date.
+#
+# On Linux, changes are reported by inotify (accessed through ctypes; no extra
+# packages needed): every directory in the structure is watched and each event
+# marks the directory it happened in as changed. Events are coalesced; once no
+# event has arrived for delay seconds (or, during a continuous stream of events,
+# at the latest every MAXBATCHDELAYS*delay seconds), the changed directories are
+# listed again and the index is updated. Thousands of events on the same few
+# directories hence cost a few listings.
+#
+# Elsewhere, or if inotify cannot be used (e.g. the limit of watches set in
+# /proc/sys/fs/inotify/max_user_watches has been reached), the modification
+# times of the directories are polled every delay seconds instead, exactly as
+# dirIndex.DirectoryIndex.refresh() does. Polling does not notice files whose
+# contents changed (see the NOTE in dirIndex.py).
+#
+# NOTE: Symbolic links to directories are not followed when watching; changes in
+#       linked directories are noticed only when something else changes in their
+#       parent.
+#
+#
+#
+
+
+import os
+import time
+import errno
+import struct
+import select
+import ctypes
+import ctypes.util
+
+import clrprint
+
+from utilities import normalizedPathJoin, getCurrentDateTime
+import dirIndex
+
+
+
+# inotify constants (see inotify(7))
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = getattr(os, 'O_CLOEXEC', 0)
+
+WATCHMASK = IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+
+# struct inotify_event: wd, mask, cookie, len (followed by len bytes of name)
+EVENT = struct.Struct('iIII')
+READSIZE = 1 << 16
+
+# During a continuous stream of events, the index is updated at least every
+# MAXBATCHDELAYS times the delay.
+MAXBATCHDELAYS = 10
+
+
+
+def loadLibc():
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    if not hasattr(libc, 'inotify_init1'):
+       raise OSError(errno.ENOSYS, 'inotify not available')
+
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    return(libc)
+
+
+
+
+# Reports changes using inotify.
+# ignore: paths of files whose changes are not reported (e.g. the index itself).
+# Raises OSError if inotify cannot be used.
+class InotifyWatcher:
+
+      def __init__(self, root, ignore=()):
+          self.libc = loadLibc()
+          self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+          if self.fd < 0:
+             e = ctypes.get_errno()
+             raise OSError(e, os.strerror(e))
+
+          self.ignore = set(os.path.abspath(p) for p in ignore)
+          self.ignoreNames = set(os.path.basename(p) for p in self.ignore)
+          # watch descriptor -> directory and vice versa
+          self.paths = {}
+          self.wds = {}
+          self.events = 0
+          try:
+             self.watchTree(root)
+          except OSError:
+             self.close()
+             raise
+
+
+      def close(self):
+          if self.fd >= 0:
+             os.close(self.fd)
+             self.fd = -1
+
+
+      # Watches directory path and all its subdirectories.
+      def watchTree(self, path):
+          stack = [path]
+          while len(stack) > 0:
+                p = stack.pop()
+                wd = self.libc.inotify_add_watch(self.fd, os.fsencode(p), WATCHMASK)
+                if wd < 0:
+                   e = ctypes.get_errno()
+                   if e == errno.ENOSPC:
+                      raise OSError(e, 'Limit of inotify watches reached (see /proc/sys/fs/inotify/max_user_watches)')
+                   # Removed meanwhile or not accessible
+                   continue
+
+                self.paths[wd] = p
+                self.wds[p] = wd
+                try:
+                   with os.scandir(p) as it:
+                        stack.extend(normalizedPathJoin(p, e.name) for e in it if e.is_dir(follow_symlinks=False))
+                except OSError:
+                   pass
+
+
+      # Stops watching directory path and its subdirectories (e.g. because they were moved).
+      def unwatchTree(self, path):
+          prefix = path + os.sep
+          for p in [p for p in self.wds if p == path or p.startswith(prefix)]:
+              wd = self.wds.pop(p)
+              self.paths.pop(wd, None)
+              self.libc.inotify_rm_watch(self.fd, wd)
+
+
+      def read(self):
+          try:
+             data = os.read(self.fd, READSIZE)
+          except BlockingIOError:
+             return
+
+          offset = 0
+          while offset < len(data):
+                wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+                name = data[offset+EVENT.size:offset+EVENT.size+length].rstrip(b'\0')
+                offset += EVENT.size + length
+                yield wd, mask, os.fsdecode(name)
+
+
+      # Waits up to timeout seconds for events and returns (changed, overflow):
+      # the set of directories in which something changed, and True if events were lost
+      # because too many arrived (the whole structure must then be checked).
+      def changes(self, timeout):
+          changed = set()
+          overflow = False
+          ready, _, _ = select.select([self.fd], [], [], timeout)
+          if len(ready) == 0:
+             return(changed, overflow)
+
+          while True:
+                n = self.events
+                for wd, mask, name in self.read():
+                    self.events += 1
+                    if mask & IN_Q_OVERFLOW:
+                       overflow = True
+                       continue
+
+                    path = self.paths.get(wd)
+                    if path is None:
+                       continue
+
+                    if mask & IN_IGNORED:
+                       # Watched directory removed
+                       self.paths.pop(wd, None)
+                       self.wds.pop(path, None)
+                       continue
+
+                    if name == '':
+                       continue
+
+                    entryPath = normalizedPathJoin(path, name)
+                    if name in self.ignoreNames and os.path.abspath(entryPath) in self.ignore:
+                       continue
+
+                    changed.add(path)
+                    if mask & IN_ISDIR:
+                       if mask & (IN_CREATE | IN_MOVED_TO):
+                          self.watchTree(entryPath)
+                       elif mask & IN_MOVED_FROM:
+                          self.unwatchTree(entryPath)
+
+                if self.events == n:
+                   break
+
+          return(changed, overflow)
+
+
+
+
+# Reports changes by polling directory modification times (see watch()).
+class PollingWatcher:
+
+      def __init__(self, root, ignore=()):
+          self.events = 0
+
+      def close(self):
+          return
+
+      # None: all directories must be checked
+      def changes(self, timeout):
+          time.sleep(timeout)
+          return(None, False)
+
+
+
+
+# Watches directory root and keeps the index at indexPath up to date until stop
+# (a threading.Event) is set.
+#
+# delay: seconds without events after which the index is updated (and the polling
+#        interval if inotify is not used).
+# poll: poll modification times even if inotify is available.
+# onChange: called after each update of the index with (changed, stats): the directories
+#           listed again (None if all directories were checked) and the dictionary returned
+#           by dirIndex.DirectoryIndex.refresh() with the number of events added as 'events'.
+# ignore: paths of files whose changes are ignored.
+# ready: threading.Event set once the index is initially up to date.
+def watch(root, indexPath, delay=1.0, poll=False, onChange=None, stop=None, ignore=(), ready=None):
+    index = dirIndex.DirectoryIndex(indexPath)
+    watcher = None
+    if not poll:
+       try:
+          watcher = InotifyWatcher(root, ignore)
+       except OSError as iEx:
+          clrprint.clrprint(f'[WARNING] Cannot watch [{root}] with inotify ({iEx}). Polling every {delay}s instead.', clr='yellow')
+
+    if watcher is None:
+       watcher = PollingWatcher(root, ignore)
+
+    try:
+       # Watches are set before indexing: changes made while indexing are not lost
+       index.refresh(root)
+       if ready is not None:
+          ready.set()
+
+       pending = set()
+       overflow = False
+       first = None
+       last = None
+       events = watcher.events
+       while stop is None or not stop.is_set():
+             timeout = delay
+             if first is not None:
+                timeout = max(0, min(last + delay, first + MAXBATCHDELAYS*delay) - time.monotonic())
+
+             changed, lost = watcher.changes(timeout)
+             if changed is None:
+                stats = index.refresh(root)
+                if stats['listed'] + stats['removed'] > 0 and onChange is not None:
+                   onChange(None, stats)
+                continue
+
+             now = time.monotonic()
+             if len(changed) > 0 or lost:
+                pending |= changed
+                overflow = overflow or lost
+                if first is None:
+                   first = now
+                last = now
+
+             if first is None or (now - last < delay and now - first < MAXBATCHDELAYS*delay):
+                continue
+
+             if overflow:
+                clrprint.clrprint(f'[{getCurrentDateTime()}] [WARNING] Too many changes; checking all of [{root}]', clr='yellow')
+                stats = index.refresh(root)
+                changed = None
+             else:
+                stats = index.refreshDirectories(pending)
+                changed = pending
+
+             stats['events'] = watcher.events - events
+             events = watcher.events
+             if onChange is not None:
+                onChange(changed, stats)
+
+             pending = set()
+             overflow = False
+             first = None
+    finally:
+       watcher.close()
+       index.close()